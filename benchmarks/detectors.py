@@ -0,0 +1,142 @@
+#!python
+# coding=utf-8
+""" The profile detectors of gutils.yo against each other.
+
+The `Detectors` suite times each detector over synthetic deployments of increasing
+length. Run as a module to compare the profile boundaries the detectors find in ASCII
+files, or in a synthetic deployment when no files are given::
+
+    $ python -m benchmarks.detectors gutils/tests/resources/slocum/*.dat
+"""
+import os
+import time
+import argparse
+from glob import glob
+
+import pandas as pd
+
+from gutils.profile_adjust import reassign_profile_id
+from gutils.slocum import SlocumReader
+from gutils.yo import DETECTORS, compare_profile_boundaries
+
+from benchmarks.processing import apply_filters, peak_memory, throughput
+from benchmarks.synthetic import synthetic_slocum_data
+
+
+def synthetic_depths(rows, profiles=None):
+    """ The 't' and 'z' columns of a standardized synthetic deployment """
+    names, _, _, values = synthetic_slocum_data(
+        rows=rows,
+        profiles=profiles or rows // 500
+    )
+    return pd.DataFrame({
+        't': pd.to_datetime(values[:, names.index('m_present_time')], unit='s'),
+        'z': values[:, names.index('m_depth')],
+    })
+
+
+class Detectors(object):
+
+    params = ([100000, 1000000], list(DETECTORS))
+    param_names = ['rows', 'detector']
+    timeout = 600
+
+    def setup(self, rows, detector):
+        self.data = synthetic_depths(rows)
+
+    def time_assign_profiles(self, rows, detector):
+        DETECTORS[detector](self.data, tsint=2)
+
+    def track_assign_profiles_memory(self, rows, detector):
+        return peak_memory(DETECTORS[detector], self.data, tsint=2)
+    track_assign_profiles_memory.unit = 'MB'
+
+    def track_assign_profiles_throughput(self, rows, detector):
+        return throughput(rows, DETECTORS[detector], self.data, tsint=2)
+    track_assign_profiles_throughput.unit = 'rows/s'
+
+
+def detect(data, detector, tsint):
+    start = time.time()
+    profiles = reassign_profile_id(DETECTORS[detector](data, tsint=tsint))
+    elapsed = time.time() - start
+    if profiles is not None:
+        profiles = apply_filters(profiles)
+    return profiles, elapsed
+
+
+def compare(name, data, tsint=2, tolerance=60):
+    interpolated, interpolated_time = detect(data, 'interpolated', tsint)
+    native, native_time = detect(data, 'native', tsint)
+    row = compare_profile_boundaries(interpolated, native, tolerance=tolerance)
+    row['file'] = name
+    row['rows'] = len(data)
+    row['interpolated_s'] = interpolated_time
+    row['native_s'] = native_time
+    return row
+
+
+def format_comparison(rows):
+    columns = [
+        ('file', '{:<36}'),
+        ('rows', '{:>9}'),
+        ('profiles_a', '{:>13}'),
+        ('profiles_b', '{:>8}'),
+        ('matched', '{:>8}'),
+        ('median_offset', '{:>11}'),
+        ('max_offset', '{:>9}'),
+        ('interpolated_s', '{:>15}'),
+        ('native_s', '{:>9}'),
+    ]
+    headers = [
+        'file', 'rows', 'interpolated', 'native', 'matched',
+        'median (s)', 'max (s)', 'interpolated (s)', 'native (s)'
+    ]
+
+    def cell(v):
+        if v is None:
+            return '-'
+        if isinstance(v, float):
+            return '{:.2f}'.format(v)
+        return v
+
+    lines = [' '.join(f.format(h) for (_, f), h in zip(columns, headers))]
+    for r in rows:
+        lines.append(' '.join(f.format(cell(r[k])) for k, f in columns))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the profile boundaries found by the profile detectors'
+    )
+    parser.add_argument('files', nargs='*', help='Merged ASCII files, or folders of them')
+    parser.add_argument('-ts', '--tsint', type=float, default=2)
+    parser.add_argument('--tolerance', type=float, default=60,
+                        help='Seconds the profile starts may be apart to match')
+    parser.add_argument('-r', '--rows', type=int, default=100000,
+                        help='Rows of the synthetic deployment used without any files')
+    args = parser.parse_args()
+
+    files = []
+    for f in args.files:
+        files += sorted(glob(os.path.join(f, '*.dat'))) if os.path.isdir(f) else [f]
+
+    rows = []
+    if not files:
+        rows.append(compare('synthetic', synthetic_depths(args.rows), args.tsint, args.tolerance))
+    for f in files:
+        try:
+            data = SlocumReader(f).standardize()
+        except Exception as e:
+            print('Skipping {}: {}'.format(f, e))
+            continue
+        if 'z' not in data or 't' not in data:
+            continue
+        rows.append(compare(os.path.basename(f), data, args.tsint, args.tolerance))
+
+    print(format_comparison(rows))
+
+
+if __name__ == '__main__':
+    main()
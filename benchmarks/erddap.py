@@ -0,0 +1,61 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+
+from gutils.tests import resource
+from gutils.watch import PathEvent
+from gutils.erddap import (
+    erddap_jinja_environment,
+    netcdf_to_erddap_dataset,
+    render_deployment_xml
+)
+from gutils.watch.netcdf import Netcdf2ErddapProcessor
+
+
+class ErddapUpdate(object):
+    """ Cost of adding one new profile file of a deployment to datasets.xml """
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.content = os.path.join(self.tmpdir, 'content')
+        self.flags = os.path.join(self.tmpdir, 'flags')
+        deployment = os.path.join(self.tmpdir, 'netcdf', 'deployment')
+        for d in [self.content, self.flags, deployment]:
+            os.makedirs(d)
+
+        self.netcdf = os.path.join(deployment, 'profile.nc')
+        shutil.copy(resource('erddap', '2.nc'), self.netcdf)
+
+        self.processor = Netcdf2ErddapProcessor(
+            outputs_path=os.path.dirname(deployment),
+            erddap_content_path=self.content,
+            erddap_flag_path=self.flags
+        )
+        self.event = PathEvent.from_path(self.netcdf)
+        # The deployment is already in datasets.xml, like for every profile but the first
+        self.processor.create_and_update_content(self.event)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def time_processor_update(self):
+        """ The steady state: a new profile with the same variables as the last one """
+        self.processor.create_and_update_content(self.event)
+
+    def time_processor_update_render(self):
+        """ A new profile whose variables have to be rendered and compared """
+        self.processor.datasets.forget_signatures()
+        self.processor.create_and_update_content(self.event)
+
+    def time_netcdf_to_erddap_dataset(self):
+        """ Parsing, rendering, comparing and writing datasets.xml for a single file """
+        netcdf_to_erddap_dataset(
+            os.path.join(self.content, 'datasets.xml'),
+            self.netcdf,
+            self.flags
+        )
+
+    def time_render_deployment(self):
+        render_deployment_xml(self.netcdf, erddap_jinja_environment())
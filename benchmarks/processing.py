@@ -0,0 +1,216 @@
+#!python
+# coding=utf-8
+""" How each processing stage scales with the rows, sensors and profiles of a file.
+
+Every stage has a `time_` benchmark and a `track_..._memory` benchmark with the peak
+memory (MB) allocated while it runs, as seen by tracemalloc. `track_..._throughput`
+benchmarks report rows per second.
+"""
+import os
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+from gutils.filters import (
+    filter_profile_depth,
+    filter_profile_distance,
+    filter_profile_number_of_points,
+    filter_profile_timeperiod,
+    process_dataset
+)
+from gutils.nc import create_netcdf, merge_profile_netcdf_files, read_attrs
+from gutils.profile_adjust import reassign_profile_id
+from gutils.slocum import SlocumReader
+from gutils.tests import resource
+from gutils.yo import assign_profiles
+
+from benchmarks.synthetic import write_slocum_ascii
+
+FILTERS = dict(
+    tsint=10,
+    filter_z=1,
+    filter_points=5,
+    filter_time=10,
+    filter_distance=1
+)
+
+CONFIG = resource('slocum', 'config', 'bass-20160909T1733')
+
+
+def peak_memory(func, *args, **kwargs):
+    """ Peak memory in MB allocated while running `func` """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024. / 1024.
+
+
+def throughput(rows, func, *args, **kwargs):
+    """ Rows per second processed by `func` """
+    start = time.time()
+    func(*args, **kwargs)
+    return rows / (time.time() - start)
+
+
+def apply_filters(profiles):
+    filtered, _ = filter_profile_depth(
+        profiles, below=FILTERS['filter_z'], reindex=False
+    )
+    filtered, _ = filter_profile_number_of_points(
+        filtered, points_condition=FILTERS['filter_points'], reindex=False
+    )
+    filtered, _ = filter_profile_timeperiod(
+        filtered, timespan_condition=FILTERS['filter_time'], reindex=False
+    )
+    filtered, _ = filter_profile_distance(
+        filtered, distance_condition=FILTERS['filter_distance'], reindex=True
+    )
+    return filtered
+
+
+class SyntheticFile(object):
+    """ Writes a synthetic ASCII file for each combination of the parameters """
+
+    params = ([10000, 100000], [0, 100])
+    param_names = ['rows', 'sensors']
+    timeout = 300
+
+    def setup(self, rows, sensors):
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_benchmark_')
+        self.ascii_file = write_slocum_ascii(
+            os.path.join(self.tmpdir, 'usf_synthetic_2016_252_1_0_sbd.dat'),
+            rows=rows,
+            profiles=rows // 500,
+            sensors=sensors
+        )
+
+    def teardown(self, rows, sensors):
+        shutil.rmtree(self.tmpdir)
+
+
+class Read(SyntheticFile):
+
+    def time_read(self, rows, sensors):
+        SlocumReader(self.ascii_file)
+
+    def track_read_memory(self, rows, sensors):
+        return peak_memory(SlocumReader, self.ascii_file)
+    track_read_memory.unit = 'MB'
+
+    def track_read_throughput(self, rows, sensors):
+        return throughput(rows, SlocumReader, self.ascii_file)
+    track_read_throughput.unit = 'rows/s'
+
+
+class Standardize(SyntheticFile):
+
+    def setup(self, rows, sensors):
+        super(Standardize, self).setup(rows, sensors)
+        self.reader = SlocumReader(self.ascii_file)
+
+    def time_standardize(self, rows, sensors):
+        self.reader.standardize()
+
+    def track_standardize_memory(self, rows, sensors):
+        return peak_memory(self.reader.standardize)
+    track_standardize_memory.unit = 'MB'
+
+    def track_standardize_throughput(self, rows, sensors):
+        return throughput(rows, self.reader.standardize)
+    track_standardize_throughput.unit = 'rows/s'
+
+
+class Profiles(SyntheticFile):
+    """ Profile detection, adjustment and filtering of standardized data """
+
+    def setup(self, rows, sensors):
+        super(Profiles, self).setup(rows, sensors)
+        self.standardized = SlocumReader(self.ascii_file).standardize()
+        self.assigned = assign_profiles(self.standardized, tsint=FILTERS['tsint'])
+        self.profiles = reassign_profile_id(self.assigned.copy())
+
+    def time_assign_profiles(self, rows, sensors):
+        assign_profiles(self.standardized, tsint=FILTERS['tsint'])
+
+    def track_assign_profiles_memory(self, rows, sensors):
+        return peak_memory(assign_profiles, self.standardized, tsint=FILTERS['tsint'])
+    track_assign_profiles_memory.unit = 'MB'
+
+    def time_reassign_profile_id(self, rows, sensors):
+        reassign_profile_id(self.assigned.copy())
+
+    def track_reassign_profile_id_memory(self, rows, sensors):
+        return peak_memory(reassign_profile_id, self.assigned.copy())
+    track_reassign_profile_id_memory.unit = 'MB'
+
+    def time_filters(self, rows, sensors):
+        apply_filters(self.profiles)
+
+    def track_filters_memory(self, rows, sensors):
+        return peak_memory(apply_filters, self.profiles)
+    track_filters_memory.unit = 'MB'
+
+
+class ProcessDataset(SyntheticFile):
+    """ Everything up to writing the netCDF files """
+
+    def time_process_dataset(self, rows, sensors):
+        process_dataset(self.ascii_file, SlocumReader, **FILTERS)
+
+    def track_process_dataset_memory(self, rows, sensors):
+        return peak_memory(process_dataset, self.ascii_file, SlocumReader, **FILTERS)
+    track_process_dataset_memory.unit = 'MB'
+
+    def track_process_dataset_throughput(self, rows, sensors):
+        return throughput(rows, process_dataset, self.ascii_file, SlocumReader, **FILTERS)
+    track_process_dataset_throughput.unit = 'rows/s'
+
+
+class CreateNetcdf(object):
+    """ Writing the profile netCDF files of a file and merging them into one """
+
+    params = [10, 50]
+    param_names = ['profiles']
+    timeout = 300
+
+    def setup(self, profiles):
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_benchmark_')
+        ascii_file = write_slocum_ascii(
+            os.path.join(self.tmpdir, 'usf_synthetic_2016_252_1_0_sbd.dat'),
+            rows=profiles * 500,
+            profiles=profiles
+        )
+        self.processed, self.mode = process_dataset(ascii_file, SlocumReader, **FILTERS)
+        self.attrs = read_attrs(CONFIG, template='trajectory')
+
+        self.netcdf_path = os.path.join(self.tmpdir, 'netcdf')
+        self.merge_path = os.path.join(self.tmpdir, 'merge')
+        create_netcdf(self.attrs, self.processed, self.merge_path, self.mode, subset=False)
+
+    def teardown(self, profiles):
+        shutil.rmtree(self.tmpdir)
+
+    def create(self):
+        # Profile ids are epochs, so every run writes the same files
+        create_netcdf(self.attrs, self.processed, self.netcdf_path, self.mode, subset=False)
+
+    def time_create_netcdf(self, profiles):
+        self.create()
+
+    def track_create_netcdf_memory(self, profiles):
+        return peak_memory(self.create)
+    track_create_netcdf_memory.unit = 'MB'
+
+    def merge(self):
+        merge_profile_netcdf_files(self.merge_path, os.path.join(self.tmpdir, 'merged.nc'))
+
+    def time_merge_profile_netcdf_files(self, profiles):
+        self.merge()
+
+    def track_merge_profile_netcdf_files_memory(self, profiles):
+        return peak_memory(self.merge)
+    track_merge_profile_netcdf_files_memory.unit = 'MB'
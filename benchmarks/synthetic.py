@@ -0,0 +1,203 @@
+#!python
+# coding=utf-8
+""" Deterministic synthetic Slocum deployments for the benchmarks.
+
+Writes merged ASCII files in the same format `dba_merge` produces: the dbd_label
+header, a sensor, unit and byte size line and one space separated row per cycle. The
+glider does yos between the surface and `max_depth`, surfacing for a GPS fix every
+`yos_per_surfacing` yos, and the science sensors only report on some of the rows like
+they do in real files.
+"""
+import os
+import argparse
+
+import numpy as np
+
+FLIGHT_SENSORS = [
+    # name, units, bytes
+    ('m_present_time', 'timestamp', 8),
+    ('m_depth', 'm', 4),
+    ('m_gps_lat', 'lat', 8),
+    ('m_gps_lon', 'lon', 8),
+    ('m_lat', 'lat', 8),
+    ('m_lon', 'lon', 8),
+    ('m_pitch', 'rad', 4),
+    ('m_water_vx', 'm/s', 4),
+    ('m_water_vy', 'm/s', 4),
+]
+
+SCIENCE_SENSORS = [
+    ('sci_m_present_time', 'timestamp', 8),
+    ('sci_water_pressure', 'bar', 4),
+    ('sci_water_temp', 'degc', 4),
+    ('sci_water_cond', 's/m', 4),
+]
+
+START = 1473499376.0  # 2016-09-10T09:22:56Z
+
+
+def nmea(decimal_degrees):
+    """ Decimal degrees to the NMEA (DDDmm.mmmm) format of the glider """
+    degrees = np.trunc(decimal_degrees)
+    return degrees * 100 + (decimal_degrees - degrees) * 60
+
+
+def yo_depths(rows, profiles, max_depth, yos_per_surfacing, dt):
+    """ Depths of a glider doing `profiles` dives and climbs over `rows` rows, and a mask
+    of the rows at the surface
+    """
+    profiles = max(int(profiles), 1)
+    phase = np.linspace(0, profiles, rows, endpoint=False)
+    # Triangle wave, 0 at the surface and 1 at the bottom of each yo
+    wave = 1 - np.abs((phase % 2) - 1)
+    depth = 0.5 + wave * (max_depth - 0.5)
+
+    # Stay at the surface for a couple of minutes every few yos
+    yo = np.floor(phase / 2).astype(int)
+    first_of_yo = np.r_[True, np.diff(yo) != 0]
+    surfacings = first_of_yo & (yo % max(yos_per_surfacing, 1) == 0)
+    surface = np.zeros(rows, dtype=bool)
+    for start in np.flatnonzero(surfacings):
+        surface[start:start + int(120 / dt)] = True
+    depth[surface] = 0
+    return depth, surface
+
+
+def synthetic_slocum_data(rows=10000, profiles=20, sensors=0, max_depth=100.,
+                          yos_per_surfacing=4, dt=4., science_every=2, seed=0):
+    """ Returns the (names, units, sizes, values) of a synthetic deployment. `sensors` is
+    the number of extra science sensors on top of the ones GUTILS uses.
+    """
+    rng = np.random.RandomState(seed)
+
+    t = START + np.arange(rows) * dt
+    depth, surface = yo_depths(rows, profiles, max_depth, yos_per_surfacing, dt)
+
+    # Drift north east at about 0.25 m/s
+    lat = 27.5 + np.arange(rows) * dt * 0.25 / 111000.
+    lon = -80.2 + np.arange(rows) * dt * 0.25 / 111000.
+
+    temperature = 28.5 - 0.12 * depth + rng.normal(0, 0.02, rows)
+    conductivity = 5.6 - 0.006 * depth + rng.normal(0, 0.001, rows)
+    pressure = depth / 10. + rng.normal(0, 0.002, rows)
+    pitch = np.where(np.gradient(depth) >= 0, -0.45, 0.45)
+
+    nan = np.full(rows, np.nan)
+    gps_lat = nan.copy()
+    gps_lon = nan.copy()
+    gps_lat[surface] = nmea(lat[surface])
+    gps_lon[surface] = nmea(lon[surface])
+
+    # Depth averaged currents are reported once per surfacing
+    water_vx = nan.copy()
+    water_vy = nan.copy()
+    reported = np.flatnonzero(surface & ~np.r_[False, surface[:-1]])
+    water_vx[reported] = rng.normal(0.05, 0.02, len(reported))
+    water_vy[reported] = rng.normal(-0.05, 0.02, len(reported))
+
+    # The flight computer decimates m_depth
+    m_depth = depth.copy()
+    m_depth[1::3] = np.nan
+
+    # The science computer only reports on some of the rows
+    science = np.zeros(rows, dtype=bool)
+    science[::max(int(science_every), 1)] = True
+
+    def sci(values):
+        return np.where(science, values, np.nan)
+
+    columns = [
+        t,
+        m_depth,
+        gps_lat,
+        gps_lon,
+        nmea(lat),
+        nmea(lon),
+        pitch,
+        water_vx,
+        water_vy,
+        sci(t),
+        sci(pressure),
+        sci(temperature),
+        sci(conductivity),
+    ]
+    names = FLIGHT_SENSORS + SCIENCE_SENSORS
+
+    for i in range(sensors):
+        names.append(('sci_synthetic_{}'.format(i), 'nodim', 4))
+        columns.append(sci(rng.normal(i, 1, rows)))
+
+    return (
+        [ n for n, _, _ in names ],
+        [ u for _, u, _ in names ],
+        [ s for _, _, s in names ],
+        np.column_stack(columns)
+    )
+
+
+def write_slocum_ascii(path, rows=10000, profiles=20, sensors=0, seed=0, **kwargs):
+    """ Writes a synthetic merged Slocum ASCII file to `path` """
+    names, units, sizes, values = synthetic_slocum_data(
+        rows=rows,
+        profiles=profiles,
+        sensors=sensors,
+        seed=seed,
+        **kwargs
+    )
+
+    # usf_bass_2016_252_1_0_sbd.dat -> usf-bass-2016-252-1-0
+    segment = os.path.splitext(os.path.basename(path))[0]
+    if segment.endswith('_sbd'):
+        segment = segment[:-len('_sbd')]
+    segment = segment.replace('_', '-')
+    header = [
+        ('dbd_label', 'DBD_ASC(dinkum_binary_data_ascii)file'),
+        ('encoding_ver', '2'),
+        ('num_ascii_tags', '14'),
+        ('all_sensors', '0'),
+        ('filename', segment),
+        ('the8x3_filename', '00000000'),
+        ('filename_extension', 'sbd'),
+        ('filename_label', '{}-sbd(00000000)'.format(segment)),
+        ('mission_name', 'SYNTHETIC.MI'),
+        ('fileopen_time', 'Sat_Sep_10_09:22:56_2016'),
+        ('sensors_per_cycle', str(len(names))),
+        ('num_label_lines', '3'),
+        ('num_segments', '1'),
+        ('segment_filename_0', segment),
+    ]
+
+    with open(path, 'wt') as f:
+        for k, v in header:
+            f.write('{}: {}\n'.format(k, v))
+        f.write(' '.join(names) + ' \n')
+        f.write(' '.join(units) + ' \n')
+        f.write(' '.join(str(s) for s in sizes) + ' \n')
+        np.savetxt(f, values, fmt='%.10g', delimiter=' ')
+
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Write a synthetic merged Slocum ASCII file'
+    )
+    parser.add_argument('path', help='File to write')
+    parser.add_argument('-r', '--rows', type=int, default=10000)
+    parser.add_argument('-p', '--profiles', type=int, default=20)
+    parser.add_argument('-s', '--sensors', type=int, default=0,
+                        help='Number of extra science sensors')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    write_slocum_ascii(
+        args.path,
+        rows=args.rows,
+        profiles=args.profiles,
+        sensors=args.sensors,
+        seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+    main()
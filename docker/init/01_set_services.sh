@@ -21,3 +21,8 @@ if [ ! -z "$RUN_NETCDF_TO_ERDDAP_WATCH" ]; then
     mkdir -p /etc/service/gutils_netcdf_to_erddap_watch
     cp $PROJECT_ROOT/docker/gutils_netcdf_to_erddap_watch /etc/service/gutils_netcdf_to_erddap_watch/run
 fi
+
+if [ ! -z "$RUN_PIPELINE_WATCH" ]; then
+    mkdir -p /etc/service/gutils_pipeline_watch
+    cp $PROJECT_ROOT/docker/gutils_pipeline_watch /etc/service/gutils_pipeline_watch/run
+fi
@@ -3,15 +3,13 @@
 from __future__ import division  # always return floats when dividing
 
 import os
+import re
 import math
 import errno
 import subprocess
 from collections import namedtuple
 
-import numpy as np
-import pandas as pd
 from six import StringIO
-from scipy.signal import boxcar, convolve
 
 import logging
 L = logging.getLogger(__name__)
@@ -20,6 +18,7 @@ __version__ = "2.7.0"
 
 
 def boxcar_smooth_dataset(dataset, window_size):
+    from scipy.signal import boxcar, convolve
     window = boxcar(window_size)
     return convolve(dataset, window, 'same') / window_size
 
@@ -32,6 +31,7 @@ def validate_glider_args(*args):
     * Checks for netCDF4 fill types and changes them to NaNs
     * Tests for finite values in time and depth arrays
     """
+    import numpy as np
 
     arg_length = len(args[0])
 
@@ -93,6 +93,8 @@ def get_decimal_degrees(lat_lon):
 
 
 def masked_epoch(timeseries):
+    import numpy as np
+    import pandas as pd
     tmask = pd.isnull(timeseries)
     epochs = np.ma.MaskedArray(timeseries.astype(np.int64) // 1e9)
     epochs.mask = tmask
@@ -106,6 +108,7 @@ def interpolate_gps(timestamps, latitude, longitude):
         'dataset': An N by 3 numpy array of time, lat, lon pairs
     Returns interpolated gps dataset over entire time domain of dataset
     """
+    import numpy as np
 
     validate_glider_args(timestamps, latitude, longitude)
 
@@ -168,7 +171,36 @@ def generate_stream(processArgs):
     return StringIO(stdout), process.returncode
 
 
+def stream_process(processArgs):
+    """ Runs a given process and yields each line of output as soon as it is printed
+
+    Parameters
+    ----------
+    processArgs : list
+        Arguments to run in a process
+
+    Yields
+    ------
+    str
+        Each line of text, without the trailing newline
+    """
+    process = subprocess.Popen(
+        processArgs,
+        universal_newlines=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1
+    )
+    try:
+        for line in iter(process.stdout.readline, ''):
+            yield line.rstrip('\n')
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
 def get_uv_data(profile):
+    import numpy as np
     # Find and return t, x and y from the second row where U and V are not null
     t = np.nan
     x = np.nan
@@ -198,6 +230,8 @@ PROFILE_MINIMUM = 2
 
 def get_profile_data(profile, method=None):
     # Find and return profile t, x and y from the data based on the method
+    import numpy as np
+    import pandas as pd
     if method is None:
         method = PROFILE_MEAN
 
@@ -231,6 +265,30 @@ def get_profile_data(profile, method=None):
     return tuv(t=t, x=x, y=y)
 
 
+# Names of the profile detection algorithms in gutils.yo.DETECTORS
+PROFILE_DETECTORS = ['interpolated', 'native']
+
+
+def add_detector_argument(parser):
+    parser.add_argument(
+        '--detector',
+        help="How profiles are found: 'interpolated' looks for the inflections of the depths "
+             "interpolated onto a grid every tsint seconds, 'native' for the inflections of "
+             "the depth samples themselves, which is faster for long deployments.",
+        choices=PROFILE_DETECTORS,
+        default=os.environ.get('GUTILS_PROFILE_DETECTOR', 'interpolated')
+    )
+    return parser
+
+
+def natural_sort_key(path):
+    """ Sorts the numbers in file names by value: usf_bass_2016_252_1_2 before usf_bass_2016_252_1_10 """
+    return [
+        int(part) if part.isdigit() else part
+        for part in re.split(r'(\d+)', os.path.basename(path))
+    ] + [path]
+
+
 def safe_makedirs(folder):
     try:
         os.makedirs(folder)
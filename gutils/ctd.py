@@ -1,6 +1,9 @@
 #!/usr/bin/env python
+import os
 import warnings
 
+import numpy as np
+
 from gutils import (
     validate_glider_args,
 )
@@ -9,6 +12,41 @@ from gsw.gibbs.practical_salinity import SP_from_C
 from gsw.gibbs.conversions import SA_from_SP, CT_from_t
 from gsw.gibbs.density_enthalpy_48 import rho
 
+# Rows per chunk when gsw runs on more than one thread (GUTILS_GSW_THREADS)
+DEFAULT_CHUNK_SIZE = 250000
+
+
+def practical_salinity(conductivity, temperature, pressure):
+    # Convert S/m to mS/cm
+    mS_conductivity = conductivity * 10
+
+    return SP_from_C(
+        mS_conductivity,
+        temperature,
+        pressure
+    )
+
+
+def density(temperature, pressure, salinity, latitude, longitude):
+    absolute_salinity = SA_from_SP(
+        salinity,
+        pressure,
+        longitude,
+        latitude
+    )
+
+    conservative_temperature = CT_from_t(
+        absolute_salinity,
+        temperature,
+        pressure
+    )
+
+    return rho(
+        absolute_salinity,
+        conservative_temperature,
+        pressure
+    )
+
 
 def calculate_practical_salinity(time, conductivity, temperature, pressure):
     """Calculates practical salinity given glider conductivity, temperature,
@@ -23,16 +61,9 @@ def calculate_practical_salinity(time, conductivity, temperature, pressure):
 
     validate_glider_args(time, conductivity, temperature, pressure)
 
-    # Convert S/m to mS/cm
-    mS_conductivity = conductivity * 10
-
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        return SP_from_C(
-            mS_conductivity,
-            temperature,
-            pressure
-        )
+        return practical_salinity(conductivity, temperature, pressure)
 
 
 def calculate_density(time, temperature, pressure, salinity, latitude, longitude):
@@ -50,26 +81,67 @@ def calculate_density(time, temperature, pressure, salinity, latitude, longitude
 
     validate_glider_args(time, temperature, pressure, salinity, latitude, longitude)
 
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        return density(temperature, pressure, salinity, latitude, longitude)
+
+
+def compacted(func, arrays, threads=None, chunk_size=None):
+    """Runs the gsw `func` over only the rows where all of `arrays` are finite and
+    returns its results at those rows, NaN everywhere else. Merged glider data is
+    sparse, so this skips most of the rows.
+
+    With more than one of `threads` (default: GUTILS_GSW_THREADS, 1) the rows are
+    split into chunks of `chunk_size` (default: GUTILS_GSW_CHUNK_SIZE) that run on a
+    pool of threads.
+
+    Raises the same errors as validate_glider_args for fewer than two rows or an
+    array without any finite values.
+    """
+    arrays = [ np.asarray(a, dtype='float64') for a in arrays ]
+    length = len(arrays[0])
+    if length < 2:
+        raise IndexError('The time series must have at least two values')
+
+    rows = None
+    for a in arrays:
+        if len(a) != length:
+            raise ValueError('Arguments must all be the same length')
+        finite = np.isfinite(a)
+        if not finite.any():
+            raise ValueError('Data array has no finite values')
+        rows = finite if rows is None else rows & finite
+    rows = np.flatnonzero(rows)
+
+    result = np.full(length, np.nan)
+    if rows.size == 0:
+        return result
+    compact = [ a[rows] for a in arrays ]
+
+    if threads is None:
+        threads = int(os.environ.get('GUTILS_GSW_THREADS', 1))
+    if chunk_size is None:
+        chunk_size = int(os.environ.get('GUTILS_GSW_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    chunk_size = max(int(chunk_size), 1)
+
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
 
-        absolute_salinity = SA_from_SP(
-            salinity,
-            pressure,
-            longitude,
-            latitude
-        )
-
-        conservative_temperature = CT_from_t(
-            absolute_salinity,
-            temperature,
-            pressure
-        )
-
-        density = rho(
-            absolute_salinity,
-            conservative_temperature,
-            pressure
-        )
-
-        return density
+        if threads > 1 and rows.size > chunk_size:
+            from multiprocessing.pool import ThreadPool
+
+            starts = range(0, rows.size, chunk_size)
+            pool = ThreadPool(min(threads, len(starts)))
+            try:
+                chunks = pool.map(
+                    lambda s: func(*[ c[s:s + chunk_size] for c in compact ]),
+                    starts
+                )
+            finally:
+                pool.close()
+                pool.join()
+            result[rows] = np.concatenate(chunks)
+        else:
+            result[rows] = func(*compact)
+
+    return result
@@ -0,0 +1,631 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import threading
+from copy import deepcopy
+from datetime import datetime
+from collections import OrderedDict
+
+import numpy as np
+import netCDF4 as nc4
+from lxml import etree
+from jinja2 import Environment, PackageLoader, select_autoescape
+
+from gutils import safe_makedirs
+from gutils.ledger import iter_files
+
+import logging
+L = logging.getLogger(__name__)
+
+
+def lxml_elements_equal(e1, e2):
+    if e1.tag != e2.tag:
+        return False
+    if e1.text != e2.text:
+        return False
+    if e1.tail != e2.tail:
+        return False
+    if e1.attrib != e2.attrib:
+        return False
+    if len(e1) != len(e2):
+        return False
+
+    return all(lxml_elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+
+
+datatype_mapping = {
+    str: 'String',
+    np.dtype('U'): 'String',
+    np.dtype('int8'): 'byte',
+    np.dtype('int32'): 'int',
+    np.dtype('float32'): 'float',
+    np.dtype('float64'): 'double',
+}
+
+
+destination_mapping = {
+    'profile_lat': 'latitude',
+    'profile_lon': 'longitude',
+    'profile_time': 'time',
+    'time': 'precise_time',
+    'lat': 'precise_lat',
+    'lon': 'precise_lon',
+    'platform': 'meta_platform',
+    'crs': 'meta_crs',
+}
+
+
+_erddap_jinja_environment = None
+_erddap_jinja_lock = threading.Lock()
+
+
+def erddap_jinja_environment():
+    """ The jinja environment for the ERDDAP templates. Shared so each template is only
+    compiled once, and again only when the template file changes on disk.
+    """
+    global _erddap_jinja_environment
+    with _erddap_jinja_lock:
+        if _erddap_jinja_environment is None:
+            loader = PackageLoader('gutils', 'templates')
+            _erddap_jinja_environment = Environment(
+                loader=loader,
+                autoescape=select_autoescape(['html', 'xml']),
+                auto_reload=True
+            )
+        return _erddap_jinja_environment
+
+
+def read_datasets_xml(datasets_path, jenv=None):
+    """ Parses datasets.xml, or the base template if it doesn't exist yet """
+    if os.path.isfile(datasets_path):
+        return etree.parse(datasets_path).getroot()
+
+    jenv = jenv or erddap_jinja_environment()
+    datasets_template_string = jenv.get_template('erddap_datasets.xml').render()
+    return etree.fromstring(datasets_template_string)
+
+
+def write_datasets_xml(xmltree, datasets_path):
+    """ Atomically replaces datasets.xml with the serialized `xmltree` """
+    datasets_folder = os.path.dirname(datasets_path) or '.'
+    # Create tempfile for the new modified file next to the old one so it can be renamed over it
+    new_datasets_handle, new_datasets_path = tempfile.mkstemp(
+        prefix='.gutils_erddap_',
+        suffix='.xml',
+        dir=datasets_folder
+    )
+    try:
+        with os.fdopen(new_datasets_handle, 'wt') as f:
+            f.write(etree.tostring(
+                xmltree,
+                encoding='ISO-8859-1',
+                pretty_print=True,
+                xml_declaration=True
+            ).decode('iso-8859-1'))
+            f.write('\n')
+
+        # Replace old datasets.xml
+        os.chmod(new_datasets_path, 0o664)
+        os.rename(new_datasets_path, datasets_path)
+    finally:
+        if os.path.exists(new_datasets_path):
+            os.remove(new_datasets_path)
+
+
+def write_erddap_flag(flag_path, deployment_name):
+    """ Write dataset update flag if it doesn't exist """
+    if flag_path is None:
+        return
+
+    final_flagfile = os.path.join(flag_path, deployment_name)
+    if os.path.isfile(final_flagfile):
+        return
+
+    flag_tmp_handle, flag_tmp_path = tempfile.mkstemp(prefix='gutils_errdap_', suffix='.flag')
+    try:
+        with os.fdopen(flag_tmp_handle, 'w') as ff:
+            ff.write(datetime.utcnow().isoformat())
+        os.chmod(flag_tmp_path, 0o666)
+        shutil.move(flag_tmp_path, final_flagfile)
+    finally:
+        if os.path.exists(flag_tmp_path):
+            os.remove(flag_tmp_path)
+
+
+def deployment_signature(deployment_directory, variables):
+    """ Everything about a deployment's netCDF variables that goes into its ERDDAP
+    dataset node: the names, dtypes and whether they have an ioos_category
+    """
+    return (
+        deployment_directory,
+        tuple(
+            (name, str(v.dtype), 'ioos_category' in v.ncattrs())
+            for name, v in variables.items()
+        )
+    )
+
+
+def render_deployment_template(deployment_directory, variables, jenv=None):
+    jenv = jenv or erddap_jinja_environment()
+    xmlstring = jenv.get_template('erddap_deployment.xml').render(
+        deployment_name=os.path.basename(deployment_directory),
+        deployment_directory=deployment_directory,
+        deployment_variables=variables,
+        datatype_mapping=datatype_mapping,
+        destination_mapping=destination_mapping
+    )
+    return etree.fromstring(xmlstring)
+
+
+def render_deployment_xml(netcdf_path, jenv=None):
+    """ Returns the deployment name and the ERDDAP dataset node for the deployment
+    folder `netcdf_path` is in
+    """
+    deployment_directory = os.path.dirname(netcdf_path)
+    with nc4.Dataset(netcdf_path) as ncd:
+        node = render_deployment_template(deployment_directory, ncd.variables, jenv)
+    return os.path.basename(deployment_directory), node
+
+
+def merge_deployment_node(old_node, deployment_xml_node):
+    """ Returns the node to replace a deployment's existing dataset node with, or None
+    if the existing node is already identical
+    """
+    if lxml_elements_equal(old_node, deployment_xml_node):
+        L.debug("Not replacing identical deployment XML node")
+        return None
+
+    # Now make sure we don't remove any variables since some could be
+    # missing from this file but present in others
+    new_vars = [ d.findtext('sourceName') for d in deployment_xml_node.iter('dataVariable') ]
+    # iterate over the old_vars and figure out which ones
+    # are not in the new_vars
+    for dv in old_node.iter('dataVariable'):
+        vname = dv.findtext('sourceName')
+        if vname not in new_vars:
+            # Append the old variable block into the new one
+            L.debug('Carried over variable {}'.format(vname))
+            deployment_xml_node.append(deepcopy(dv))
+
+    if lxml_elements_equal(old_node, deployment_xml_node):
+        L.debug("Not replacing identical deployment XML node")
+        return None
+
+    return deployment_xml_node
+
+
+def update_datasets_tree(xmltree, deployment_name, deployment_xml_node):
+    """ Adds or replaces the dataset node for a deployment in the parsed datasets.xml.
+    Returns False if the tree already had an identical node.
+    """
+    find_dataset = etree.XPath("//erddapDatasets/dataset[@datasetID=$name]")
+
+    # Find an existing datasetID within the datasets.xml file
+    dnode = find_dataset(xmltree, name=deployment_name)
+    if not dnode:
+        # No datasetID found, create a new one
+        xmltree.append(deployment_xml_node)
+        L.debug("Added Deployment: {}".format(deployment_name))
+        return True
+
+    deployment_xml_node = merge_deployment_node(dnode[0], deployment_xml_node)
+    if deployment_xml_node is None:
+        return False
+
+    # Update the existing datasetID with a new XML block
+    xmltree.replace(dnode[0], deployment_xml_node)
+    L.debug("Replaced Deployment: {}".format(deployment_name))
+    return True
+
+
+def netcdf_to_erddap_dataset(datasets_path, netcdf_path, flag_path):
+    jenv = erddap_jinja_environment()
+    deployment_name = os.path.basename(os.path.dirname(netcdf_path))
+    try:
+        xmltree = read_datasets_xml(datasets_path, jenv)
+        deployment_name, deployment_xml_node = render_deployment_xml(netcdf_path, jenv)
+        if update_datasets_tree(xmltree, deployment_name, deployment_xml_node) or \
+                not os.path.isfile(datasets_path):
+            write_datasets_xml(xmltree, datasets_path)
+    finally:
+        write_erddap_flag(flag_path, deployment_name)
+
+
+def atomic_write(path, chunks, mode=0o664):
+    """ Writes the byte strings or file paths in `chunks` to a temporary file next to
+    `path` and renames it over `path`
+    """
+    handle, tmp_path = tempfile.mkstemp(
+        prefix='.gutils_erddap_',
+        suffix='.xml',
+        dir=os.path.dirname(path) or '.'
+    )
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            for c in chunks:
+                if isinstance(c, bytes):
+                    f.write(c)
+                else:
+                    with open(c, 'rb') as src:
+                        shutil.copyfileobj(src, f)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def serialize_fragment(node):
+    return etree.tostring(
+        node,
+        encoding='ISO-8859-1',
+        pretty_print=True,
+        xml_declaration=False
+    )
+
+
+class DatasetsXml(object):
+    """ An ERDDAP datasets.xml assembled from one XML fragment per deployment.
+
+    Each deployment's dataset node is kept in its own file in `fragments_path` (by
+    default a `datasets.d` folder next to datasets.xml) and updates to different
+    deployments can run at the same time. datasets.xml is rebuilt from the fragments by
+    concatenating them, without parsing, at most once every `debounce` seconds (right
+    away when `debounce` is 0). ERDDAP flags for the updated deployments are written
+    after datasets.xml.
+
+    If datasets.xml was changed by something else since it was last written it is split
+    back into fragments, and any pending updates re-applied, before it is rebuilt.
+
+    Only the deployments GUTILS writes have a fragment. Everything else in datasets.xml,
+    including datasets added by an operator or another tool, is kept in the head. A dataset
+    in the head is moved into a fragment the first time GUTILS updates its deployment.
+    """
+
+    HEAD = '.head.xml'
+    STAMP = '.assembled'
+
+    def __init__(self, datasets_path, flag_path=None, debounce=0, fragments_path=None):
+        self.datasets_path = datasets_path
+        self.flag_path = flag_path
+        self.debounce = debounce
+        self.fragments_path = fragments_path or os.path.join(
+            os.path.dirname(datasets_path),
+            'datasets.d'
+        )
+
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.mtime = None
+        self.dirty = False
+        # Parsed fragments, by deployment name
+        self.nodes = {}
+        # Deployment nodes changed since the last write, by deployment name
+        self.pending = OrderedDict()
+        self.flags = set()
+        self.timer = None
+        # Variable signature of the last file seen for each deployment
+        self.signatures = {}
+
+    def current_mtime(self):
+        try:
+            return os.path.getmtime(self.datasets_path)
+        except OSError:
+            return None
+
+    def fragment_path(self, deployment_name):
+        return os.path.join(self.fragments_path, '{}.xml'.format(deployment_name))
+
+    def fragments(self):
+        return sorted(
+            os.path.join(self.fragments_path, f) for f in os.listdir(self.fragments_path)
+            if f.endswith('.xml') and not f.startswith('.')
+        )
+
+    def owned(self):
+        """ The names of the deployments with a fragment """
+        return set(os.path.splitext(os.path.basename(f))[0] for f in self.fragments())
+
+    def read_stamp(self):
+        try:
+            with open(os.path.join(self.fragments_path, self.STAMP)) as f:
+                return float(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def write_stamp(self):
+        with open(os.path.join(self.fragments_path, self.STAMP), 'w') as f:
+            f.write(repr(self.mtime))
+
+    def load(self):
+        """ Makes sure the fragments exist, splitting datasets.xml into them when there
+        are none yet or when it was changed since they were last assembled
+        """
+        safe_makedirs(self.fragments_path)
+        self.mtime = self.current_mtime()
+        self.nodes = {}
+        self.signatures = {}
+
+        if self.mtime is not None and (not self.fragments() or self.mtime != self.read_stamp()):
+            self.split(read_datasets_xml(self.datasets_path))
+        else:
+            if not os.path.isfile(os.path.join(self.fragments_path, self.HEAD)):
+                self.write_head(read_datasets_xml(self.datasets_path), self.owned())
+            if self.mtime is None and self.fragments():
+                # datasets.xml was removed, put it back
+                self.dirty = True
+
+        self.loaded = True
+
+    def write_head(self, xmltree, owned):
+        """ Keeps everything in datasets.xml that isn't the dataset node of a deployment
+        in `owned`
+        """
+        atomic_write(os.path.join(self.fragments_path, self.HEAD), [
+            serialize_fragment(child) for child in xmltree
+            if child.tag != 'dataset' or child.get('datasetID') not in owned
+        ])
+
+    def read_head(self):
+        with open(os.path.join(self.fragments_path, self.HEAD), 'rb') as f:
+            return etree.fromstring(
+                b"<?xml version='1.0' encoding='ISO-8859-1'?>\n<erddapDatasets>\n" +
+                f.read() +
+                b"</erddapDatasets>\n",
+                # The fragments are pretty printed again when the head is written
+                etree.XMLParser(remove_blank_text=True)
+            )
+
+    def head_node(self, deployment_name):
+        """ The dataset node of a deployment that is still in the head, or None """
+        found = self.read_head().xpath("dataset[@datasetID=$name]", name=deployment_name)
+        return found[0] if found else None
+
+    def adopt(self, deployment_name):
+        """ Removes a deployment that now has a fragment from the head """
+        with self.lock:
+            head = self.read_head()
+            for child in head.xpath("dataset[@datasetID=$name]", name=deployment_name):
+                head.remove(child)
+            self.write_head(head, ())
+
+    def split(self, xmltree):
+        """ Writes the dataset node of each deployment with a fragment in a parsed
+        datasets.xml to its fragment and removes the fragments of deployments that are
+        no longer in it. Every other node is kept in the head.
+        """
+        owned = self.owned()
+        keep = set()
+        for child in xmltree:
+            name = child.get('datasetID') if child.tag == 'dataset' else None
+            if name in owned:
+                atomic_write(self.fragment_path(name), [serialize_fragment(child)])
+                keep.add(self.fragment_path(name))
+
+        self.write_head(xmltree, owned)
+        for f in self.fragments():
+            if f not in keep:
+                os.remove(f)
+        L.debug("Split {} into {} fragments".format(self.datasets_path, len(keep)))
+
+    def reload_if_changed(self):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            elif self.current_mtime() != self.mtime:
+                L.info("{} was changed outside of GUTILS, reloading".format(self.datasets_path))
+                self.load()
+                for name, node in self.pending.items():
+                    self.merge(name, deepcopy(node))
+
+    def node(self, deployment_name):
+        """ The current dataset node of a deployment, or None """
+        if deployment_name not in self.nodes:
+            fragment = self.fragment_path(deployment_name)
+            if not os.path.isfile(fragment):
+                return None
+            self.nodes[deployment_name] = etree.parse(fragment).getroot()
+        return self.nodes[deployment_name]
+
+    def merge(self, deployment_name, deployment_xml_node):
+        """ Merges a newly rendered node into the deployment's fragment. Returns the
+        node that was written, or None if the fragment did not change.
+        """
+        old_node = self.node(deployment_name)
+        in_head = False
+        if old_node is None:
+            # The deployment may still be in the head from before it had a fragment
+            old_node = self.head_node(deployment_name)
+            in_head = old_node is not None
+
+        if old_node is None:
+            L.debug("Added Deployment: {}".format(deployment_name))
+        else:
+            merged = merge_deployment_node(old_node, deployment_xml_node)
+            if merged is None and not in_head:
+                return None
+            deployment_xml_node = merged if merged is not None else old_node
+            L.debug("Replaced Deployment: {}".format(deployment_name))
+
+        self.write_fragment(deployment_name, deployment_xml_node, in_head)
+        return deployment_xml_node
+
+    def write_fragment(self, deployment_name, deployment_xml_node, in_head=None):
+        fragment = self.fragment_path(deployment_name)
+        if in_head is None:
+            # A deployment with a fragment is never in the head
+            in_head = not os.path.isfile(fragment) and self.head_node(deployment_name) is not None
+
+        atomic_write(fragment, [serialize_fragment(deployment_xml_node)])
+        self.nodes[deployment_name] = deployment_xml_node
+        if in_head:
+            self.adopt(deployment_name)
+
+    def forget_signatures(self):
+        with self.lock:
+            self.signatures = {}
+
+    def unchanged(self, deployment_name, signature):
+        """ True, and flags the deployment, if the last file seen for the deployment had
+        the same variable signature so its node can't have changed
+        """
+        with self.lock:
+            self.reload_if_changed()
+            if self.signatures.get(deployment_name) != signature:
+                return False
+            self.flags.add(deployment_name)
+        self.schedule()
+        return True
+
+    def update(self, deployment_name, deployment_xml_node, signature=None):
+        # The fragment is written under the same lock flush splits and assembles them
+        # under, rendering the node is what runs in parallel
+        with self.lock:
+            self.reload_if_changed()
+            node = self.merge(deployment_name, deployment_xml_node)
+            if node is not None:
+                self.pending[deployment_name] = node
+                self.dirty = True
+            if signature is not None:
+                self.signatures[deployment_name] = signature
+            self.flags.add(deployment_name)
+        self.schedule()
+
+    def schedule(self):
+        if not self.debounce:
+            self.flush()
+            return
+
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.debounce, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def assemble(self):
+        """ Concatenates the fragments into datasets.xml """
+        chunks = [
+            b"<?xml version='1.0' encoding='ISO-8859-1'?>\n<erddapDatasets>\n",
+            os.path.join(self.fragments_path, self.HEAD)
+        ]
+        chunks += self.fragments()
+        chunks.append(b"</erddapDatasets>\n")
+
+        atomic_write(self.datasets_path, chunks)
+        self.mtime = self.current_mtime()
+        self.write_stamp()
+        L.debug("Assembled {}".format(self.datasets_path))
+
+    def rebuild(self, nodes, merge=True, prune=False):
+        """ Writes the fragments of many deployments and datasets.xml once. With `merge`
+        variables missing from the new nodes are carried over from the existing ones and
+        with `prune` deployments with a fragment that aren't in `nodes` are removed.
+        Datasets without a fragment are never pruned.
+        """
+        with self.lock:
+            self.reload_if_changed()
+            for deployment_name, deployment_xml_node in nodes.items():
+                if merge:
+                    self.merge(deployment_name, deployment_xml_node)
+                else:
+                    self.write_fragment(deployment_name, deployment_xml_node)
+                self.flags.add(deployment_name)
+
+            if prune:
+                keep = set(self.fragment_path(n) for n in nodes)
+                for f in self.fragments():
+                    if f not in keep:
+                        L.info("Removing deployment {}".format(f))
+                        os.remove(f)
+                self.nodes = { n: v for n, v in self.nodes.items() if n in nodes }
+
+            self.signatures = {}
+            self.dirty = True
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            if self.dirty:
+                self.reload_if_changed()
+                self.assemble()
+                self.dirty = False
+                self.pending.clear()
+
+            for deployment_name in self.flags:
+                write_erddap_flag(self.flag_path, deployment_name)
+            self.flags.clear()
+
+
+class VariableHeader(object):
+    """ The parts of a netCDF variable the deployment template uses, so a variable can
+    be rendered after its file is closed
+    """
+
+    def __init__(self, dtype, attributes):
+        self.dtype = dtype
+        self.attributes = list(attributes)
+
+    def ncattrs(self):
+        return self.attributes
+
+
+def find_deployments(data_path):
+    """ Returns {deployment_directory: [netCDF files]} for every folder below `data_path`
+    with netCDF files in it
+    """
+    deployments = {}
+    for path, name, _ in iter_files(data_path):
+        _, ext = os.path.splitext(name)
+        if ext in ['.nc', '.nc4']:
+            deployments.setdefault(os.path.dirname(path), []).append(path)
+    return { d: sorted(fs) for d, fs in deployments.items() }
+
+
+def render_deployment_headers(args):
+    """ Renders the dataset node of a deployment from the headers of `netcdf_files`,
+    using the union of their variables. Returns the deployment name and the XML string.
+    """
+    deployment_directory, netcdf_files = args
+    variables = OrderedDict()
+    for netcdf_file in netcdf_files:
+        with nc4.Dataset(netcdf_file) as ncd:
+            for name, v in ncd.variables.items():
+                if name not in variables:
+                    variables[name] = VariableHeader(v.dtype, v.ncattrs())
+
+    node = render_deployment_template(deployment_directory, variables)
+    return os.path.basename(deployment_directory), etree.tostring(node)
+
+
+def rebuild_datasets_xml(data_path, datasets_path, flag_path=None, workers=None, union=False, prune=False):
+    """ Renders the dataset node of every deployment below `data_path` and writes
+    datasets.xml, and the flags, once. Only the last file of each deployment is read
+    unless `union` is set, then every file is read for the union of their variables.
+    """
+    from multiprocessing import Pool
+
+    deployments = find_deployments(data_path)
+    jobs = [
+        (d, fs if union else fs[-1:]) for d, fs in sorted(deployments.items())
+    ]
+
+    pool = Pool(workers)
+    try:
+        rendered = pool.map(render_deployment_headers, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    nodes = OrderedDict(
+        (name, etree.fromstring(xmlstring)) for name, xmlstring in rendered
+    )
+    datasets = DatasetsXml(datasets_path, flag_path=flag_path)
+    # A union already has every variable, otherwise keep the ones seen before
+    datasets.rebuild(nodes, merge=not union, prune=prune)
+    return list(nodes.keys())
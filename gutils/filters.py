@@ -1,8 +1,10 @@
 #!python
 # coding=utf-8
 import pandas as pd
+from six import string_types
 
-from gutils.yo import assign_profiles
+from gutils.timing import annotate, file_timings, stage
+from gutils.yo import get_detector
 from gutils.profile_adjust import reassign_profile_id
 import logging
 L = logging.getLogger(__name__)
@@ -96,15 +98,47 @@ def filter_profile_number_of_points(dataset, points_condition=None, reindex=True
     return filter_profiles(dataset, conditional, reindex=reindex)
 
 
-def process_dataset(file, reader_class, tsint=None, filter_z=None, filter_points=None, filter_time=None, filter_distance=None):
+def dataset_name(file):
+    """ The path of an ASCII file, or the segment name of an already read dataset """
+    if isinstance(file, string_types):
+        return file
+    metadata = getattr(file, 'metadata', None) or {}
+    return metadata.get('filename_label') or metadata.get('filename') or repr(file)
+
+
+def process_dataset(file, reader_class, tsint=None, filter_z=None, filter_points=None, filter_time=None, filter_distance=None,
+                    profile_state=None, gps_index=None, detector=None):
+    """ With a `profile_state` (gutils.profile_state.ProfileState) the glider's open profile
+    is continued from its previous segment and only completed profiles are returned. With a
+    `gps_index` (gutils.gps.GpsFixIndex) positions are interpolated between the GPS fixes
+    of the whole deployment. `detector` is the name of the profile detection algorithm in
+    gutils.yo.DETECTORS, 'interpolated' by default.
+    """
 
     # Check filename
     if file is None:
         raise ValueError('Must specify path to combined ASCII file')
 
+    with file_timings(dataset_name(file)):
+        return _process_dataset(file, reader_class, tsint, filter_z, filter_points, filter_time, filter_distance,
+                                profile_state, gps_index, detector)
+
+
+def _process_dataset(file, reader_class, tsint, filter_z, filter_points, filter_time, filter_distance,
+                     profile_state, gps_index, detector):
     try:
-        reader = reader_class(file)
-        data = reader.standardize()
+        if isinstance(file, reader_class):
+            # Already read, ie. piped straight from the binary converter
+            reader = file
+        else:
+            with stage('read'):
+                reader = reader_class(file)
+        with stage('standardize'):
+            if gps_index is not None:
+                data = reader.standardize(gps_index=gps_index)
+            else:
+                data = reader.standardize()
+        annotate(rows=len(data), columns=len(data.columns))
 
         if 'z' not in data.columns:
             L.warning("No Z axis found - Skipping {}".format(file))
@@ -115,19 +149,26 @@ def process_dataset(file, reader_class, tsint=None, filter_z=None, filter_points
             return None, None
 
         # Find profile breaks
-        profiles = assign_profiles(data, tsint=tsint)
-        profiles = reassign_profile_id(profiles)
+        if profile_state is not None:
+            profiles = profile_state.detect(data, tsint=tsint, detector=detector)
+        else:
+            with stage('assign_profiles'):
+                profiles = get_detector(detector)(data, tsint=tsint)
+            with stage('reassign_profile_id'):
+                profiles = reassign_profile_id(profiles)
         # Shortcut for empty dataframes
         if profiles is None:
             return None, None
 
         # Filter data
-        original_profiles = len(profiles.profile.unique())
-        filtered, rm_depth    = filter_profile_depth(profiles, below=filter_z, reindex=False)
-        filtered, rm_points   = filter_profile_number_of_points(filtered, points_condition=filter_points, reindex=False)
-        filtered, rm_time     = filter_profile_timeperiod(filtered, timespan_condition=filter_time, reindex=False)
-        filtered, rm_distance = filter_profile_distance(filtered, distance_condition=filter_distance, reindex=True)
-        total_filtered = rm_depth + rm_points + rm_time + rm_distance
+        with stage('filter'):
+            original_profiles = len(profiles.profile.unique())
+            filtered, rm_depth    = filter_profile_depth(profiles, below=filter_z, reindex=False)
+            filtered, rm_points   = filter_profile_number_of_points(filtered, points_condition=filter_points, reindex=False)
+            filtered, rm_time     = filter_profile_timeperiod(filtered, timespan_condition=filter_time, reindex=False)
+            filtered, rm_distance = filter_profile_distance(filtered, distance_condition=filter_distance, reindex=True)
+            total_filtered = rm_depth + rm_points + rm_time + rm_distance
+        annotate(profiles=original_profiles - total_filtered, filtered_profiles=total_filtered)
         L.info(
             (
                 'Filtered {}/{} profiles from {}'.format(total_filtered, original_profiles, file),
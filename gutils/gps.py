@@ -0,0 +1,155 @@
+#!python
+# coding=utf-8
+""" Deployment-wide index of GPS fixes.
+
+A segment only holds the GPS fixes of the surfacings inside of it, so a segment recorded
+mid-dive has no fix to interpolate its positions between. A `GpsFixIndex` keeps every
+valid fix seen in a deployment as sorted time, latitude and longitude arrays in an
+`.npz` file, so each segment is interpolated against the fixes of the whole deployment
+without reading the neighbouring segments again.
+"""
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from gutils import safe_makedirs
+
+import logging
+L = logging.getLogger(__name__)
+
+# Guards the indexes updated by more than one thread, by path
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def index_lock(path):
+    with _locks_lock:
+        return _locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+class GpsFixIndex(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = index_lock(path)
+        self.load()
+
+    def __len__(self):
+        return self.t.size
+
+    def stat(self):
+        """ Identifies the version of the index file, None if there is no file """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        # Saving replaces the file, so the inode changes too
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def load(self):
+        self.t = np.empty(0)
+        self.lat = np.empty(0)
+        self.lon = np.empty(0)
+        self.version = self.stat()
+        if self.version is None:
+            return
+
+        try:
+            with np.load(self.path) as fixes:
+                self.t, self.lat, self.lon = fixes['t'], fixes['lat'], fixes['lon']
+        except (IOError, OSError, ValueError, KeyError) as e:
+            L.warning("Could not read the GPS fixes in {}, starting over: {}".format(self.path, e))
+
+    def refresh(self):
+        """ Loads the index again if another instance saved it since it was loaded """
+        if self.stat() != self.version:
+            self.load()
+
+    def save(self):
+        safe_makedirs(os.path.dirname(self.path))
+        handle, tmp_path = tempfile.mkstemp(
+            prefix='.gutils_gps_',
+            suffix='.npz',
+            dir=os.path.dirname(self.path)
+        )
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, t=self.t, lat=self.lat, lon=self.lon)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.version = self.stat()
+
+    def add(self, timestamps, latitude, longitude):
+        """ Adds the valid fixes to the index and returns how many were new. A fix at the
+        same time as one already in the index replaces it.
+        """
+        t = np.asarray(timestamps, dtype='float64')
+        lat = np.asarray(latitude, dtype='float64')
+        lon = np.asarray(longitude, dtype='float64')
+        valid = np.isfinite(t) & np.isfinite(lat) & np.isfinite(lon)
+        if not valid.any():
+            return 0
+
+        # Sorted by time, keeping the first of the new fixes at each time
+        t, first = np.unique(t[valid], return_index=True)
+        lat = lat[valid][first]
+        lon = lon[valid][first]
+
+        with self.lock:
+            # Pick up the fixes another instance added since this one was loaded
+            self.refresh()
+
+            # Only the new fixes are merged into the sorted index
+            at = np.searchsorted(self.t, t)
+            known = at < self.t.size
+            known[known] = self.t[at[known]] == t[known]
+
+            replaced = at[known]
+            changed = (
+                not np.array_equal(self.lat[replaced], lat[known]) or
+                not np.array_equal(self.lon[replaced], lon[known])
+            )
+            if changed:
+                self.lat[replaced] = lat[known]
+                self.lon[replaced] = lon[known]
+
+            new = ~known
+            if new.any():
+                self.t = np.insert(self.t, at[new], t[new])
+                self.lat = np.insert(self.lat, at[new], lat[new])
+                self.lon = np.insert(self.lon, at[new], lon[new])
+                changed = True
+
+            if changed:
+                self.save()
+            return int(new.sum())
+
+    def interpolate(self, timestamps):
+        """ Latitude and longitude at each of `timestamps`, interpolated between the fixes
+        and held at the first and last fixes outside of them. NaN without any fixes.
+        """
+        t = np.asarray(timestamps, dtype='float64')
+        est_lat = np.full(t.size, np.nan)
+        est_lon = np.full(t.size, np.nan)
+
+        if self.t.size == 0:
+            L.warning('GPS index contains no valid GPS fixes for interpolation')
+            return est_lat, est_lon
+
+        valid = np.isfinite(t)
+        est_lat[valid] = np.interp(t[valid], self.t, self.lat)
+        est_lon[valid] = np.interp(t[valid], self.t, self.lon)
+        return est_lat, est_lon
+
+
+def deployment_gps_index(state_path, deployment):
+    """ Returns the GpsFixIndex of `deployment` inside of `state_path`, or None if no
+    state path was configured.
+    """
+    if not state_path:
+        return None
+    return GpsFixIndex(os.path.join(state_path, 'gps', '{}.npz'.format(deployment)))
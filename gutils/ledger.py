@@ -0,0 +1,132 @@
+#!python
+# coding=utf-8
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from gutils import safe_makedirs
+
+import logging
+L = logging.getLogger(__name__)
+
+
+def iter_files(root):
+    """ Recursively yields (path, name, stat) for each file below `root`. Uses os.scandir
+    where available so directory entries are not stat'ed twice.
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        for dirpath, _, files in os.walk(root):
+            for f in files:
+                p = os.path.join(dirpath, f)
+                yield p, f, os.stat(p)
+        return
+
+    folders = [root]
+    while folders:
+        folder = folders.pop()
+        try:
+            entries = list(scandir(folder))
+        except OSError as e:
+            L.warning("Could not scan {}: {}".format(folder, e))
+            continue
+
+        for entry in entries:
+            if entry.is_dir():
+                folders.append(entry.path)
+            elif entry.is_file():
+                yield entry.path, entry.name, entry.stat()
+
+
+class Ledger(object):
+    """ Persistent record of the files a watch processed, stored in a SQLite database.
+
+    Each row records the path, size and mtime of the file when it was processed along
+    with the result ('processed' or 'failed') and the list of files it produced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            safe_makedirs(os.path.dirname(path))
+
+        self.lock = threading.Lock()
+        # Notifier threads use the connection too
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS processed ('
+                '  path TEXT PRIMARY KEY,'
+                '  size INTEGER,'
+                '  mtime REAL,'
+                '  result TEXT,'
+                '  outputs TEXT,'
+                '  recorded REAL'
+                ')'
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def record(self, path, result, outputs=None):
+        try:
+            st = os.stat(path)
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, None
+
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?, ?, ?)',
+                (path, size, mtime, result, json.dumps(outputs or []), time.time())
+            )
+
+    def get(self, path):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, mtime, result, outputs FROM processed WHERE path = ?',
+                (path,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {
+            'size': row[0],
+            'mtime': row[1],
+            'result': row[2],
+            'outputs': json.loads(row[3]),
+        }
+
+    def scan(self, root, valid=None):
+        """ Returns the files below `root` that are missing from the ledger, were not
+        processed successfully or have a different size or mtime than when they were recorded.
+        """
+        with self.lock:
+            known = {
+                p: (s, m) for p, s, m in
+                self.conn.execute(
+                    'SELECT path, size, mtime FROM processed WHERE result = ?',
+                    ('processed',)
+                )
+            }
+
+        pending = []
+        for path, name, st in iter_files(root):
+            if valid is not None and not valid(name):
+                continue
+            if known.get(path) != (st.st_size, st.st_mtime):
+                pending.append(path)
+        return pending
+
+
+def stage_ledger(state_path, stage):
+    """ Returns the Ledger for a watch stage inside of `state_path`, or None if
+    no state path was configured.
+    """
+    if not state_path:
+        return None
+    return Ledger(os.path.join(state_path, '{}.sqlite'.format(stage)))
@@ -8,24 +8,24 @@ import json
 import math
 import shutil
 import argparse
+import hashlib
 import calendar
 import tempfile
 from glob import glob
+from copy import deepcopy
 from datetime import datetime
-from collections import OrderedDict
-
-import netCDF4 as nc4
-from compliance_checker.runner import ComplianceChecker, CheckSuite
-from pocean.utils import dict_update, get_fill_value
-from pocean.meta import MetaInterface
-from pocean.dsg import (
-    IncompleteMultidimensionalTrajectory,
-    ContiguousRaggedTrajectoryProfile
+from collections import OrderedDict, namedtuple
+
+from gutils import (
+    add_detector_argument,
+    get_uv_data,
+    get_profile_data,
+    natural_sort_key,
+    safe_makedirs,
+    setup_cli_logger
 )
-
-from gutils import get_uv_data, get_profile_data, safe_makedirs, setup_cli_logger
-from gutils.filters import process_dataset
-from gutils.slocum import SlocumReader
+from gutils.profiling import add_profile_arguments, configure_profiling, profiled
+from gutils.timing import defer, file_timings, stage
 
 import logging
 L = logging.getLogger(__name__)
@@ -40,6 +40,8 @@ class ProfileIdTypes(object):
 
 
 def read_attrs(config_path=None, template=None):
+    from pocean.utils import dict_update
+    from pocean.meta import MetaInterface
 
     def cfg_file(name):
         return os.path.join(
@@ -82,6 +84,8 @@ def read_attrs(config_path=None, template=None):
 
 
 def set_scalar_value(value, ncvar):
+    from pocean.utils import get_fill_value
+
     if value is None or math.isnan(value):
         ncvar[:] = get_fill_value(ncvar)
     else:
@@ -89,6 +93,8 @@ def set_scalar_value(value, ncvar):
 
 
 def set_profile_data(ncd, profile_txy, profile_index):
+    import netCDF4 as nc4
+
     prof_t = ncd.variables['profile_time']
     prof_y = ncd.variables['profile_lat']
     prof_x = ncd.variables['profile_lon']
@@ -110,6 +116,8 @@ def set_profile_data(ncd, profile_txy, profile_index):
 
 
 def set_uv_data(ncd, uv_txy):
+    import netCDF4 as nc4
+
     # The uv index should be the second row where v (originally m_water_vx) is not null
     uv_t = ncd.variables['time_uv']
     uv_x = ncd.variables['lon_uv']
@@ -183,6 +191,10 @@ def get_temporal_attributes(profile):
     }
 
 
+# Global attributes that change every time a file is written
+CREATION_ATTRIBUTES = ['date_created', 'date_issued', 'date_modified', 'history']
+
+
 def get_creation_attributes(profile):
     nc_create_ts = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
     return {
@@ -198,7 +210,45 @@ def get_creation_attributes(profile):
     }
 
 
+def content_digest(path):
+    """ MD5 hex digest of the dimensions, variables and attributes of a netCDF file. The
+    CREATION_ATTRIBUTES are left out so a regenerated file with the same data has the
+    same digest.
+    """
+    import numpy as np
+    import netCDF4 as nc4
+
+    md5 = hashlib.md5()
+
+    def update(*values):
+        for v in values:
+            if isinstance(v, np.ndarray):
+                v = v.tolist()
+            md5.update(repr(v).encode('utf-8'))
+
+    with nc4.Dataset(path) as ncd:
+        ncd.set_auto_maskandscale(False)
+        for name in sorted(ncd.ncattrs()):
+            if name not in CREATION_ATTRIBUTES:
+                update(name, ncd.getncattr(name))
+        for name, dim in sorted(ncd.dimensions.items()):
+            update(name, len(dim))
+        for name, var in sorted(ncd.variables.items()):
+            update(name, str(var.dtype), var.dimensions)
+            for attr in sorted(var.ncattrs()):
+                update(attr, var.getncattr(attr))
+            data = np.asarray(var[:])
+            if data.dtype.kind == 'O':
+                update(data)
+            else:
+                md5.update(np.ascontiguousarray(data).tobytes())
+    return md5.hexdigest()
+
+
 def create_profile_netcdf(attrs, profile, output_path, mode, profile_id_type=ProfileIdTypes.EPOCH):
+    from pocean.utils import dict_update
+    from pocean.dsg import IncompleteMultidimensionalTrajectory
+
     try:
         # Path to hold file while we create it
         tmp_handle, tmp_path = tempfile.mkstemp(suffix='.nc', prefix='gutils_glider_netcdf_')
@@ -355,11 +405,10 @@ def create_netcdf(attrs, data, output_path, mode, profile_id_type=ProfileIdTypes
         )
         data = data.drop(orphans, axis=1)
 
-    written = []
     for pi, profile in data.groupby('profile'):
         try:
             cr = create_profile_netcdf(attrs, profile, output_path, mode, profile_id_type)
-            written.append(cr)
+            written_files.append(cr)
         except BaseException:
             L.exception('Error creating netCDF for profile {}. Skipping.'.format(pi))
             continue
@@ -369,13 +418,16 @@ def create_netcdf(attrs, data, output_path, mode, profile_id_type=ProfileIdTypes
 
 def create_arg_parser():
     parser = argparse.ArgumentParser(
-        description='Parses a single combined ASCII file into a set of '
-                    'NetCDFs file according to JSON configurations '
+        description='Parses combined ASCII files into a set of '
+                    'NetCDF files according to JSON configurations '
                     'for institution, deployment, glider, and datatypes.'
     )
     parser.add_argument(
-        'file',
-        help="Combined ASCII file to process into NetCDF"
+        'files',
+        nargs='+',
+        help="Combined ASCII files to process into NetCDF. Directories are searched for "
+             "ASCII files and glob patterns are expanded. Files are processed in the order "
+             "of the glider segment numbers in their names."
     )
     parser.add_argument(
         'config_path',
@@ -417,6 +469,7 @@ def create_arg_parser():
         help="Filter out profiles that are not completely below this depth (meters)",
         default=1
     )
+    add_detector_argument(parser)
     parser.add_argument(
         '--no-subset',
         dest='subset',
@@ -429,21 +482,171 @@ def create_arg_parser():
         help="The template to use when writing netCDF files. Options: None, [filepath], trajectory, ioos_ngdac",
         default='trajectory'
     )
+    parser.add_argument(
+        "-p",
+        "--profile_id_type",
+        help="The profile type to use when writing netCDF files. 1 == EPOCH, 2 == COUNT, 3 == FRAME",
+        default=os.environ.get('GUTILS_PROFILE_ID_TYPE', 1),
+        type=int
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of files to process at the same time. Defaults to the number of CPUs.",
+        default=None,
+        type=int
+    )
     parser.set_defaults(subset=True)
+    add_profile_arguments(parser)
 
     return parser
 
 
-def create_dataset(file, reader_class, config_path, output_path, subset, template, profile_id_type, **filters):
+def create_dataset(file, reader_class, config_path, output_path, subset, template, profile_id_type,
+                   profile_state=None, gps_index=None, **filters):
+    from gutils.filters import dataset_name, process_dataset
+
+    with file_timings(dataset_name(file)):
+        processed_df, mode = process_dataset(
+            file, reader_class, profile_state=profile_state, gps_index=gps_index, **filters
+        )
 
-    processed_df, mode = process_dataset(file, reader_class, **filters)
+        if processed_df is None:
+            return 1
+
+        with stage('read_attrs'):
+            attrs = read_attrs(config_path, template=template)
+
+        with stage('create_netcdf'):
+            return create_netcdf(attrs, processed_df, output_path, mode, profile_id_type, subset=subset)
+
+
+ASCII_EXTENSIONS = ['.dat']
+
+
+def find_ascii_files(paths, extensions=None):
+    """ Expands files, directories and glob patterns into a list of files without
+    duplicates, sorted by the numbers in their names so glider segments are in order
+    """
+    extensions = extensions or ASCII_EXTENSIONS
+
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                _, ext = os.path.splitext(name)
+                if ext.lower() in extensions:
+                    found.add(os.path.join(path, name))
+        elif os.path.isfile(path):
+            found.add(path)
+        else:
+            matches = [ m for m in glob(path) if os.path.isfile(m) ]
+            if not matches:
+                L.warning("No files found at {}".format(path))
+            found.update(matches)
+
+    return sorted(found, key=natural_sort_key)
 
-    if processed_df is None:
-        return 1
 
-    attrs = read_attrs(config_path, template=template)
+BatchResult = namedtuple('BatchResult', ['file', 'written', 'error', 'dataset'])
 
-    return create_netcdf(attrs, processed_df, output_path, mode, profile_id_type, subset=subset)
+# Set in each batch worker process by `init_batch_worker`
+_batch = None
+
+
+def init_batch_worker(reader_class, config_path, output_path, subset, template, profile_id_type,
+                      filters, level=None):
+    """ Reads the templates and configs once per worker process instead of once per file """
+    global _batch
+
+    if level is not None:
+        setup_cli_logger(level)
+
+    _batch = dict(
+        reader_class=reader_class,
+        attrs=read_attrs(config_path, template=template),
+        output_path=output_path,
+        subset=subset,
+        profile_id_type=profile_id_type,
+        filters=filters
+    )
+
+
+def process_batch_file(file):
+    """ Creates the netCDF files of one ASCII file in a batch worker.
+
+    COUNT profile ids depend on how many files were written before, so with
+    ProfileIdTypes.COUNT the processed data is returned for the parent to write in order.
+    """
+    from gutils.filters import process_dataset
+
+    try:
+        with profiled(file), file_timings(file):
+            processed_df, mode = process_dataset(file, _batch['reader_class'], **_batch['filters'])
+            if processed_df is None:
+                return BatchResult(file, [], None, None)
+
+            if _batch['profile_id_type'] == ProfileIdTypes.COUNT:
+                # The parent adds the writing of the files to the timings and reports them
+                return BatchResult(file, [], None, (processed_df, mode, defer()))
+
+            with stage('create_netcdf'):
+                written = create_netcdf(
+                    deepcopy(_batch['attrs']),
+                    processed_df,
+                    _batch['output_path'],
+                    mode,
+                    _batch['profile_id_type'],
+                    subset=_batch['subset']
+                )
+        return BatchResult(file, written, None, None)
+    except Exception as e:
+        L.exception('Error processing {}'.format(file))
+        return BatchResult(file, [], str(e), None)
+
+
+def create_datasets(files, reader_class, config_path, output_path, subset, template,
+                    profile_id_type, workers=None, **filters):
+    """ Creates the netCDF files of many ASCII files using a pool of `workers` processes.
+    Yields a BatchResult for each file, in the order of `files`.
+    """
+    from multiprocessing import Pool, cpu_count
+
+    workers = min(workers or cpu_count(), len(files)) or 1
+    initargs = (reader_class, config_path, output_path, subset, template, profile_id_type, filters)
+
+    if workers == 1:
+        pool = None
+        init_batch_worker(*initargs)
+        results = (process_batch_file(f) for f in files)
+    else:
+        level = logging.getLogger().getEffectiveLevel()
+        pool = Pool(workers, initializer=init_batch_worker, initargs=initargs + (level,))
+        # imap hands back results in the order of `files`, whichever worker finishes first
+        results = pool.imap(process_batch_file, files)
+
+    try:
+        attrs = read_attrs(config_path, template=template)
+        for result in results:
+            if result.dataset is not None:
+                # ProfileIdTypes.COUNT, written here one file at a time so the ids follow
+                # the order of the files
+                processed_df, mode, timings = result.dataset
+                with file_timings(result.file, timings), stage('create_netcdf'):
+                    written = create_netcdf(
+                        deepcopy(attrs),
+                        processed_df,
+                        output_path,
+                        mode,
+                        profile_id_type,
+                        subset=subset
+                    )
+                result = BatchResult(result.file, written, None, None)
+            yield result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
 
 def main_create():
@@ -451,34 +654,64 @@ def main_create():
 
     parser = create_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
 
     filter_args = vars(args)
     # Remove non-filter args into positional arguments
-    file = filter_args.pop('file')
+    files = find_ascii_files(filter_args.pop('files'))
     config_path = filter_args.pop('config_path')
     output_path = filter_args.pop('output_path')
     subset = filter_args.pop('subset')
     template = filter_args.pop('template')
+    profile_id_type = int(filter_args.pop('profile_id_type'))
+    workers = filter_args.pop('workers')
+    filter_args.pop('profile')
+    filter_args.pop('profile_keep')
+    filter_args.pop('profile_memory')
 
     # Move reader_class to a class
     reader_class = filter_args.pop('reader_class')
     if reader_class == 'slocum':
+        from gutils.slocum import SlocumReader
         reader_class = SlocumReader
 
-    return create_dataset(
-        file=file,
+    if not files:
+        L.error("No ASCII files to process")
+        return 1
+
+    failed = 0
+    written = 0
+    results = create_datasets(
+        files=files,
         reader_class=reader_class,
         config_path=config_path,
         output_path=output_path,
         subset=subset,
         template=template,
+        profile_id_type=profile_id_type,
+        workers=workers,
         **filter_args
     )
+    for i, result in enumerate(results, 1):
+        if result.error is not None:
+            failed += 1
+            L.error("[{}/{}] {}: {}".format(i, len(files), result.file, result.error))
+        else:
+            written += len(result.written)
+            L.info("[{}/{}] {}: {} netCDF files".format(
+                i, len(files), result.file, len(result.written)
+            ))
+
+    L.info("Processed {} files into {} netCDF files, {} failed".format(len(files), written, failed))
+    # Also fails when nothing could be processed, like a single file without profiles
+    return 1 if failed or not written else 0
 
 
 # CHECKER
 
 def check_dataset(args):
+    from compliance_checker.runner import ComplianceChecker, CheckSuite
+
     check_suite = CheckSuite()
     check_suite.load_all_available_checkers()
 
@@ -538,6 +771,7 @@ def check_arg_parser():
         'file',
         help='Path to Glider NetCDF file.'
     )
+    add_profile_arguments(parser)
     return parser
 
 
@@ -546,17 +780,23 @@ def main_check():
 
     parser = check_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
 
     # Check filenames
     if args.file is None:
         raise ValueError('Must specify path to NetCDF file')
 
-    return check_dataset(args)
+    with profiled(args.file):
+        return check_dataset(args)
 
 
 def merge_profile_netcdf_files(folder, output):
     import pandas as pd
     from glob import glob
+    from pocean.dsg import (
+        IncompleteMultidimensionalTrajectory,
+        ContiguousRaggedTrajectoryProfile
+    )
 
     new_fp, new_path = tempfile.mkstemp(suffix='.nc', prefix='gutils_merge_')
 
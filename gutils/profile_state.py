@@ -0,0 +1,156 @@
+#!python
+# coding=utf-8
+""" Profile detection that carries over between the segment files of a glider.
+
+In real-time each segment is processed on its own, so a yo that spans two segments is
+split into two truncated profiles that the filters usually drop. A `ProfileState` keeps
+the rows of the profile a glider was still in when its last segment ended. They are
+joined on to the start of the next segment and the profile is only emitted once it is
+complete, so earlier segments are never processed again and no profile is emitted twice.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from gutils import safe_makedirs
+from gutils.timing import annotate, stage
+from gutils.yo import get_detector
+from gutils.profile_adjust import reassign_profile_id
+
+import logging
+L = logging.getLogger(__name__)
+
+# Segments starting more than this many seconds after the open profile do not continue it
+DEFAULT_MAX_GAP = 3600
+# A segment ending shallower than this (meters) ended its last profile at the surface
+DEFAULT_SURFACE_DEPTH = 2
+
+
+class ProfileState(object):
+
+    def __init__(self, path, max_gap=DEFAULT_MAX_GAP, surface_depth=DEFAULT_SURFACE_DEPTH):
+        self.path = path
+        self.max_gap = max_gap
+        self.surface_depth = surface_depth
+        self.tail = self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            return pd.read_pickle(self.path)
+        except Exception as e:
+            L.warning("Could not read the open profile from {}, starting over: {}".format(
+                self.path, e
+            ))
+            return None
+
+    def save(self, tail):
+        self.tail = tail
+        if tail is None or tail.empty:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+            return
+
+        safe_makedirs(os.path.dirname(self.path))
+        handle, tmp_path = tempfile.mkstemp(
+            prefix='.gutils_profile_',
+            suffix='.pkl',
+            dir=os.path.dirname(self.path)
+        )
+        os.close(handle)
+        try:
+            tail.to_pickle(tmp_path)
+            os.rename(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def detect(self, data, tsint=None, detector=None):
+        """ Assigns profiles to the open profile joined with the `data` of a new segment.
+
+        Returns the rows of the completed profiles and keeps the rows of the last profile,
+        unless the segment ended at the surface, for the next segment.
+        """
+        tail = self.tail
+        if tail is not None and not tail.empty:
+            start = data.t.min()
+            end = tail.t.max()
+            if pd.isnull(start) or start <= end:
+                # An older segment, or one processed again, can't continue the open profile
+                L.warning("Data does not follow the open profile ending at {}, "
+                          "assigning profiles without it".format(end))
+                return find_profiles(data, tsint, detector)
+            if (start - end).total_seconds() > self.max_gap:
+                L.info("Closing the open profile ending at {}, the next data starts at {}".format(
+                    end, start
+                ))
+                parts = [tail, data]
+            else:
+                parts = [pd.concat([tail, data], ignore_index=True, sort=False)]
+        else:
+            parts = [data]
+
+        profiles = concat_profiles([ find_profiles(p, tsint, detector) for p in parts ])
+        if profiles is None:
+            # Not enough depths to find a profile in, wait for more data
+            self.save(pd.concat(parts, ignore_index=True, sort=False))
+            annotate(open_profile_rows=len(self.tail))
+            return None
+
+        depths = profiles.z.dropna()
+        last_profile = profiles.profile.max()
+        if not depths.empty and depths.iloc[-1] < self.surface_depth:
+            # Ended at the surface, the last profile is complete
+            self.save(None)
+            annotate(open_profile_rows=0)
+            return profiles
+
+        if pd.isnull(last_profile):
+            open_rows = np.ones(len(profiles), dtype=bool)
+        else:
+            first_open = np.argmax(profiles.profile.values == last_profile)
+            open_rows = np.arange(len(profiles)) >= first_open
+
+        self.save(profiles.loc[open_rows].drop(columns='profile').reset_index(drop=True))
+        annotate(open_profile_rows=len(self.tail))
+
+        completed = profiles.loc[~open_rows]
+        if completed.profile.isnull().all():
+            return None
+        return completed
+
+
+def find_profiles(data, tsint=None, detector=None):
+    with stage('assign_profiles'):
+        profiles = get_detector(detector)(data.reset_index(drop=True), tsint=tsint)
+    with stage('reassign_profile_id'):
+        return reassign_profile_id(profiles)
+
+
+def concat_profiles(parts):
+    """ Joins the profiles found in separate parts of the data, numbering them in order """
+    parts = [ p for p in parts if p is not None ]
+    if not parts:
+        return None
+
+    offset = 0
+    numbered = []
+    for p in parts:
+        p = p.copy()
+        p['profile'] = p.profile + offset
+        if p.profile.notnull().any():
+            offset = p.profile.max() + 1
+        numbered.append(p)
+    return pd.concat(numbered, ignore_index=True, sort=False)
+
+
+def glider_profile_state(state_path, glider):
+    """ Returns the ProfileState of `glider` inside of `state_path`, or None if no
+    state path was configured.
+    """
+    if not state_path:
+        return None
+    return ProfileState(os.path.join(state_path, 'profiles', '{}.pkl'.format(glider)))
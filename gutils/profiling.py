@@ -0,0 +1,181 @@
+#!python
+# coding=utf-8
+""" Opt-in cProfile (and tracemalloc) captures of each file processed by the console scripts.
+
+Run any of the console scripts with `--profile <folder>`, or set GUTILS_PROFILE, and a
+cProfile of every processed file or watch event is written to that folder as
+`<utc time>-<pid>-<file name>.prof`, readable with `python -m pstats` or snakeviz. With
+`--profile_memory` (GUTILS_PROFILE_MEMORY) a tracemalloc snapshot of the memory allocated
+while processing the file is written next to it as `.tracemalloc`. Only the newest
+`--profile_keep` (GUTILS_PROFILE_KEEP) captures of each kind are kept.
+"""
+import os
+import re
+import threading
+from glob import glob
+from datetime import datetime
+from contextlib import contextmanager
+
+from gutils import safe_makedirs
+from gutils.timing import env_flag
+
+import logging
+L = logging.getLogger(__name__)
+
+DEFAULT_KEEP = 100
+
+_local = threading.local()
+_unset = object()
+_profiler = _unset
+
+
+class Profiler(object):
+
+    def __init__(self, directory, keep=DEFAULT_KEEP, memory=False):
+        self.directory = directory
+        self.keep = max(int(keep), 1)
+        self.memory = memory
+        self.lock = threading.Lock()
+        safe_makedirs(self.directory)
+
+        if self.memory is True:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def path(self, name, extension):
+        name = re.sub(r'[^\w.-]+', '_', os.path.basename(str(name)))
+        return os.path.join(
+            self.directory,
+            '{}-{}-{}{}'.format(
+                datetime.utcnow().strftime('%Y%m%dT%H%M%S.%f'),
+                os.getpid(),
+                name,
+                extension
+            )
+        )
+
+    @contextmanager
+    def profile(self, name):
+        """ Profiles the block and writes the captures when it is done, even if it failed.
+        Blocks inside another profiled block on the same thread are part of the outer capture.
+        """
+        import cProfile
+
+        if getattr(_local, 'active', False):
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another thread is being profiled and the interpreter only allows one profiler
+            L.debug("Not profiling {}: {}".format(name, e))
+            yield
+            return
+
+        if self.memory is True:
+            import tracemalloc
+            tracemalloc.clear_traces()
+
+        _local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            _local.active = False
+            self.write(name, profile)
+
+    def write(self, name, profile):
+        try:
+            prof_path = self.path(name, '.prof')
+            profile.dump_stats(prof_path)
+            L.debug("Wrote profile of {} to {}".format(name, prof_path))
+
+            if self.memory is True:
+                import tracemalloc
+                tracemalloc.take_snapshot().dump(self.path(name, '.tracemalloc'))
+
+            with self.lock:
+                self.rotate('.prof')
+                if self.memory is True:
+                    self.rotate('.tracemalloc')
+        except (IOError, OSError) as e:
+            L.warning("Could not write the profile of {}: {}".format(name, e))
+
+    def rotate(self, extension):
+        captures = sorted(
+            glob(os.path.join(self.directory, '*' + extension)),
+            key=lambda p: (os.path.getmtime(p), p)
+        )
+        for p in captures[:-self.keep]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+
+def add_profile_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        help="Folder to write a cProfile of each processed file or event to",
+        default=os.environ.get('GUTILS_PROFILE')
+    )
+    parser.add_argument(
+        "--profile_keep",
+        help="Number of profiles to keep in the --profile folder, older ones are removed",
+        type=int,
+        default=int(os.environ.get('GUTILS_PROFILE_KEEP', DEFAULT_KEEP))
+    )
+    parser.add_argument(
+        "--profile_memory",
+        help="Also write a tracemalloc snapshot of each processed file or event",
+        action='store_true',
+        default=env_flag('GUTILS_PROFILE_MEMORY', False)
+    )
+    return parser
+
+
+def configure_profiling(args):
+    """ Sets up profiling from the `add_profile_arguments` arguments. The settings are also
+    exported to the environment so worker processes profile their files too.
+    """
+    global _profiler
+
+    if not args.profile:
+        _profiler = None
+        return None
+
+    os.environ['GUTILS_PROFILE'] = args.profile
+    os.environ['GUTILS_PROFILE_KEEP'] = str(args.profile_keep)
+    os.environ['GUTILS_PROFILE_MEMORY'] = '1' if args.profile_memory else '0'
+    _profiler = Profiler(args.profile, keep=args.profile_keep, memory=args.profile_memory)
+    L.info("Writing profiles to {}".format(args.profile))
+    return _profiler
+
+
+def get_profiler():
+    global _profiler
+
+    if _profiler is _unset:
+        directory = os.environ.get('GUTILS_PROFILE')
+        _profiler = None
+        if directory:
+            _profiler = Profiler(
+                directory,
+                keep=int(os.environ.get('GUTILS_PROFILE_KEEP', DEFAULT_KEEP)),
+                memory=env_flag('GUTILS_PROFILE_MEMORY', False)
+            )
+    return _profiler
+
+
+@contextmanager
+def profiled(name):
+    """ Profiles the block as `name` when profiling is turned on """
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+    else:
+        with profiler.profile(name):
+            yield
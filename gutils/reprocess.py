@@ -0,0 +1,391 @@
+#!python
+# coding=utf-8
+import os
+import sys
+import argparse
+from collections import namedtuple
+
+from gutils import add_detector_argument, natural_sort_key, setup_cli_logger
+from gutils.ledger import stage_ledger
+from gutils.nc import ProfileIdTypes
+
+import logging
+L = logging.getLogger(__name__)
+
+
+def completed(ledger, path):
+    """ True if `path` was processed successfully, hasn't changed since and the files it
+    produced still exist
+    """
+    entry = ledger.get(path)
+    if entry is None or entry['result'] != 'processed':
+        return False
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+
+    if (entry['size'], entry['mtime']) != (st.st_size, st.st_mtime):
+        return False
+
+    return all(os.path.isfile(o) for o in entry['outputs'])
+
+
+def check_file(path):
+    """ Runs the compliance checks on one netCDF file, in a worker process """
+    from gutils.nc import check_dataset
+
+    args = namedtuple('Check_Arguments', ['file'])
+    return path, check_dataset(args(file=path))
+
+
+class DeploymentReprocessor(object):
+    """ Runs every stage over all of the binary files of a deployment: binary merge,
+    netCDF creation, compliance checks and optionally merging the profiles into one file.
+
+    Each stage keeps a checkpoint ledger in `state_path`: the binary files of every
+    converted segment, every ASCII file turned into netCDF files and every netCDF file
+    that passed the checks. Running it again after a crash or failure only processes the
+    segments that did not complete, or that changed since.
+    """
+
+    def __init__(self, binary_path, ascii_path, netcdf_path, config_path, state_path,
+                 workers=None, subset=True, template='trajectory',
+                 profile_id_type=ProfileIdTypes.EPOCH, check=True, merged_output=None,
+                 **filters):
+        self.binary_path = os.path.abspath(binary_path)
+        self.ascii_path = os.path.abspath(ascii_path)
+        self.netcdf_path = os.path.abspath(netcdf_path)
+        self.config_path = os.path.abspath(config_path)
+        self.workers = workers
+        self.subset = subset
+        self.template = template
+        self.profile_id_type = profile_id_type
+        self.check = check
+        self.merged_output = os.path.abspath(merged_output) if merged_output else None
+        self.filters = filters
+
+        self.binary_ledger = stage_ledger(state_path, 'reprocess_binary')
+        self.ascii_ledger = stage_ledger(state_path, 'reprocess_ascii')
+        self.check_ledger = stage_ledger(state_path, 'reprocess_check')
+        self.merge_ledger = stage_ledger(state_path, 'reprocess_merge')
+
+        self.failed = 0
+
+    def close(self):
+        for ledger in [self.binary_ledger, self.ascii_ledger, self.check_ledger, self.merge_ledger]:
+            ledger.close()
+
+    def convert(self):
+        """ Merges the binary files of the segments without a checkpoint into ASCII files.
+        Returns the ASCII files of every converted segment, in segment order.
+        """
+        from gutils.slocum import ALL_EXTENSIONS, FLIGHT_SCIENCE_PAIRS, SlocumMerger
+
+        segments = []
+        for s in SlocumMerger(self.binary_path, self.ascii_path).segments():
+            extensions = [ os.path.splitext(f)[1].lower() for f in s ]
+            if not any(e in FLIGHT_SCIENCE_PAIRS for e in extensions):
+                # Can't be converted without the flight data
+                L.debug("No flight file found in {}, skipping".format(s))
+                continue
+            segments.append([
+                f for f, e in zip(s, extensions) if e in ALL_EXTENSIONS
+            ])
+        pending = [ s for s in segments if not all(completed(self.binary_ledger, f) for f in s) ]
+        L.info("Converting {} of {} segments".format(len(pending), len(segments)))
+
+        if pending:
+            merger = SlocumMerger(
+                self.binary_path,
+                self.ascii_path,
+                globs=[ os.path.basename(f) for s in pending for f in s ],
+                workers=self.workers
+            )
+            # Recorded as each segment finishes so a crash keeps the segments done so far
+            for p in merger.iter_convert():
+                for f in p['binary']:
+                    self.binary_ledger.record(os.path.abspath(f), 'processed', [p['ascii']])
+
+            for s in pending:
+                if not all(completed(self.binary_ledger, f) for f in s):
+                    # The converter skips segments it can't read, they are tried again on
+                    # the next run in case the .cac files they need are there by then
+                    L.warning("Could not convert {}, skipping".format(', '.join(s)))
+                    self.failed += 1
+                    for f in s:
+                        self.binary_ledger.record(f, 'skipped')
+
+        ascii_files = []
+        for s in segments:
+            for f in s:
+                entry = self.binary_ledger.get(f)
+                if entry is not None and entry['result'] == 'processed':
+                    ascii_files += [ a for a in entry['outputs'] if a not in ascii_files ]
+        return ascii_files
+
+    def create(self, ascii_files):
+        """ Creates the netCDF files of the ASCII files without a checkpoint. Returns the
+        netCDF files of every ASCII file, in order.
+        """
+        from gutils.nc import create_datasets
+        from gutils.slocum import SlocumReader
+
+        pending = [ a for a in ascii_files if not completed(self.ascii_ledger, a) ]
+        L.info("Creating netCDF files from {} of {} ASCII files".format(
+            len(pending),
+            len(ascii_files)
+        ))
+
+        if pending:
+            results = create_datasets(
+                files=pending,
+                reader_class=SlocumReader,
+                config_path=self.config_path,
+                output_path=self.netcdf_path,
+                subset=self.subset,
+                template=self.template,
+                profile_id_type=self.profile_id_type,
+                workers=self.workers,
+                **self.filters
+            )
+            # Recorded as each file finishes so a crash keeps the files done so far
+            for i, result in enumerate(results, 1):
+                if result.error is not None:
+                    L.error("[{}/{}] {}: {}".format(i, len(pending), result.file, result.error))
+                    self.failed += 1
+                    self.ascii_ledger.record(result.file, 'failed')
+                else:
+                    L.info("[{}/{}] {}: {} netCDF files".format(
+                        i, len(pending), result.file, len(result.written)
+                    ))
+                    self.ascii_ledger.record(result.file, 'processed', result.written)
+
+        netcdf_files = []
+        for a in ascii_files:
+            entry = self.ascii_ledger.get(a)
+            if entry is not None and entry['result'] == 'processed':
+                netcdf_files += entry['outputs']
+        return netcdf_files
+
+    def check_files(self, netcdf_files):
+        """ Runs the compliance checks on the netCDF files that did not pass them yet """
+        from multiprocessing import Pool, cpu_count
+
+        pending = [ n for n in netcdf_files if not completed(self.check_ledger, n) ]
+        L.info("Checking {} of {} netCDF files".format(len(pending), len(netcdf_files)))
+        if not pending:
+            return
+
+        workers = min(self.workers or cpu_count(), len(pending))
+        pool = Pool(workers)
+        try:
+            for path, result in pool.imap_unordered(check_file, pending):
+                if result == 0:
+                    self.check_ledger.record(path, 'processed')
+                else:
+                    self.failed += 1
+                    self.check_ledger.record(path, 'failed')
+        finally:
+            pool.close()
+            pool.join()
+
+    def merge(self):
+        """ Merges the profiles into `merged_output` unless it was already merged from the
+        same files
+        """
+        from gutils.nc import merge_profile_netcdf_files
+
+        members = sorted(
+            os.path.join(self.netcdf_path, f) for f in os.listdir(self.netcdf_path)
+            if f.endswith('.nc')
+        )
+        entry = self.merge_ledger.get(self.merged_output)
+        if completed(self.merge_ledger, self.merged_output) and entry['outputs'] == members:
+            L.info("{} is up to date".format(self.merged_output))
+            return
+
+        L.info("Merging {} netCDF files into {}".format(len(members), self.merged_output))
+        merge_profile_netcdf_files(self.netcdf_path, self.merged_output)
+        # The merged file is the product here, the outputs are the files that went into it
+        self.merge_ledger.record(self.merged_output, 'processed', members)
+
+    def run(self):
+        """ Runs every stage and returns the number of segments or files that failed """
+        self.failed = 0
+
+        ascii_files = sorted(self.convert(), key=natural_sort_key)
+        netcdf_files = self.create(ascii_files)
+
+        if self.check is True:
+            self.check_files(netcdf_files)
+
+        if self.merged_output is not None:
+            if self.failed:
+                L.error("Not merging {}, {} segments or files failed".format(
+                    self.merged_output,
+                    self.failed
+                ))
+            elif netcdf_files:
+                self.merge()
+
+        return self.failed
+
+
+def create_reprocess_arg_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Reprocess every binary file of a glider deployment into netCDF files. "
+                    "Completed segments are recorded in --state_path so an interrupted run "
+                    "picks up where it left off."
+    )
+    parser.add_argument(
+        'deployment',
+        help='Path to the binary glider data of the deployment, i.e. '
+             '/data/binary/bass-20160909T1733'
+    )
+    parser.add_argument(
+        '--ascii_outputs',
+        help='Where to place the merged ASCII files. A directory named after the deployment '
+             'is created here.',
+        default=os.environ.get('GUTILS_ASCII_DIRECTORY')
+    )
+    parser.add_argument(
+        '-o',
+        '--outputs',
+        help='Where to place the newly generated NetCDF files. A directory named after the '
+             'deployment is created here.',
+        default=os.environ.get('GUTILS_NETCDF_DIRECTORY')
+    )
+    parser.add_argument(
+        '-c',
+        '--configs',
+        help="Folder to look for NetCDF global and glider "
+             "JSON configuration files.  Default is './config'.",
+        default=os.environ.get('GUTILS_CONFIG_DIRECTORY', './config')
+    )
+    parser.add_argument(
+        '-ts', '--tsint',
+        help="Interpolation window to consider when assigning profiles",
+        default=2
+    )
+    parser.add_argument(
+        '-fp', '--filter_points',
+        help="Filter out profiles that do not have at least this number of points",
+        default=5
+    )
+    parser.add_argument(
+        '-fd', '--filter_distance',
+        help="Filter out profiles that do not span at least this vertical distance (meters)",
+        default=1
+    )
+    parser.add_argument(
+        '-ft', '--filter_time',
+        help="Filter out profiles that last less than this numer of seconds",
+        default=10
+    )
+    parser.add_argument(
+        '-fz', '--filter_z',
+        help="Filter out profiles that are not completely below this depth (meters)",
+        default=1
+    )
+    add_detector_argument(parser)
+    parser.add_argument(
+        '--no-subset',
+        dest='subset',
+        action='store_false',
+        help='Process all variables - not just those available in a datatype mapping JSON file'
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        help="The template to use when writing netCDF files. Options: [filepath], trajectory, ioos_ngdac",
+        default=os.environ.get('GUTILS_NETCDF_TEMPLATE', 'trajectory')
+    )
+    parser.add_argument(
+        "-p",
+        "--profile_id_type",
+        help="The profile type to use when writing netCDF files. 1 == EPOCH, 2 == COUNT, 3 == FRAME",
+        default=os.environ.get('GUTILS_PROFILE_ID_TYPE', 1),
+        type=int
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of segments to process at the same time. Defaults to the number of CPUs.",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--no-check",
+        dest='check',
+        action='store_false',
+        help="Skip the compliance checks of the netCDF files"
+    )
+    parser.add_argument(
+        "-m",
+        "--merged_output",
+        help="Also merge the profiles of the deployment into this netCDF file",
+        default=None
+    )
+    parser.add_argument(
+        "--state_path",
+        help="Folder to keep the checkpoints of completed segments in",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
+    parser.set_defaults(subset=True, check=True)
+
+    return parser
+
+
+def main_reprocess():
+    setup_cli_logger(logging.INFO)
+
+    parser = create_reprocess_arg_parser()
+    args = parser.parse_args()
+
+    if not args.ascii_outputs:
+        L.error("Please provide an --ascii_outputs agrument or set the "
+                "GUTILS_ASCII_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    if not args.outputs:
+        L.error("Please provide an --outputs agrument or set the "
+                "GUTILS_NETCDF_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    if not args.state_path:
+        L.error("Please provide a --state_path agrument or set the "
+                "GUTILS_STATE_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    filter_args = vars(args)
+    deployment = os.path.abspath(filter_args.pop('deployment'))
+    glider_folder_name = os.path.basename(deployment)
+    ascii_outputs = filter_args.pop('ascii_outputs')
+    outputs = filter_args.pop('outputs')
+    glider_config_folder = os.path.join(filter_args.pop('configs'), glider_folder_name)
+
+    if not os.path.isdir(glider_config_folder):
+        L.error("Config folder {} not found!".format(glider_config_folder))
+        return 1
+
+    reprocessor = DeploymentReprocessor(
+        binary_path=deployment,
+        ascii_path=os.path.join(ascii_outputs, glider_folder_name),
+        netcdf_path=os.path.join(outputs, glider_folder_name),
+        config_path=glider_config_folder,
+        **filter_args
+    )
+    try:
+        failed = reprocessor.run()
+    finally:
+        reprocessor.close()
+
+    if failed:
+        L.error("{} segments or files failed, run again to retry them".format(failed))
+        return 1
+
+    L.info("GUTILS reprocess Exited Successfully")
+    return 0
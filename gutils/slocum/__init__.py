@@ -1,22 +1,28 @@
 #!/usr/bin/env python
 import os
+import sys
 import shutil
+import threading
+import subprocess
 from glob import glob
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
 from collections import OrderedDict
 
+import six
 import numpy as np
 import pandas as pd
+from six.moves import queue
 from gsw import z_from_p, p_from_z
 
 from gutils import (
-    generate_stream,
     get_decimal_degrees,
     interpolate_gps,
     masked_epoch,
-    safe_makedirs
+    safe_makedirs,
+    stream_process
 )
-from gutils.ctd import calculate_practical_salinity, calculate_density
+from gutils.ctd import compacted, density, practical_salinity
+from gutils.timing import stage
 
 import logging
 L = logging.getLogger(__name__)
@@ -27,6 +33,12 @@ MODE_MAPPING = {
     "delayed": ["dbd", "ebd"]
 }
 ALL_EXTENSIONS = [".sbd", ".tbd", ".mbd", ".nbd", ".dbd", ".ebd"]
+# (flight, science) file pairs
+FLIGHT_SCIENCE_PAIRS = {
+    ".dbd": ".ebd",
+    ".sbd": ".tbd",
+    ".mbd": ".nbd"
+}
 
 
 class SlocumReader(object):
@@ -38,6 +50,9 @@ class SlocumReader(object):
     CONDUCTIVITY_SENSORS = ['sci_water_cond']
 
     def __init__(self, ascii_file):
+        """ `ascii_file` is either the path to a merged ASCII file or an open text stream
+        of merged ASCII data, ie. the stdout of `dba_merge`.
+        """
         self.ascii_file = ascii_file
         self.metadata, self.data = self.read()
 
@@ -51,23 +66,32 @@ class SlocumReader(object):
                     break
 
     def read(self):
+        if hasattr(self.ascii_file, 'read'):
+            return self.read_stream(self.ascii_file)
+
+        with open(self.ascii_file, 'rt') as af:
+            return self.read_stream(af)
+
+    def read_stream(self, stream):
         metadata = OrderedDict()
         headers = None
-        with open(self.ascii_file, 'rt') as af:
-            for li, al in enumerate(af):
-                if 'm_present_time' in al:
-                    headers = al.strip().split(' ')
-                elif headers is not None:
-                    data_start = li + 2  # Skip units line and the interger row after that
-                    break
-                else:
-                    title, value = al.split(':', 1)
-                    metadata[title.strip()] = value.strip()
+        for al in iter(stream.readline, ''):
+            if 'm_present_time' in al:
+                headers = al.strip().split(' ')
+                # Skip units line and the interger row after that
+                stream.readline()
+                stream.readline()
+                break
+            else:
+                title, value = al.split(':', 1)
+                metadata[title.strip()] = value.strip()
+
+        if headers is None:
+            raise ValueError('No sensor header found in {}'.format(self.ascii_file))
 
         df = pd.read_csv(
-            self.ascii_file,
+            stream,
             index_col=False,
-            skiprows=data_start,
             header=None,
             names=headers,
             sep=' ',
@@ -75,17 +99,21 @@ class SlocumReader(object):
         )
         return metadata, df
 
-    def standardize(self, gps_prefix=None):
+    def standardize(self, gps_prefix=None, gps_index=None):
+        """ With a `gps_index` (gutils.gps.GpsFixIndex) the GPS fixes of the file are added
+        to it and the positions are interpolated between all of the fixes in the index.
+        """
 
         df = self.data.copy()
 
         # Convert NMEA coordinates to decimal degrees
-        for col in df.columns:
-            # Ignore if the m_gps_lat and/or m_gps_lon value is the default masterdata value
-            if '_lat' in col:
-                df[col] = df[col].map(lambda x: get_decimal_degrees(x) if x <= 9000 else np.nan)
-            elif '_lon' in col:
-                df[col] = df[col].map(lambda x: get_decimal_degrees(x) if x < 18000 else np.nan)
+        with stage('nmea'):
+            for col in df.columns:
+                # Ignore if the m_gps_lat and/or m_gps_lon value is the default masterdata value
+                if '_lat' in col:
+                    df[col] = df[col].map(lambda x: get_decimal_degrees(x) if x <= 9000 else np.nan)
+                elif '_lon' in col:
+                    df[col] = df[col].map(lambda x: get_decimal_degrees(x) if x < 18000 else np.nan)
 
         # Standardize 'time' to the 't' column
         for t in self.TIMESTAMP_SENSORS:
@@ -104,21 +132,32 @@ class SlocumReader(object):
             df.loc[masterdatas, 'drv_m_gps_lat'] = np.nan
             df.loc[masterdatas, 'drv_m_gps_lon'] = np.nan
 
-            try:
-                # Interpolate the filled in 'x' and 'y'
-                y_interp, x_interp = interpolate_gps(
-                    masked_epoch(df.t),
-                    df.drv_m_gps_lat,
-                    df.drv_m_gps_lon
-                )
-            except (ValueError, IndexError):
-                L.warning("Raw GPS values not found!")
-                y_interp = np.empty(df.drv_m_gps_lat.size) * np.nan
-                x_interp = np.empty(df.drv_m_gps_lon.size) * np.nan
+            if gps_index is not None:
+                with stage('gps'):
+                    gps_index.add(masked_epoch(df.t), df.drv_m_gps_lat, df.drv_m_gps_lon)
+                    y_interp, x_interp = gps_index.interpolate(masked_epoch(df.t))
+            else:
+                try:
+                    # Interpolate the filled in 'x' and 'y'
+                    with stage('gps'):
+                        y_interp, x_interp = interpolate_gps(
+                            masked_epoch(df.t),
+                            df.drv_m_gps_lat,
+                            df.drv_m_gps_lon
+                        )
+                except (ValueError, IndexError):
+                    L.warning("Raw GPS values not found!")
+                    y_interp = np.empty(df.drv_m_gps_lat.size) * np.nan
+                    x_interp = np.empty(df.drv_m_gps_lon.size) * np.nan
 
             df['y'] = y_interp
             df['x'] = x_interp
 
+        elif gps_index is not None and 't' in df.columns:
+            # No GPS in this file, use the fixes from the rest of the deployment
+            with stage('gps'):
+                df['y'], df['x'] = gps_index.interpolate(masked_epoch(df.t))
+
         """
         ---- Option 1: Always calculate Z from pressure ----
         It's really a matter of data provider preference and varies from one provider to another.
@@ -137,7 +176,8 @@ class SlocumReader(object):
                 df['pressure'] = df[p].copy() * 10
                 # Calculate depth from pressure and latitude
                 # Negate the results so that increasing values note increasing depths
-                df['z'] = -z_from_p(df.pressure, df.y)
+                with stage('gsw'):
+                    df['z'] = -z_from_p(df.pressure, df.y)
                 break
 
         if 'z' not in df and 'pressure' not in df:
@@ -147,7 +187,8 @@ class SlocumReader(object):
                     df['z'] = df[p].copy()
                     # Calculate pressure from depth and latitude
                     # Negate the results so that increasing values note increasing depth
-                    df['pressure'] = -p_from_z(df.z, df.y)
+                    with stage('gsw'):
+                        df['pressure'] = -p_from_z(df.z, df.y)
                     break
         # End Option 1
 
@@ -198,38 +239,91 @@ class SlocumReader(object):
         df = df.rename(columns=rename_columns)
 
         # Compute additional columns
-        df = self.compute(df)
+        with stage('gsw'):
+            df = self.compute(df)
 
         return df
 
     def compute(self, df):
+        """ Flight and science rows are merged, so most rows are missing one of the inputs.
+        gsw only runs on the rows that have all of them, see gutils.ctd.compacted.
+        """
         try:
             # Compute salinity
-            df['salinity'] = calculate_practical_salinity(
-                time=masked_epoch(df.t),
-                conductivity=df.conductivity.values,
-                temperature=df.temperature.values,
-                pressure=df.pressure.values,
-            )
+            df['salinity'] = compacted(practical_salinity, [
+                df.conductivity.values,
+                df.temperature.values,
+                df.pressure.values,
+            ])
         except (ValueError, AttributeError) as e:
             L.error("Could not compute salinity for {}: {}".format(self.ascii_file, e))
 
         try:
             # Compute density
-            df['density'] = calculate_density(
-                time=masked_epoch(df.t),
-                temperature=df.temperature.values,
-                pressure=df.pressure.values,
-                salinity=df.salinity.values,
-                latitude=df.y,
-                longitude=df.x,
-            )
+            df['density'] = compacted(density, [
+                df.temperature.values,
+                df.pressure.values,
+                df.salinity.values,
+                df.y.values,
+                df.x.values,
+            ])
         except (ValueError, AttributeError) as e:
             L.error("Could not compute density for {}: {}".format(self.ascii_file, e))
 
         return df
 
 
+def slocum_binary_sorter(x):
+    """ Sort slocum binary files correctly, using leading zeros.leading """
+    'usf-bass-2014-048-2-1.tbd -> 2014_048_00000002_000000001'
+    x, ext = os.path.splitext(os.path.basename(x))
+    if ext not in ALL_EXTENSIONS:
+        return x
+    z = [ int(a) for a in x.split('-')[-4:] ]
+    return '{0[0]:04d}_{0[1]:03d}_{0[2]:08d}_{0[3]:08d}'.format(z)
+
+
+def slocum_cache_file(x):
+    """ Returns the name of the .cac file `dbd2asc` needs to convert the binary file `x`,
+    or None if the file carries its own sensor list
+    """
+    header = {}
+    with open(x, 'rb') as f:
+        # The header is `num_ascii_tags` lines of "tag: value", starting with dbd_label
+        for line in f:
+            key, _, value = line.decode('latin-1').partition(':')
+            header[key.strip()] = value.strip()
+            if 'dbd_label' not in header:
+                return None
+            if 'num_ascii_tags' in header and len(header) >= int(header['num_ascii_tags']):
+                break
+
+    if header.get('sensor_list_factored') != '1' or not header.get('sensor_list_crc'):
+        return None
+    return '{}.cac'.format(header['sensor_list_crc'].lower())
+
+
+class TeeStream(object):
+    """ Wraps a text stream and writes everything that is read from it to `copy` """
+
+    def __init__(self, stream, copy):
+        self.stream = stream
+        self.copy = copy
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.copy.write(data)
+        return data
+
+    def readline(self, size=-1):
+        line = self.stream.readline(size)
+        self.copy.write(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
 class SlocumMerger(object):
     """
     Merges flight and science data files into an ASCII file.
@@ -237,10 +331,17 @@ class SlocumMerger(object):
     Copies files matching the regex in source_directory to their own temporary directory
     before processing since the Rutgers supported script only takes foldesr as input
 
+    When more than one worker is requested the matched segments are split into contiguous
+    groups and each group is converted by its own `convertDbds.sh` process. Every process
+    writes .cac files into a private copy of the cache directory and new .cac files are
+    published back into the shared cache directory once the process finishes.
+
     Returns a list of flight/science files that were processed into ASCII files
     """
 
-    def __init__(self, source_directory, destination_directory, cache_directory=None, globs=None):
+    CAC_PERMISSIONS = 0o664
+
+    def __init__(self, source_directory, destination_directory, cache_directory=None, globs=None, workers=None):
 
         globs = globs or ['*']
 
@@ -249,6 +350,7 @@ class SlocumMerger(object):
         self.cache_directory = cache_directory or source_directory
         self.destination_directory = destination_directory
         self.source_directory = source_directory
+        self.workers = max(int(workers or 1), 1)
 
         mf = set()
         for g in globs:
@@ -261,30 +363,284 @@ class SlocumMerger(object):
                 )
             )
 
-        def slocum_binary_sorter(x):
-            """ Sort slocum binary files correctly, using leading zeros.leading """
-            'usf-bass-2014-048-2-1.tbd -> 2014_048_00000002_000000001'
-            x, ext = os.path.splitext(os.path.basename(x))
-            if ext not in ALL_EXTENSIONS:
-                return x
-            z = [ int(a) for a in x.split('-')[-4:] ]
-            return '{0[0]:04d}_{0[1]:03d}_{0[2]:08d}_{0[3]:08d}'.format(z)
-
         self.matched_files = sorted(list(mf), key=slocum_binary_sorter)
 
     def __del__(self):
         # Remove tmpdir
         shutil.rmtree(self.tmpdir)
 
+    def segments(self):
+        """ Returns the matched files grouped by segment name, in segment order """
+        segments = OrderedDict()
+        for f in self.matched_files:
+            segment, _ = os.path.splitext(os.path.basename(f))
+            segments.setdefault(segment.lower(), []).append(f)
+        return list(segments.values())
+
+    def partition(self):
+        """ Splits the segments into at most `self.workers` contiguous groups of files.
+        Keeping groups contiguous lets most segments find the .cac files produced by
+        the segments right before them.
+        """
+        segments = self.segments()
+        n = min(self.workers, len(segments)) or 1
+        size, extra = divmod(len(segments), n)
+
+        groups = []
+        start = 0
+        for i in range(n):
+            end = start + size + (1 if i < extra else 0)
+            groups.append([ f for s in segments[start:end] for f in s ])
+            start = end
+        return groups
+
     def convert(self):
+        return sorted(
+            self.iter_convert(),
+            key=lambda p: slocum_binary_sorter(p['binary'][0] if p['binary'] else p['ascii'])
+        )
+
+    def iter_convert(self):
+        """ Yields each {'ascii', 'binary'} result as soon as the conversion script reports
+        the ASCII file, so downstream processing can start on the early segments while later
+        segments are still converting. Results are yielded in the order they are converted,
+        use `convert` to get all of them in segment order.
+        """
+        safe_makedirs(self.destination_directory)
+
+        groups = self.partition()
+        if len(groups) == 1:
+            for p in self._convert_group(groups[0], self.tmpdir, self.cache_directory):
+                yield p
+            return
+
+        safe_makedirs(self.cache_directory)
+        jobs = []
+        for i, g in enumerate(groups):
+            group_folder = os.path.join(self.tmpdir, 'group_{}'.format(i))
+            group_cache = self._private_cache(os.path.join(self.tmpdir, 'cache_{}'.format(i)))
+            safe_makedirs(group_folder)
+            jobs.append((g, group_folder, group_cache))
+
+        results = queue.Queue()
+        errors = []
+
+        def run(job):
+            try:
+                for p in self._convert_group(*job):
+                    results.put(p)
+            except BaseException:
+                errors.append(sys.exc_info())
+            finally:
+                # Signal that this group is done
+                results.put(None)
+
+        threads = [ threading.Thread(target=run, args=(j,)) for j in jobs ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        converted = set()
+        finished = 0
+        while finished < len(threads):
+            p = results.get()
+            if p is None:
+                finished += 1
+                continue
+            converted.update(p['binary'])
+            yield p
+
+        for t in threads:
+            t.join()
+
+        if errors:
+            six.reraise(*errors[0])
+
+        for _, _, group_cache in jobs:
+            self._publish_cache(group_cache)
+
+        # Segments that depended on a .cac file produced by another group could not be
+        # converted the first time around. Retry them now that the cache is merged.
+        group_caches = {}
+        for files, _, group_cache in jobs:
+            for f in files:
+                group_caches[f] = group_cache
+
+        def missing_cache(f):
+            cac = slocum_cache_file(f)
+            return (
+                cac is not None and
+                not os.path.isfile(os.path.join(group_caches[f], cac)) and
+                os.path.isfile(os.path.join(self.cache_directory, cac))
+            )
+
+        missed = []
+        for segment in self.segments():
+            flight = [ f for f in segment if os.path.splitext(f)[1].lower() in FLIGHT_SCIENCE_PAIRS ]
+            if not flight:
+                continue
+            if os.path.join(self.source_directory, os.path.basename(flight[0])) in converted:
+                continue
+            if any(missing_cache(f) for f in segment):
+                missed += segment
+
+        if missed:
+            L.info("Retrying {} files with the merged cache".format(len(missed)))
+            retry_folder = os.path.join(self.tmpdir, 'retry')
+            safe_makedirs(retry_folder)
+            for p in self._convert_group(missed, retry_folder, self.cache_directory):
+                yield p
+
+    def iter_read(self, archive=False, isolate_cache=False):
+        """ Converts and merges each segment with the bundled `dbd2asc` and `dba_merge` tools
+        and pipes the merged output straight into a SlocumReader, skipping the ASCII file on
+        disk. If `archive` is True a copy of the merged ASCII data is also written to the
+        destination directory while it is being read.
+
+        If `isolate_cache` is True `dbd2asc` writes .cac files into a private copy of the
+        cache directory and new .cac files are published back into the shared cache directory
+        after each segment, so mergers running at the same time never write into the shared
+        cache directory directly.
+
+        Yields a {'ascii', 'binary', 'reader'} dict for each segment in segment order. The
+        'ascii' value is None unless the ASCII data was archived.
+        """
+        if archive is True:
+            safe_makedirs(self.destination_directory)
+        safe_makedirs(self.cache_directory)
+        cache_directory = self.cache_directory
+        if isolate_cache is True:
+            cache_directory = self._private_cache(os.path.join(self.tmpdir, 'cache'))
+
+        bin_path = os.path.join(os.path.dirname(__file__), 'bin')
+        dbd2asc = os.path.join(bin_path, 'dbd2asc')
+        dba_merge = os.path.join(bin_path, 'dba_merge')
+
+        for segment in self.segments():
+            flight = [ f for f in segment if os.path.splitext(f)[1].lower() in FLIGHT_SCIENCE_PAIRS ]
+            if not flight:
+                L.debug("No flight file found in {}, skipping".format(segment))
+                continue
+            flight = flight[0]
+            science = [
+                f for f in segment
+                if os.path.splitext(f)[1].lower() == FLIGHT_SCIENCE_PAIRS[os.path.splitext(flight)[1].lower()]
+            ]
+            # dba_merge takes the flight file first
+            merge_files = [flight] + science[:1]
+            binary_files = sorted(merge_files)
+
+            dbas = []
+            archive_handle = archive_path = None
+            try:
+                pargs = [dbd2asc, '-o', '-c', cache_directory, flight]
+                if science:
+                    # dba_merge needs both sides as files so the single file conversions
+                    # are written to the temporary directory
+                    for f in merge_files:
+                        dba_handle, dba_path = mkstemp(prefix='gutils_', suffix='.dba', dir=self.tmpdir)
+                        dbas.append(dba_path)
+                        with os.fdopen(dba_handle, 'w') as dba:
+                            ret = subprocess.call(
+                                [dbd2asc, '-o', '-c', cache_directory, f],
+                                stdout=dba,
+                                cwd=self.tmpdir
+                            )
+                        if ret != 0:
+                            if f == flight:
+                                raise ValueError('Could not convert {}'.format(f))
+                            # Like convertDbds.sh, fall back to the flight data only
+                            L.warning("Could not convert {}, reading the flight data only".format(f))
+                            binary_files = [flight]
+                            break
+                    else:
+                        pargs = [dba_merge] + dbas
+
+                process = subprocess.Popen(
+                    pargs,
+                    universal_newlines=True,
+                    stdout=subprocess.PIPE,
+                    cwd=self.tmpdir
+                )
+                try:
+                    stream = process.stdout
+                    if archive is True:
+                        archive_handle, archive_path = mkstemp(
+                            prefix='.gutils_',
+                            suffix='.dat',
+                            dir=self.destination_directory
+                        )
+                        stream = TeeStream(stream, os.fdopen(archive_handle, 'w'))
+                    reader = SlocumReader(stream)
+                finally:
+                    process.stdout.close()
+                    ret = process.wait()
+                    if archive_handle is not None:
+                        stream.copy.close()
+
+                if ret != 0:
+                    raise ValueError('Could not merge {}'.format(','.join(binary_files)))
+
+                ascii_file = None
+                if archive_path is not None:
+                    # Same naming as the convertDbds.sh script
+                    ascii_file = os.path.join(
+                        self.destination_directory,
+                        '{}_{}.dat'.format(
+                            reader.metadata.get('filename', '').lower().replace('-', '_'),
+                            os.path.splitext(flight)[1][1:].lower()
+                        )
+                    )
+                    os.chmod(archive_path, 0o664)
+                    shutil.move(archive_path, ascii_file)
+                    archive_path = None
+
+                if isolate_cache is True:
+                    self._publish_cache(cache_directory)
+
+                L.info("Read {}".format(','.join([ os.path.basename(x) for x in binary_files ])))
+                yield {
+                    'ascii': ascii_file,
+                    'binary': binary_files,
+                    'reader': reader
+                }
+            except (ValueError, OSError) as e:
+                L.error("Skipping segment {}: {}".format(os.path.basename(flight), e))
+            finally:
+                for d in dbas:
+                    os.remove(d)
+                if archive_path is not None and os.path.exists(archive_path):
+                    os.remove(archive_path)
+
+    def _private_cache(self, folder):
+        """ Creates `folder` with a copy of the .cac files in the shared cache directory """
+        safe_makedirs(folder)
+        for cac in glob(os.path.join(self.cache_directory, '*.cac')):
+            shutil.copy2(cac, folder)
+        return folder
+
+    def _publish_cache(self, group_cache):
+        """ Atomically moves .cac files that are missing from the shared cache directory
+        into it. The .cac files are named after the sensor list CRC so an existing file
+        never has to be replaced.
+        """
+        for cac in glob(os.path.join(group_cache, '*.cac')):
+            final = os.path.join(self.cache_directory, os.path.basename(cac))
+            if os.path.isfile(final):
+                continue
+            tmp_handle, tmp_path = mkstemp(prefix='.gutils_', suffix='.cac', dir=self.cache_directory)
+            os.close(tmp_handle)
+            shutil.copy2(cac, tmp_path)
+            os.chmod(tmp_path, self.CAC_PERMISSIONS)
+            os.rename(tmp_path, final)
+
+    def _convert_group(self, files, folder, cache_directory):
         # Copy to tempdir
-        for f in self.matched_files:
+        for f in files:
             fname = os.path.basename(f)
-            tmpf = os.path.join(self.tmpdir, fname)
+            tmpf = os.path.join(folder, fname)
             shutil.copy2(f, tmpf)
 
-        safe_makedirs(self.destination_directory)
-
         # Run conversion script
         convert_binary_path = os.path.join(
             os.path.dirname(__file__),
@@ -295,20 +651,16 @@ class SlocumMerger(object):
             convert_binary_path,
             '-q',
             '-p',
-            '-c', self.cache_directory
+            '-i',
+            '-c', cache_directory
         ]
 
-        pargs.append(self.tmpdir)
+        pargs.append(folder)
         pargs.append(self.destination_directory)
 
-        command_output, return_code = generate_stream(pargs)
-
-        # Return
-        processed = []
-        output_files = command_output.read().split('\n')
         # iterate and every time we hit a .dat file we return the cache
         binary_files = []
-        for x in output_files:
+        for x in stream_process(pargs):
 
             if x.startswith('Error'):
                 L.error(x)
@@ -323,14 +675,14 @@ class SlocumMerger(object):
             if suff == '.dat':
                 ascii_file = os.path.join(self.destination_directory, fname)
                 if os.path.isfile(ascii_file):
-                    processed.append({
-                        'ascii': ascii_file,
-                        'binary': sorted(binary_files)
-                    })
                     L.info("Converted {} to {}".format(
                         ','.join([ os.path.basename(x) for x in sorted(binary_files) ]),
                         fname
                     ))
+                    yield {
+                        'ascii': ascii_file,
+                        'binary': sorted(binary_files)
+                    }
                 else:
                     L.warning("{} not an output file".format(x))
 
@@ -339,5 +691,3 @@ class SlocumMerger(object):
                 bf = os.path.join(self.source_directory, fname)
                 if os.path.isfile(x):
                     binary_files.append(bf)
-
-        return processed
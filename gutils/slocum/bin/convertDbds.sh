@@ -18,7 +18,7 @@ NAME
     $app - Convert and merge native Slocum glider binary flight and science data files
 
 SYNOPSIS
-    $app [-h] [-f SENSOR_LIST] [-c DBD_CACHE_DIR] [-m] [-e EXTENSION] [-b TWRC_EXE_DIR] [-q] SOURCEDIR DESTDIR
+    $app [-h] [-f SENSOR_LIST] [-c DBD_CACHE_DIR] [-m] [-e EXTENSION] [-b TWRC_EXE_DIR] [-q] [-p] [-i] SOURCEDIR DESTDIR
 
 DESCRIPTION
     Convert and merge all binary *.[demnst]bd files in SOURCEDIR and write the
@@ -66,6 +66,11 @@ DESCRIPTION
     -p
         Print the path of each binary file that was successsfully converted to STDOUT
 
+    -i
+        Move each output file to DESTDIR as soon as it is created instead of
+        moving all of them once every file has been converted.  When combined
+        with -p, the printed output file path is the path in DESTDIR
+
 ";
 
 # Default option values
@@ -74,7 +79,7 @@ local_twrc_exe_dir="$app_dir";
 # Default ascii file extension
 dba_extension='dat';
 # Process options
-while getopts hf:c:me:b:qp option
+while getopts hf:c:me:b:qpi option
 do
 
     case "$option" in
@@ -104,6 +109,9 @@ do
         "p")
             printsuccess=1;
             ;;
+        "i")
+            immediate=1;
+            ;;
         "?")
             exit 1;
             ;;
@@ -474,6 +482,13 @@ do
 
         fi
 
+        # Move the output file to DESTDIR right away so it can be picked up
+        # while the remaining segments are converted
+        if [ -n "$immediate" -a -f "$datFile" ]
+        then
+            mv $datFile $ascDest && datFile="${ascDest}/$(basename $datFile)";
+        fi
+
         [ -n "$printsuccess" ] && echo -e "$dbdSource\n$sciSource\n$datFile";
 
     else
@@ -546,6 +561,13 @@ do
             convertedCount=$(( convertedCount + 1 ));
         fi
 
+        # Move the output file to DESTDIR right away so it can be picked up
+        # while the remaining segments are converted
+        if [ -n "$immediate" -a -f "$datFile" ]
+        then
+            mv $datFile $ascDest && datFile="${ascDest}/$(basename $datFile)";
+        fi
+
         [ -n "$printsuccess" ] && echo -e "$dbdSource\n$datFile";
 
     fi
@@ -584,19 +606,29 @@ done
 
 # Move all remaining file in $tmpDir to $ascDest
 # Default exit status
-[ "$convertedCount" -eq 0 ] && exit 1;
+if [ "$convertedCount" -eq 0 ]
+then
+    rm -Rf $tmpDir;
+    exit 1;
+fi
 
-[ -z "$quiet" ] && echo -n "Moving output files to destination: $ascDest...";
-status=$(mv ${tmpDir}/*.${dba_extension} $ascDest 2>&1);
-if [ "$?" -eq 0 ]
+if [ -z "$immediate" ]
 then
-    [ -z "$quiet" ] && echo "Done.";
-    # Set status to 0 to signal successful conversion
-    STATUS=0;
+    [ -z "$quiet" ] && echo -n "Moving output files to destination: $ascDest...";
+    status=$(mv ${tmpDir}/*.${dba_extension} $ascDest 2>&1);
+    if [ "$?" -eq 0 ]
+    then
+        [ -z "$quiet" ] && echo "Done.";
+        # Set status to 0 to signal successful conversion
+        STATUS=0;
+    else
+        [ -z "$quiet" ] && echo "Failed.";
+    fi
+    [ -z "$quiet" ] && echo '=============================================================================='
 else
-    [ -z "$quiet" ] && echo "Failed.";
+    # Output files were already moved if -i was specified
+    STATUS=0;
 fi
-[ -z "$quiet" ] && echo '=============================================================================='
 
 # Remove $tmpDir
 rm -Rf $tmpDir;
@@ -0,0 +1,87 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from gutils.gps import GpsFixIndex, deployment_gps_index
+from gutils.slocum import SlocumReader
+from gutils.tests import GutilsTestClass, resource
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class TestGpsFixIndex(GutilsTestClass):
+
+    def setUp(self):
+        super(TestGpsFixIndex, self).setUp()
+        self.state_path = tempfile.mkdtemp(prefix='gutils_gps_')
+
+    def tearDown(self):
+        shutil.rmtree(self.state_path)
+
+    def test_add_and_interpolate(self):
+        index = deployment_gps_index(self.state_path, 'bass')
+        lat, lon = index.interpolate([0, 1])
+        assert np.isnan(lat).all() and np.isnan(lon).all()
+
+        assert index.add([20, np.nan, 10], [2, 5, 1], [-2, -5, np.nan]) == 1
+        assert index.add([30, 20], [3, 2.5], [-3, -2.5]) == 1
+        assert index.add([30], [3], [-3]) == 0
+
+        # Sorted, persisted and shared with new instances
+        path = os.path.join(self.state_path, 'gps', 'bass.npz')
+        index = GpsFixIndex(path)
+        assert len(index) == 2
+        np.testing.assert_array_equal(index.t, [20, 30])
+        np.testing.assert_array_equal(index.lat, [2.5, 3])
+
+        lat, lon = index.interpolate([0, 25, 40, np.nan])
+        np.testing.assert_array_equal(lat, [2.5, 2.75, 3, np.nan])
+        np.testing.assert_array_equal(lon, [-2.5, -2.75, -3, np.nan])
+
+    def test_instances_share_fixes(self):
+        a = deployment_gps_index(self.state_path, 'bass')
+        b = deployment_gps_index(self.state_path, 'bass')
+        assert a.add([10, 30], [1, 3], [-1, -3]) == 2
+        assert b.add([20], [2], [-2]) == 1
+        assert a.add([40], [4], [-4]) == 1
+        np.testing.assert_array_equal(a.t, [10, 20, 30, 40])
+        np.testing.assert_array_equal(a.lon, [-1, -2, -3, -4])
+
+        # Unchanged files are not read again
+        loads = []
+        load = a.load
+        a.load = lambda: loads.append(load())
+        assert a.add([50, 5], [5, 0.5], [-5, -0.5]) == 2
+        assert loads == []
+        np.testing.assert_array_equal(GpsFixIndex(a.path).t, [5, 10, 20, 30, 40, 50])
+
+    def test_segment_without_fixes(self):
+        segment = resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat')
+        whole = SlocumReader(segment).standardize()
+
+        index = deployment_gps_index(self.state_path, 'bass')
+        for f in ['usf_bass_2016_253_0_4_sbd.dat', 'usf_bass_2016_253_0_6_sbd.dat']:
+            SlocumReader(resource('slocum', f)).standardize(gps_index=index)
+        assert len(index) == 6
+
+        # A mid-dive piece of the segment, between its surfacings
+        rows = slice(500, 2500)
+
+        def mid_dive():
+            reader = SlocumReader(segment)
+            reader.data = reader.data.iloc[rows].reset_index(drop=True)
+            assert not (reader.data.m_gps_lat < 9000).any()
+            return reader
+
+        alone = mid_dive().standardize()
+        assert alone.y.isnull().all()
+
+        indexed = mid_dive().standardize(gps_index=index)
+        assert indexed.y.notnull().all()
+        np.testing.assert_allclose(indexed.y.values, whole.y.values[rows])
+        np.testing.assert_allclose(indexed.x.values, whole.x.values[rows])
@@ -0,0 +1,88 @@
+#!python
+# coding=utf-8
+import os
+import re
+import sys
+import subprocess
+
+import pytest
+
+from gutils.tests import GutilsTestClass
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+# Modules the console scripts should only import once they have data to work on
+HEAVY_MODULES = [
+    'numpy',
+    'pandas',
+    'scipy',
+    'gsw',
+    'netCDF4',
+    'lxml',
+    'jinja2',
+    'pocean',
+    'compliance_checker',
+]
+
+SETUP_PY = os.path.join(os.path.dirname(__file__), '..', '..', 'setup.py')
+
+
+def console_scripts():
+    """ (script, module, function) of every console script in setup.py """
+    with open(SETUP_PY) as f:
+        return re.findall(r"'(gutils_\w+) = ([\w.]+):(\w+)'", f.read())
+
+
+def import_times(module, function):
+    """ Runs `function` from `module` with --help under `python -X importtime` and
+    returns {module: cumulative import time in microseconds}
+    """
+    code = 'import sys; sys.argv = ["gutils", "--help"]; from {} import {}; {}()'.format(
+        module, function, function
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        universal_newlines=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    _, stderr = process.communicate()
+    assert process.returncode == 0, stderr
+
+    times = {}
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime requires python 3.7')
+@pytest.mark.skipif(not os.path.isfile(SETUP_PY), reason='setup.py is not available')
+class TestConsoleScriptImports(GutilsTestClass):
+
+    def test_no_heavy_imports(self):
+        scripts = console_scripts()
+        assert len(scripts) > 0
+
+        for script, module, function in scripts:
+            times = import_times(module, function)
+            heavy = [ m for m in HEAVY_MODULES if m in times ]
+            L.info("{} imports in {:.1f}ms".format(script, times[module] / 1000.))
+            assert heavy == [], "{} imports {} on startup".format(script, ', '.join(heavy))
+
+
+class TestCoreImports(GutilsTestClass):
+
+    def test_core_modules_do_not_import_watch(self):
+        # The watch package needs pyinotify and starts metrics and tracing
+        code = (
+            'import sys; import gutils.ledger, gutils.erddap, gutils.reprocess; '
+            'print(sorted(m for m in sys.modules if m.startswith(("gutils.watch", "pyinotify"))))'
+        )
+        output = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+        assert output.strip() == '[]'
@@ -0,0 +1,121 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+
+from six.moves.urllib.request import urlopen
+
+from gutils.timing import file_timings, stage
+from gutils.watch import GutilsProcessEvent, PathEvent
+from gutils.watch.metrics import (
+    EVENTS,
+    FILES,
+    OUTPUT_LATENCY,
+    PROCESSING,
+    STAGES,
+    Counter,
+    Histogram,
+    Registry,
+    start_metrics_server
+)
+from gutils.tests import GutilsTestClass
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class MetricsProcessor(GutilsProcessEvent):
+
+    watch = 'test_metrics'
+
+    def valid_file(self, name):
+        return name.endswith('.dat')
+
+    def process_file(self, event):
+        if 'bad' in event.name:
+            raise ValueError('Bad file')
+        return [event.pathname + '.nc']
+
+
+class TestMetrics(GutilsTestClass):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_metrics_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name):
+        p = os.path.join(self.tmpdir, name)
+        with open(p, 'wt') as f:
+            f.write('data')
+        return PathEvent.from_path(p)
+
+    def test_render(self):
+        registry = Registry()
+        files = registry.register(Counter('files_total', 'Files', ['result']))
+        latency = registry.register(Histogram('latency_seconds', 'Latency', buckets=(1, 10)))
+
+        files.inc(result='processed')
+        files.inc(2, result='processed')
+        latency.observe(0.5)
+        latency.observe(5)
+        latency.observe(50)
+
+        assert registry.render().split('\n') == [
+            '# HELP files_total Files',
+            '# TYPE files_total counter',
+            'files_total{result="processed"} 3.0',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="1.0"} 1.0',
+            'latency_seconds_bucket{le="10.0"} 2.0',
+            'latency_seconds_bucket{le="+Inf"} 3.0',
+            'latency_seconds_sum 55.5',
+            'latency_seconds_count 3.0',
+            '',
+        ]
+
+    def test_watch_metrics(self):
+        watch = MetricsProcessor.watch
+        events = EVENTS.get(watch=watch)
+        processed = FILES.get(watch=watch, result='processed')
+        failed = FILES.get(watch=watch, result='failed')
+        processing = PROCESSING.count(watch=watch)
+        latency = OUTPUT_LATENCY.count(watch=watch)
+
+        processor = MetricsProcessor()
+        processor.process_IN_CLOSE(self.write('a.dat'))
+        processor.process_IN_MOVED_TO(self.write('b.txt'))
+        with self.assertRaises(ValueError):
+            processor.process_IN_CLOSE(self.write('bad.dat'))
+
+        assert EVENTS.get(watch=watch) == events + 3
+        assert FILES.get(watch=watch, result='processed') == processed + 1
+        assert FILES.get(watch=watch, result='failed') == failed + 1
+        assert PROCESSING.count(watch=watch) == processing + 2
+        assert OUTPUT_LATENCY.count(watch=watch) == latency + 1
+
+    def test_stages(self):
+        before = STAGES.count(stage='test_metrics_stage')
+        with file_timings('a.dat'), stage('test_metrics_stage'):
+            pass
+        assert STAGES.count(stage='test_metrics_stage') == before + 1
+
+    def test_server(self):
+        MetricsProcessor().handle(self.write('a.dat'))
+
+        server = start_metrics_server(0)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_address[1])
+            response = urlopen(url)
+            assert response.headers['Content-Type'].startswith('text/plain')
+            body = response.read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert 'gutils_files_total{watch="test_metrics",result="processed"}' in body
+        assert '# TYPE gutils_processing_seconds histogram' in body
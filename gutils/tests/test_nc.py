@@ -1,7 +1,10 @@
 #!python
 # coding=utf-8
 import os
+import time
 import shutil
+import tempfile
+import threading
 from glob import glob
 from collections import namedtuple
 
@@ -9,10 +12,24 @@ import netCDF4 as nc4
 from lxml import etree
 
 from gutils import safe_makedirs
-from gutils.nc import check_dataset, create_dataset, merge_profile_netcdf_files
+from gutils.nc import (
+    check_dataset,
+    create_dataset,
+    create_datasets,
+    find_ascii_files,
+    merge_profile_netcdf_files
+)
 from gutils.slocum import SlocumReader
 from gutils.tests import resource, GutilsTestClass
-from gutils.watch.netcdf import netcdf_to_erddap_dataset
+from gutils.erddap import (
+    DatasetsXml,
+    deployment_signature,
+    netcdf_to_erddap_dataset,
+    read_datasets_xml,
+    rebuild_datasets_xml,
+    render_deployment_xml,
+    write_datasets_xml
+)
 
 from pocean.dsg import ContiguousRaggedTrajectoryProfile
 
@@ -112,6 +129,42 @@ class TestCreateGliderScript(GutilsTestClass):
         for o in output_files:
             assert check_dataset(ds(file=o)) == 0
 
+    def test_batch(self):
+        out_base = resource('slocum', 'real', 'netcdf', 'bass-20160909T1733')
+
+        files = find_ascii_files([resource('slocum', 'usf_bass*.dat')])
+        names = [ os.path.basename(f) for f in files ]
+        assert names.index('usf_bass_2016_252_1_2_sbd.dat') < names.index('usf_bass_2016_252_1_10_sbd.dat')
+        # Directories are searched and duplicates dropped
+        found = find_ascii_files([resource('slocum'), files[0]])
+        assert len(found) == len(set(found))
+        assert set(files) <= set(found)
+
+        results = list(create_datasets(
+            files=files,
+            reader_class=SlocumReader,
+            config_path=resource('slocum', 'config', 'bass-20160909T1733'),
+            output_path=out_base,
+            subset=False,
+            template='ioos_ngdac',
+            profile_id_type=2,
+            workers=2,
+            tsint=10,
+            filter_distance=1,
+            filter_points=5,
+            filter_time=10,
+            filter_z=1
+        ))
+        # Results come back in the order of the files
+        assert [ r.file for r in results ] == files
+
+        # COUNT ids follow the order of the files, like when creating them one at a time
+        written = [ w for r in results for w in r.written ]
+        assert len(written) == len(os.listdir(out_base))
+        for i, w in enumerate(written):
+            with nc4.Dataset(w) as ncd:
+                assert ncd.variables['profile_id'][0] == i
+
     def test_delayed(self):
         out_base = resource('slocum', 'real', 'netcdf', 'modena-2015')
 
@@ -212,3 +265,158 @@ class TestNetcdfToErddap(GutilsTestClass):
         assert 'density' in vs
 
         os.remove(datasets_path)
+
+    def test_cached_datasets_xml(self):
+        content = tempfile.mkdtemp()
+        flags = tempfile.mkdtemp()
+        datasets_path = os.path.join(content, 'datasets.xml')
+
+        def dataset_variables(name):
+            xmltree = etree.parse(datasets_path).getroot()
+            ds = xmltree.xpath("//erddapDatasets/dataset[@datasetID=$name]", name=name)[0]
+            return [ d.findtext('sourceName') for d in ds.iter('dataVariable') ]
+
+        try:
+            datasets = DatasetsXml(datasets_path, flag_path=flags, debounce=60)
+            datasets.update(*render_deployment_xml(resource('erddap', '1.nc')))
+
+            # Nothing is written until the debounce is up or it is flushed
+            assert not os.path.isfile(datasets_path)
+            assert not os.listdir(flags)
+            datasets.flush()
+            assert 'temperature' not in dataset_variables('erddap')
+            assert os.listdir(flags) == ['erddap']
+
+            # Someone else edits datasets.xml
+            xmltree = etree.parse(datasets_path).getroot()
+            xmltree.append(etree.fromstring('<dataset datasetID="external"/>'))
+            with open(datasets_path, 'wb') as f:
+                f.write(etree.tostring(xmltree))
+            later = time.time() + 10
+            os.utime(datasets_path, (later, later))
+
+            datasets.update(*render_deployment_xml(resource('erddap', '2.nc')))
+            datasets.flush()
+            assert 'temperature' in dataset_variables('erddap')
+            assert dataset_variables('external') == []
+        finally:
+            shutil.rmtree(content)
+            shutil.rmtree(flags)
+
+    def test_deployment_signatures(self):
+        content = tempfile.mkdtemp()
+        datasets_path = os.path.join(content, 'datasets.xml')
+
+        def signature(n):
+            with nc4.Dataset(n) as ncd:
+                return deployment_signature(os.path.dirname(n), ncd.variables)
+
+        try:
+            datasets = DatasetsXml(datasets_path)
+            first = resource('erddap', '1.nc')
+            assert datasets.unchanged('erddap', signature(first)) is False
+            datasets.update(*render_deployment_xml(first), signature=signature(first))
+            assert datasets.unchanged('erddap', signature(first)) is True
+
+            # Different variables
+            assert datasets.unchanged('erddap', signature(resource('erddap', '2.nc'))) is False
+
+            # Forgotten when datasets.xml is changed by something else
+            later = time.time() + 10
+            os.utime(datasets_path, (later, later))
+            assert datasets.unchanged('erddap', signature(first)) is False
+        finally:
+            shutil.rmtree(content)
+
+    def test_datasets_xml_fragments(self):
+        content = tempfile.mkdtemp()
+        netcdfs = tempfile.mkdtemp()
+        datasets_path = os.path.join(content, 'datasets.xml')
+
+        deployments = {}
+        for i, name in enumerate(['glider_a', 'glider_b', 'glider_c']):
+            safe_makedirs(os.path.join(netcdfs, name))
+            deployments[name] = os.path.join(netcdfs, name, 'profile.nc')
+            shutil.copy(resource('erddap', '{}.nc'.format(i + 1)), deployments[name])
+
+        def dataset_ids():
+            xmltree = etree.parse(datasets_path).getroot()
+            return [ d.get('datasetID') for d in xmltree.iter('dataset') ]
+
+        try:
+            datasets = DatasetsXml(datasets_path, debounce=60)
+            # Different deployments are updated at the same time
+            threads = [
+                threading.Thread(target=datasets.update, args=render_deployment_xml(n))
+                for n in deployments.values()
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            datasets.flush()
+
+            assert dataset_ids() == ['glider_a', 'glider_b', 'glider_c']
+            assert sorted(os.listdir(os.path.join(content, 'datasets.d'))) == [
+                '.assembled', '.head.xml', 'glider_a.xml', 'glider_b.xml', 'glider_c.xml'
+            ]
+            xmltree = etree.parse(datasets_path).getroot()
+            assert xmltree.find('requestBlacklist') is not None
+
+            # A restart picks up the fragments, and a deployment removed from
+            # datasets.xml by hand stays removed
+            xmltree.remove(xmltree.find("dataset[@datasetID='glider_b']"))
+            with open(datasets_path, 'wb') as f:
+                f.write(etree.tostring(xmltree))
+            datasets = DatasetsXml(datasets_path)
+            datasets.update(*render_deployment_xml(deployments['glider_c']))
+            assert dataset_ids() == ['glider_a', 'glider_c']
+        finally:
+            shutil.rmtree(content)
+            shutil.rmtree(netcdfs)
+
+    def test_rebuild(self):
+        content = tempfile.mkdtemp()
+        flags = tempfile.mkdtemp()
+        netcdfs = tempfile.mkdtemp()
+        datasets_path = os.path.join(content, 'datasets.xml')
+
+        for name in ['glider_a', 'glider_b']:
+            safe_makedirs(os.path.join(netcdfs, name))
+            for n in ['1.nc', '2.nc', '3.nc']:
+                shutil.copy(resource('erddap', n), os.path.join(netcdfs, name, n))
+
+        def dataset_variables():
+            xmltree = etree.parse(datasets_path).getroot()
+            return {
+                d.get('datasetID'): [ v.findtext('sourceName') for v in d.iter('dataVariable') ]
+                for d in xmltree.iter('dataset')
+            }
+
+        def dataset_ids():
+            xmltree = etree.parse(datasets_path).getroot()
+            return [ d.get('datasetID') for d in xmltree.iter('dataset') ]
+
+        try:
+            # A datasets.xml from before the fragments, with a deployment and a dataset
+            # GUTILS doesn't manage
+            xmltree = read_datasets_xml(datasets_path)
+            xmltree.append(etree.fromstring('<dataset datasetID="external"/>'))
+            xmltree.append(etree.fromstring('<dataset datasetID="glider_a"/>'))
+            write_datasets_xml(xmltree, datasets_path)
+
+            # Only the last file is read
+            assert rebuild_datasets_xml(netcdfs, datasets_path, flags, workers=2) == ['glider_a', 'glider_b']
+            assert dataset_ids() == ['external', 'glider_a', 'glider_b']
+            assert 'temperature' not in dataset_variables()['glider_a']
+            assert sorted(os.listdir(flags)) == ['glider_a', 'glider_b']
+
+            # The union of all of the files. Only deployments GUTILS manages are pruned.
+            shutil.rmtree(os.path.join(netcdfs, 'glider_b'))
+            assert rebuild_datasets_xml(netcdfs, datasets_path, workers=2, union=True, prune=True) == ['glider_a']
+            assert dataset_ids() == ['external', 'glider_a']
+            assert 'temperature' in dataset_variables()['glider_a']
+        finally:
+            shutil.rmtree(content)
+            shutil.rmtree(flags)
+            shutil.rmtree(netcdfs)
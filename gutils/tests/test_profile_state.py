@@ -0,0 +1,91 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+
+from gutils.filters import process_dataset
+from gutils.profile_state import glider_profile_state
+from gutils.slocum import SlocumReader
+from gutils.tests import GutilsTestClass, resource
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+FILTERS = dict(filter_z=1, filter_points=5, filter_time=10, filter_distance=1)
+
+
+class SegmentReader(object):
+    """ Serves already standardized rows, as if they were a segment of their own """
+
+    mode = 'rt'
+
+    def __init__(self, data):
+        self.data = data
+
+    def standardize(self):
+        return self.data.copy()
+
+
+class TestProfileState(GutilsTestClass):
+
+    def setUp(self):
+        super(TestProfileState, self).setUp()
+        self.state_path = tempfile.mkdtemp(prefix='gutils_profile_state_')
+
+        self.file = resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat')
+        data = SlocumReader(self.file).standardize()
+        # Split mid-dive so profiles span the segment boundaries
+        n = len(data)
+        cuts = [0, n // 3 + 7, 2 * n // 3 - 11, n]
+        self.segments = [
+            data.iloc[cuts[i]:cuts[i + 1]].reset_index(drop=True)
+            for i in range(len(cuts) - 1)
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.state_path)
+
+    def process(self, segment, incremental=True):
+        state = glider_profile_state(self.state_path if incremental else None, 'bass')
+        processed, _ = process_dataset(
+            SegmentReader(segment), SegmentReader, profile_state=state, **FILTERS
+        )
+        return processed
+
+    def test_profiles_span_segments(self):
+        whole, _ = process_dataset(self.file, SlocumReader, **FILTERS)
+
+        emitted = []
+        for segment in self.segments[:-1]:
+            processed = self.process(segment)
+            emitted.append(processed)
+            # The profile the segment ended in is kept for the next one
+            assert os.path.isfile(os.path.join(self.state_path, 'profiles', 'bass.pkl'))
+            assert processed.t.max() < segment.t.max()
+
+        # The last segment ends at the surface so its last profile is complete
+        emitted.append(self.process(self.segments[-1]))
+        assert not os.path.isfile(os.path.join(self.state_path, 'profiles', 'bass.pkl'))
+
+        incremental = sum(e.profile.nunique() for e in emitted)
+        isolated = sum(self.process(s, incremental=False).profile.nunique() for s in self.segments)
+        assert incremental == whole.profile.nunique()
+        assert isolated != incremental
+
+        # Each completed profile is only emitted once
+        times = [ t for e in emitted for t in e.t.tolist() ]
+        assert len(times) == len(set(times))
+
+    def test_segment_processed_again(self):
+        first = self.process(self.segments[0])
+        second = self.process(self.segments[1])
+        assert second.t.min() > first.t.max()
+
+        # An earlier segment does not continue the open profile, which is kept
+        state = glider_profile_state(self.state_path, 'bass')
+        tail = state.tail.copy()
+        again = self.process(self.segments[0])
+        isolated = self.process(self.segments[0], incremental=False)
+        assert again.profile.nunique() == isolated.profile.nunique()
+        assert glider_profile_state(self.state_path, 'bass').tail.equals(tail)
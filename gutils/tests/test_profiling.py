@@ -0,0 +1,85 @@
+#!python
+# coding=utf-8
+import os
+import pstats
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from glob import glob
+
+from gutils.profiling import Profiler, add_profile_arguments, configure_profiling
+from gutils.watch import GutilsProcessEvent, PathEvent
+from gutils.tests import GutilsTestClass
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class SlowProcessor(GutilsProcessEvent):
+
+    def valid_file(self, name):
+        return name.endswith('.dat')
+
+    def process_file(self, event):
+        return [ sorted(range(1000)) for _ in range(10) ]
+
+
+class TestProfiler(GutilsTestClass):
+
+    def setUp(self):
+        super(TestProfiler, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_profile_')
+        self.profile_path = os.path.join(self.tmpdir, 'profiles')
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        configure_profiling(argparse.Namespace(profile=None))
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def profiles(self, extension='.prof'):
+        return sorted(glob(os.path.join(self.profile_path, '*' + extension)))
+
+    def test_rotation(self):
+        profiler = Profiler(self.profile_path, keep=3)
+        for i in range(5):
+            with profiler.profile('usf_bass_2016_253_0_{}_sbd.dat'.format(i)):
+                # Profiling the same thread twice is part of the outer profile
+                with profiler.profile('inner'):
+                    sorted(range(1000))
+
+        # Only the newest ones are kept
+        profiles = self.profiles()
+        assert len(profiles) == 3
+        for i, p in zip([2, 3, 4], profiles):
+            assert p.endswith('-usf_bass_2016_253_0_{}_sbd.dat.prof'.format(i))
+
+        functions = [ f[2] for f in pstats.Stats(profiles[-1]).stats ]
+        assert any('sorted' in f for f in functions)
+
+    def test_watch_events(self):
+        parser = add_profile_arguments(argparse.ArgumentParser())
+        args = parser.parse_args(['--profile', self.profile_path, '--profile_memory'])
+        configure_profiling(args)
+        assert os.environ['GUTILS_PROFILE'] == self.profile_path
+
+        processor = SlowProcessor()
+        processor.handle(PathEvent.from_path('/data/glider/a.dat'))
+        processor.handle(PathEvent.from_path('/data/glider/b.txt'))
+
+        profiles = self.profiles()
+        assert len(profiles) == 1
+        assert profiles[0].endswith('-a.dat.prof')
+        assert len(self.profiles('.tracemalloc')) == 1
+
+    def test_disabled(self):
+        os.environ.pop('GUTILS_PROFILE', None)
+        args = add_profile_arguments(argparse.ArgumentParser()).parse_args([])
+        assert configure_profiling(args) is None
+
+        SlowProcessor().handle(PathEvent.from_path('/data/glider/a.dat'))
+        assert not os.path.exists(self.profile_path)
@@ -54,7 +54,8 @@ def test_real_deployments(deployment):
             binary_path,
             ascii_path
         )
-        for p in merger.convert():
+        # Create the netCDF files for each segment as soon as it is converted
+        for p in merger.iter_convert():
             args['file'] = p['ascii']
             create_dataset(**args)
     finally:
@@ -0,0 +1,115 @@
+#!python
+# coding=utf-8
+import os
+import shutil
+import tempfile
+from glob import glob
+
+from gutils.reprocess import DeploymentReprocessor
+from gutils.slocum import SlocumMerger
+from gutils.tests import GutilsTestClass, resource
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class TestDeploymentReprocessor(GutilsTestClass):
+
+    def setUp(self):
+        super(TestDeploymentReprocessor, self).setUp()
+
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_reprocess_')
+        deployment = 'bass-20160909T1733'
+        self.binary_path = os.path.join(self.tmpdir, 'binary', deployment)
+        shutil.copytree(resource('slocum', 'real', 'binary', deployment), self.binary_path)
+        self.ascii_path = os.path.join(self.tmpdir, 'ascii', deployment)
+        self.netcdf_path = os.path.join(self.tmpdir, 'netcdf', deployment)
+        self.state_path = os.path.join(self.tmpdir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def reprocessor(self):
+        return DeploymentReprocessor(
+            binary_path=self.binary_path,
+            ascii_path=self.ascii_path,
+            netcdf_path=self.netcdf_path,
+            config_path=resource('slocum', 'config', 'bass-20160909T1733'),
+            state_path=self.state_path,
+            workers=2,
+            subset=False,
+            template='trajectory',
+            profile_id_type=1,
+            check=False,
+            tsint=10,
+            filter_distance=1,
+            filter_points=5,
+            filter_time=10,
+            filter_z=1
+        )
+
+    def test_resume(self):
+        reprocessor = self.reprocessor()
+        assert reprocessor.run() == 0
+        reprocessor.close()
+
+        ascii_files = glob(os.path.join(self.ascii_path, '*.dat'))
+        netcdf_files = glob(os.path.join(self.netcdf_path, '*.nc'))
+        assert len(ascii_files) > 0
+        assert len(netcdf_files) > 0
+        mtimes = { f: os.path.getmtime(f) for f in ascii_files + netcdf_files }
+
+        # Lose a netCDF file, like when a run is killed while writing the files of a segment
+        removed = sorted(netcdf_files)[len(netcdf_files) // 2]
+        os.remove(removed)
+        reprocessor = self.reprocessor()
+        segment = [
+            reprocessor.ascii_ledger.get(a)['outputs'] for a in ascii_files
+            if removed in reprocessor.ascii_ledger.get(a)['outputs']
+        ][0]
+
+        assert reprocessor.run() == 0
+        reprocessor.close()
+
+        # Only the netCDF files of that segment were created again
+        assert os.path.isfile(removed)
+        for f, mtime in mtimes.items():
+            if f not in segment:
+                assert os.path.getmtime(f) == mtime
+
+    def test_skipped_segments_fail(self):
+        # The rest of the segments of the dive need the .cac file written by its first
+        # segment. Write it into the temporary folder first, the other tests remove the
+        # .cac files from the resource folders.
+        cache_path = os.path.join(self.tmpdir, 'cache')
+        SlocumMerger(
+            self.binary_path,
+            os.path.join(self.tmpdir, 'cache_ascii'),
+            cache_directory=cache_path,
+            globs=['usf-bass-2016-253-0-0.*']
+        ).convert()
+        saved = os.path.join(cache_path, 'da485e91.cac')
+        assert os.path.isfile(saved)
+
+        cac = os.path.join(self.binary_path, 'da485e91.cac')
+        if os.path.isfile(cac):
+            os.remove(cac)
+        for f in glob(os.path.join(self.binary_path, 'usf-bass-2016-253-0-0.*')):
+            os.remove(f)
+
+        reprocessor = self.reprocessor()
+        assert reprocessor.run() == 8
+        reprocessor.close()
+
+        skipped = os.path.join(self.binary_path, 'usf-bass-2016-253-0-1.sbd')
+        reprocessor = self.reprocessor()
+        assert reprocessor.binary_ledger.get(skipped)['result'] == 'skipped'
+        assert reprocessor.run() == 8
+        reprocessor.close()
+
+        # Converted once the .cac file is there
+        shutil.copy2(saved, cac)
+        reprocessor = self.reprocessor()
+        assert reprocessor.run() == 0
+        assert reprocessor.binary_ledger.get(skipped)['result'] == 'processed'
+        reprocessor.close()
@@ -5,7 +5,7 @@ import shutil
 import tempfile
 from glob import glob
 
-from gutils.slocum import SlocumMerger, SlocumReader
+from gutils.slocum import SlocumMerger, SlocumReader, slocum_cache_file
 from gutils.tests import GutilsTestClass, resource
 
 import logging
@@ -47,6 +47,40 @@ class TestSlocumMerger(GutilsTestClass):
         assert len(p) > 0
         assert len(glob(os.path.join(self.ascii_path, '*.dat'))) > 0
 
+    def test_convert_parallel(self):
+        serial = SlocumMerger(
+            self.binary_path,
+            self.ascii_path,
+            cache_directory=tempfile.mkdtemp(),
+            globs=['*.tbd', '*.sbd']
+        ).convert()
+        shutil.rmtree(self.ascii_path)
+
+        parallel = SlocumMerger(
+            self.binary_path,
+            self.ascii_path,
+            cache_directory=tempfile.mkdtemp(),
+            globs=['*.tbd', '*.sbd'],
+            workers=3
+        ).convert()
+        assert len(parallel) > 0
+        assert parallel == serial
+        assert len(glob(os.path.join(self.ascii_path, '*.dat'))) == len(serial)
+
+    def test_iter_convert(self):
+        merger = SlocumMerger(
+            self.binary_path,
+            self.ascii_path,
+            globs=['*.tbd', '*.sbd']
+        )
+        converted = []
+        for p in merger.iter_convert():
+            # The ASCII file is in place as soon as it is yielded
+            assert os.path.isfile(p['ascii'])
+            converted.append(p['ascii'])
+        assert len(converted) > 0
+        assert sorted(converted) == sorted(glob(os.path.join(self.ascii_path, '*.dat')))
+
     def test_convert_single_pair(self):
         merger = SlocumMerger(
             self.binary_path,
@@ -63,6 +97,68 @@ class TestSlocumMerger(GutilsTestClass):
         }]
         assert len(glob(os.path.join(self.ascii_path, '*.dat'))) == 1
 
+    def test_read_from_merger_stream(self):
+        merger = SlocumMerger(
+            self.binary_path,
+            self.ascii_path,
+            globs=['usf-bass-2014-048-0-0.tbd', 'usf-bass-2014-048-0-0.sbd']
+        )
+        p = merger.convert()
+        from_file = SlocumReader(p[0]['ascii'])
+
+        streamed = list(merger.iter_read())
+        assert len(streamed) == 1
+        assert streamed[0]['ascii'] is None
+        assert streamed[0]['binary'] == p[0]['binary']
+
+        sr = streamed[0]['reader']
+        assert sr.mode == from_file.mode
+        assert sr.metadata == from_file.metadata
+        assert sr.data.equals(from_file.data)
+
+    def test_read_from_merger_stream_archive(self):
+        merger = SlocumMerger(
+            self.binary_path,
+            self.ascii_path,
+            globs=['usf-bass-2014-048-0-0.tbd', 'usf-bass-2014-048-0-0.sbd']
+        )
+        streamed = list(merger.iter_read(archive=True))
+        assert len(streamed) == 1
+        assert streamed[0]['ascii'] == os.path.join(self.ascii_path, 'usf_bass_2014_048_0_0_sbd.dat')
+
+        from_file = SlocumReader(streamed[0]['ascii'])
+        assert streamed[0]['reader'].data.equals(from_file.data)
+
+    def test_read_from_merger_stream_bad_science_file(self):
+        binary_path = tempfile.mkdtemp()
+        try:
+            flight = os.path.join(binary_path, 'usf-bass-2014-048-0-0.sbd')
+            shutil.copy2(os.path.join(self.binary_path, 'usf-bass-2014-048-0-0.sbd'), flight)
+            with open(os.path.join(binary_path, 'usf-bass-2014-048-0-0.tbd'), 'wt') as f:
+                f.write('not a science file')
+
+            merger = SlocumMerger(
+                binary_path,
+                self.ascii_path,
+                globs=['*.tbd', '*.sbd']
+            )
+            # The flight data is still read, like convertDbds.sh does
+            streamed = list(merger.iter_read(archive=True))
+            assert len(streamed) == 1
+            assert streamed[0]['binary'] == [flight]
+            assert len(streamed[0]['reader'].data) > 0
+        finally:
+            shutil.rmtree(binary_path)
+
+
+class TestSlocumCacheFile(GutilsTestClass):
+
+    def test_cache_file(self):
+        binary_path = resource('slocum', 'real', 'binary', 'bass-20150407T1300')
+        # The first segment carries its sensor list, the next ones need its .cac file
+        assert slocum_cache_file(os.path.join(binary_path, 'usf-bass-2014-048-0-0.sbd')) is None
+        assert slocum_cache_file(os.path.join(binary_path, 'usf-bass-2014-048-1-1.sbd')) == '0b7d8ab7.cac'
+
 
 class TestSlocumReaderNoGPS(GutilsTestClass):
 
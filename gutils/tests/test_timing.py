@@ -0,0 +1,94 @@
+#!python
+# coding=utf-8
+import os
+import json
+import shutil
+import tempfile
+
+from gutils.filters import process_dataset
+from gutils.slocum import SlocumReader
+from gutils.tests import GutilsTestClass, resource
+from gutils.timing import annotate, current, file_timings, stage
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class TestTimings(GutilsTestClass):
+
+    def setUp(self):
+        super(TestTimings, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_timing_')
+        self.timings_file = os.path.join(self.tmpdir, 'timings.jsonl')
+        self.environ = dict(os.environ)
+        os.environ.pop('GUTILS_TIMINGS', None)
+        os.environ['GUTILS_TIMINGS_FILE'] = self.timings_file
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def reported(self):
+        if not os.path.isfile(self.timings_file):
+            return []
+        with open(self.timings_file) as f:
+            return [ json.loads(line) for line in f ]
+
+    def test_stages(self):
+        with file_timings('one.dat'):
+            with stage('read'):
+                pass
+            for _ in range(3):
+                with stage('standardize'):
+                    with stage('gsw'):
+                        pass
+            annotate(rows=10)
+
+            # Nested files are timed as part of the outer file
+            with file_timings('two.dat'):
+                with stage('filter'):
+                    pass
+
+        assert current() is None
+        summaries = self.reported()
+        assert len(summaries) == 1
+
+        summary = summaries[0]
+        assert summary['file'] == 'one.dat'
+        assert summary['rows'] == 10
+        assert summary['failed'] is False
+        assert list(summary['stages'].keys()) == [
+            'read', 'standardize.gsw', 'standardize', 'filter'
+        ]
+        assert summary['stages']['standardize']['calls'] == 3
+        assert summary['stages']['standardize.gsw']['calls'] == 3
+        for s in summary['stages'].values():
+            assert s['wall'] >= 0
+            assert s['cpu'] >= 0
+
+    def test_failed(self):
+        with self.assertRaises(ValueError):
+            with file_timings('bad.dat'), stage('read'):
+                raise ValueError('Bad file')
+
+        summary = self.reported()[0]
+        assert summary['failed'] is True
+        assert 'read' in summary['stages']
+
+    def test_disabled(self):
+        os.environ['GUTILS_TIMINGS'] = '0'
+        with file_timings('one.dat') as timings, stage('read'):
+            assert timings is None
+        assert self.reported() == []
+
+    def test_process_dataset(self):
+        ascii_file = resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat')
+        process_dataset(ascii_file, SlocumReader, tsint=10)
+
+        summary = self.reported()[0]
+        assert summary['file'] == ascii_file
+        assert summary['rows'] > 0
+        for s in ['read', 'standardize', 'standardize.gsw', 'assign_profiles',
+                  'reassign_profile_id', 'filter']:
+            assert s in summary['stages']
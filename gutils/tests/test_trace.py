@@ -0,0 +1,108 @@
+#!python
+# coding=utf-8
+import os
+import time
+import shutil
+import tempfile
+
+from gutils import safe_makedirs
+from gutils.watch import GutilsProcessEvent, PathEvent
+from gutils.watch.trace import configure_tracing, read_spans, trace_report
+from gutils.tests import GutilsTestClass
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+
+class CopyProcessor(GutilsProcessEvent):
+    """ Writes `outputs` files named after the input into the same deployment folder of
+    `outputs_path`
+    """
+
+    def my_init(self, watch, outputs_path, extension, outputs=1):
+        self.watch = watch
+        self.outputs_path = outputs_path
+        self.extension = extension
+        self.outputs = outputs
+
+    def valid_file(self, name):
+        return True
+
+    def process_file(self, event):
+        folder = os.path.join(self.outputs_path, os.path.basename(event.path))
+        safe_makedirs(folder)
+        written = []
+        for i in range(self.outputs):
+            p = os.path.join(folder, '{}_{}{}'.format(event.name, i, self.extension))
+            with open(p, 'wt') as f:
+                f.write('data')
+            written.append(p)
+        return written
+
+
+class TestTrace(GutilsTestClass):
+
+    def setUp(self):
+        super(TestTrace, self).setUp()
+        self.tmpdir = tempfile.mkdtemp(prefix='gutils_trace_')
+        self.trace_path = os.path.join(self.tmpdir, 'trace')
+        configure_tracing(self.trace_path)
+
+    def tearDown(self):
+        configure_tracing(None)
+        shutil.rmtree(self.tmpdir)
+
+    def processor(self, watch, folder, extension, outputs=1):
+        return CopyProcessor(
+            watch=watch,
+            outputs_path=os.path.join(self.tmpdir, folder),
+            extension=extension,
+            outputs=outputs
+        )
+
+    def test_trace(self):
+        binary = os.path.join(self.tmpdir, 'binary', 'bass-20160909T1733')
+        safe_makedirs(binary)
+        flight = os.path.join(binary, 'usf-bass-2016-253-0-6.sbd')
+        with open(flight, 'wt') as f:
+            f.write('data')
+        # Arrived a minute ago
+        os.utime(flight, (time.time() - 60, time.time() - 60))
+
+        to_ascii = self.processor('binary_to_ascii', 'ascii', '.dat')
+        to_netcdf = self.processor('ascii_to_netcdf', 'netcdf', '.nc', outputs=3)
+        to_erddap = self.processor('netcdf_to_erddap', 'erddap', '.xml')
+
+        for a in to_ascii.handle(PathEvent.from_path(flight)):
+            for n in to_netcdf.handle(PathEvent.from_path(a)):
+                to_erddap.handle(PathEvent.from_path(n))
+
+        spans = read_spans(os.path.join(self.trace_path, 'spans.jsonl'))
+        # Arrival, binary, ascii and three erddap spans
+        assert len(spans) == 6
+        assert len(set(s['trace'] for s in spans)) == 1
+        assert spans[0]['stage'] == 'arrival'
+        assert spans[0]['file'] == 'bass-20160909T1733/usf-bass-2016-253-0-6.sbd'
+
+        report = trace_report(spans)
+        assert report['traces'] == 1
+        assert list(report['stages'].keys()) == [
+            'binary_to_ascii', 'ascii_to_netcdf', 'netcdf_to_erddap'
+        ]
+        assert report['stages']['netcdf_to_erddap']['traces'] == 1
+        assert report['stages']['binary_to_ascii']['since_arrival']['max'] >= 59
+        assert report['end_to_end']['max'] == \
+            report['stages']['netcdf_to_erddap']['since_arrival']['max']
+
+    def test_untraced_file_starts_a_trace(self):
+        to_netcdf = self.processor('ascii_to_netcdf', 'netcdf', '.nc')
+        for name in ['a.dat', 'b.dat']:
+            p = os.path.join(self.tmpdir, 'ascii', 'glider', name)
+            safe_makedirs(os.path.dirname(p))
+            with open(p, 'wt') as f:
+                f.write('data')
+            to_netcdf.handle(PathEvent.from_path(p))
+
+        spans = read_spans(os.path.join(self.trace_path, 'spans.jsonl'))
+        assert len(set(s['trace'] for s in spans)) == 2
+        assert trace_report(spans)['traces'] == 2
@@ -2,6 +2,8 @@
 # coding=utf-8
 import os
 
+import numpy as np
+
 from gutils import get_decimal_degrees, interpolate_gps, masked_epoch
 
 from gutils.yo import (
@@ -18,7 +20,9 @@ from gutils.filters import (
 
 from gutils.ctd import (
     calculate_practical_salinity,
-    calculate_density
+    calculate_density,
+    compacted,
+    practical_salinity
 )
 
 from gutils.slocum import SlocumReader
@@ -250,6 +254,27 @@ class TestSalinity(GutilsTestClass):
         )
         assert sr.data.sci_m_present_time.size == salinity.size
 
+    def test_compacted_salinity(self):
+        sr = SlocumReader(ctd_filepath)
+        inputs = [
+            sr.data.sci_water_cond.values,
+            sr.data.sci_water_temp.values,
+            sr.data.sci_water_pressure.values,
+        ]
+        expected = calculate_practical_salinity(sr.data.sci_m_present_time, *inputs)
+
+        salinity = compacted(practical_salinity, inputs)
+        np.testing.assert_array_equal(salinity, expected)
+
+        # Chunks on a pool of threads give the same results
+        threaded = compacted(practical_salinity, inputs, threads=3, chunk_size=10)
+        np.testing.assert_array_equal(threaded, expected)
+
+        with self.assertRaises(ValueError):
+            compacted(practical_salinity, inputs[:2] + [np.full(inputs[0].size, np.nan)])
+        with self.assertRaises(IndexError):
+            compacted(practical_salinity, [ i[:1] for i in inputs ])
+
 
 class TestDensity(GutilsTestClass):
 
@@ -3,20 +3,31 @@
 import os
 import time
 import shutil
+import socket
+import threading
 from glob import glob
 
+import netCDF4 as nc4
 from pyinotify import (
     IN_CLOSE_WRITE,
     IN_MOVED_TO,
     ThreadedNotifier,
     WatchManager
 )
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+from pyftpdlib.authorizers import DummyAuthorizer
 
 from gutils import safe_makedirs
-from gutils.slocum import SlocumMerger
+from gutils.ledger import Ledger
+from gutils.nc import create_dataset
+from gutils.slocum import SlocumMerger, SlocumReader
+from gutils.watch import GutilsProcessEvent, PathEvent, ReaderEvent
 from gutils.watch.binary import Slocum2AsciiProcessor
 from gutils.watch.ascii import Slocum2NetcdfProcessor
-from gutils.watch.netcdf import Netcdf2ErddapProcessor
+from gutils.watch.ftp import FtpPool, UploadManifest, UploadQueue
+from gutils.watch.netcdf import Netcdf2ErddapProcessor, Netcdf2FtpProcessor
+from gutils.watch.pipeline import Pipeline, PipelineBinaryProcessor, PipelineProcessor
 from gutils.tests import resource, output, GutilsTestClass
 
 import logging
@@ -170,8 +181,508 @@ class TestWatchClasses(GutilsTestClass):
         dummy_netcdf = os.path.join(netcdf_path, 'profile.nc')
         shutil.copy(orig_netcdf, dummy_netcdf)
 
-        wait_for_files(erddap_content_path, 1)
+        # datasets.xml and the datasets.d fragments folder
+        wait_for_files(erddap_content_path, 2)
         wait_for_files(erddap_flag_path, 1)
 
         wm.rm_watch(wdd.values(), rec=True)
         notifier.stop()
+
+    def test_gutils_pipeline_watch(self):
+
+        wm = WatchManager()
+        mask = IN_MOVED_TO | IN_CLOSE_WRITE
+
+        binary = PipelineBinaryProcessor(
+            outputs_path=os.path.dirname(ascii_path)
+        )
+        pipeline = Pipeline(
+            binary=binary,
+            netcdf=Slocum2NetcdfProcessor(
+                outputs_path=os.path.dirname(netcdf_path),
+                configs_path=os.path.dirname(config_path),
+                subset=False,
+                template='trajectory',
+                profile_id_type=1,
+                tsint=10,
+                filter_distance=1,
+                filter_points=5,
+                filter_time=10,
+                filter_z=1
+            ),
+            erddap=Netcdf2ErddapProcessor(
+                outputs_path=os.path.dirname(netcdf_path),
+                erddap_content_path=erddap_content_path,
+                erddap_flag_path=erddap_flag_path
+            ),
+            workers=dict(netcdf=2)
+        )
+        pipeline.start()
+
+        processor = PipelineProcessor(pipeline=pipeline, binary=binary)
+        notifier = ThreadedNotifier(wm, processor)
+        notifier.coalesce_events()
+        notifier.start()
+
+        wdd = wm.add_watch(
+            binary_path,
+            mask,
+            rec=True,
+            auto_add=True
+        )
+
+        # Wait 5 seconds for the watch to start
+        time.sleep(5)
+
+        gpath = os.path.join(original_binary, '*.*bd')
+        # Sort the files so the .cac files are generated in the right order
+        for g in sorted(glob(gpath)):
+            shutil.copy2(g, binary_path)
+
+        wait_for_files(ascii_path, 32)
+        # datasets.xml and the datasets.d fragments folder
+        wait_for_files(erddap_content_path, 2)
+        wait_for_files(erddap_flag_path, 1)
+
+        wm.rm_watch(wdd.values(), rec=True)
+        notifier.stop()
+        pipeline.stop()
+
+        assert len(os.listdir(netcdf_path)) > 0
+
+
+class RecordingProcessor(GutilsProcessEvent):
+
+    def my_init(self, ledger=None, failing=None):
+        self.ledger = ledger
+        self.processed = []
+        self.failing = failing or []
+
+    def valid_file(self, name):
+        return name.endswith('.dat')
+
+    def process_file(self, event):
+        self.processed.append(event.pathname)
+        if os.path.basename(event.pathname) in self.failing:
+            raise ValueError('Could not process {}'.format(event.pathname))
+        return [event.pathname + '.out']
+
+
+class TestLedger(GutilsTestClass):
+
+    def setUp(self):
+        super(TestLedger, self).setUp()
+        self.data_path = output('ledger', 'data')
+        self.ledger_path = output('ledger', 'state', 'test.sqlite')
+        safe_makedirs(os.path.join(self.data_path, 'glider'))
+
+    def tearDown(self):
+        shutil.rmtree(output())
+
+    def write(self, *args, **kwargs):
+        p = os.path.join(self.data_path, *args)
+        with open(p, 'wt') as f:
+            f.write(kwargs.get('content', 'data'))
+        return p
+
+    def test_catch_up(self):
+        a = self.write('a.dat')
+        b = self.write('b.dat')
+        self.write('c.txt')
+
+        processor = RecordingProcessor(ledger=Ledger(self.ledger_path))
+        assert processor.catch_up(self.data_path) == [a, b]
+        assert processor.processed == [a, b]
+        assert processor.ledger.get(a)['result'] == 'processed'
+        assert processor.ledger.get(a)['outputs'] == [a + '.out']
+
+        # Nothing to do when restarting without changes
+        restarted = RecordingProcessor(ledger=Ledger(self.ledger_path))
+        assert restarted.catch_up(self.data_path) == []
+
+        # Only the changed and new files are processed
+        b = self.write('b.dat', content='more data')
+        d = self.write('glider', 'd.dat')
+        restarted = RecordingProcessor(ledger=Ledger(self.ledger_path))
+        assert restarted.catch_up(self.data_path) == [b, d]
+        assert restarted.processed == [b, d]
+
+    def test_failed_files_are_retried(self):
+        a = self.write('a.dat')
+        b = self.write('b.dat')
+
+        processor = RecordingProcessor(ledger=Ledger(self.ledger_path), failing=['b.dat'])
+        assert processor.catch_up(self.data_path) == [a, b]
+        assert processor.ledger.get(b)['result'] == 'failed'
+
+        restarted = RecordingProcessor(ledger=Ledger(self.ledger_path))
+        assert restarted.catch_up(self.data_path) == [b]
+        assert restarted.ledger.get(b)['result'] == 'processed'
+
+    def test_catch_up_can_be_interrupted(self):
+        a = self.write('a.dat')
+        self.write('b.dat')
+
+        class Interrupted(RecordingProcessor):
+            def process_file(self, event):
+                self.processed.append(event.pathname)
+                raise KeyboardInterrupt()
+
+        processor = Interrupted(ledger=Ledger(self.ledger_path))
+        with self.assertRaises(KeyboardInterrupt):
+            processor.catch_up(self.data_path)
+        assert processor.processed == [a]
+
+    def test_missing_config_is_retried(self):
+        deployment = os.path.basename(config_path)
+        safe_makedirs(os.path.join(self.data_path, deployment))
+        ascii_file = os.path.join(self.data_path, deployment, 'usf_bass_2016_253_0_6_sbd.dat')
+        shutil.copy(resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat'), ascii_file)
+        configs = output('ledger', 'config')
+        safe_makedirs(configs)
+
+        def processor():
+            return Slocum2NetcdfProcessor(
+                outputs_path=output('ledger', 'netcdf'),
+                configs_path=configs,
+                subset=False,
+                template='trajectory',
+                profile_id_type=1,
+                ledger=Ledger(self.ledger_path),
+                tsint=10,
+                filter_distance=1,
+                filter_points=5,
+                filter_time=10,
+                filter_z=1
+            )
+
+        # The deployment's config has not arrived yet
+        first = processor()
+        assert first.catch_up(self.data_path) == [ascii_file]
+        assert first.ledger.get(ascii_file)['result'] == 'failed'
+
+        shutil.copytree(config_path, os.path.join(configs, deployment))
+        restarted = processor()
+        assert restarted.catch_up(self.data_path) == [ascii_file]
+        assert restarted.ledger.get(ascii_file)['result'] == 'processed'
+        assert len(restarted.ledger.get(ascii_file)['outputs']) == 32
+
+    def test_binary_segments(self):
+        a = self.write('a.sbd')
+        a_science = self.write('a.tbd')
+        b = self.write('b.SBD')
+        self.write('c.tbd')
+
+        ledger = Ledger(self.ledger_path)
+        processor = Slocum2AsciiProcessor(outputs_path=output('ledger', 'ascii'), ledger=ledger)
+        # Each segment once, by its flight file
+        assert sorted(processor.pending(self.data_path)) == [a, b]
+
+        # Converting the flight file records its science file too
+        processor.record(PathEvent.from_path(a), 'processed', ['a.dat'])
+        assert ledger.get(a_science)['outputs'] == ['a.dat']
+        assert processor.pending(self.data_path) == [b]
+
+        # A changed science file converts the segment again
+        self.write('a.tbd', content='more data')
+        assert sorted(processor.pending(self.data_path)) == [a, b]
+
+    def test_events_are_recorded(self):
+        ledger = Ledger(self.ledger_path)
+        processor = RecordingProcessor(ledger=ledger)
+
+        a = self.write('a.dat')
+        processor.process_IN_CLOSE(PathEvent.from_path(a))
+        assert processor.processed == [a]
+        assert ledger.get(a)['outputs'] == [a + '.out']
+        assert ledger.scan(self.data_path, valid=processor.valid_file) == []
+
+
+class RecordingBinaryProcessor(PipelineBinaryProcessor):
+
+    def convert_to_ascii(self, event):
+        ascii_file = os.path.join(self.outputs_path, os.path.splitext(event.name)[0] + '.dat')
+        self.emit(ReaderEvent(
+            path=self.outputs_path,
+            name=os.path.basename(ascii_file),
+            pathname=ascii_file,
+            reader=event.name
+        ))
+        return [ascii_file]
+
+
+class TestPipeline(GutilsTestClass):
+
+    def setUp(self):
+        super(TestPipeline, self).setUp()
+        self.data_path = output('pipeline', 'data')
+        safe_makedirs(self.data_path)
+
+    def tearDown(self):
+        shutil.rmtree(output())
+
+    def test_stages_handle_each_segment_once(self):
+        a = os.path.join(self.data_path, 'a.sbd')
+        b = os.path.join(self.data_path, 'b.sbd')
+
+        netcdf = RecordingProcessor()
+        ledger = Ledger(output('pipeline', 'state', 'pipeline.sqlite'))
+        pipeline = Pipeline(
+            binary=RecordingBinaryProcessor(outputs_path=output('pipeline', 'ascii')),
+            netcdf=netcdf,
+            ledger=ledger
+        )
+        for p in [a, a, os.path.join(self.data_path, 'A.SBD'), b]:
+            pipeline.put(PathEvent.from_path(p))
+
+        pipeline.start()
+        pipeline.join()
+        pipeline.stop()
+
+        # Converted once per segment and recorded by the processors
+        assert netcdf.processed == [
+            output('pipeline', 'ascii', 'a.dat'),
+            output('pipeline', 'ascii', 'b.dat')
+        ]
+        assert ledger.get(a)['result'] == 'processed'
+        assert ledger.get(a)['outputs'] == [output('pipeline', 'ascii', 'a.dat')]
+        assert ledger.get(b)['result'] == 'processed'
+
+
+class LoginCountingHandler(FTPHandler):
+    logins = []
+    received = []
+
+    def on_login(self, username):
+        self.logins.append(username)
+
+    def on_file_received(self, file):
+        self.received.append(file)
+
+
+class TestFtpPool(GutilsTestClass):
+
+    def setUp(self):
+        super(TestFtpPool, self).setUp()
+        safe_makedirs(ftp_path)
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('gutils', 'gutils', ftp_path, perm='elradfmw')
+        LoginCountingHandler.authorizer = authorizer
+        LoginCountingHandler.logins = []
+        LoginCountingHandler.received = []
+
+        self.server = FTPServer(('127.0.0.1', 0), LoginCountingHandler)
+        self.ftp_url = '127.0.0.1:{}'.format(self.server.address[1])
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while not self.stopped.is_set():
+            self.server.serve_forever(timeout=0.1, blocking=False)
+        self.server.close_all()
+
+    def tearDown(self):
+        self.stopped.set()
+        self.thread.join()
+        shutil.rmtree(output())
+
+    def processor(self, **kwargs):
+        return Netcdf2FtpProcessor(
+            ftp_url=self.ftp_url,
+            ftp_user='gutils',
+            ftp_pass='gutils',
+            **kwargs
+        )
+
+    def test_sessions_are_reused(self):
+        processor = self.processor()
+        profile = resource('profile.nc')
+
+        remote = processor.upload(profile)
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+
+        assert os.path.isfile(os.path.join(ftp_path, remote))
+        assert len(LoginCountingHandler.logins) == 1
+
+    def test_reconnect(self):
+        processor = self.processor()
+        profile = resource('profile.nc')
+        remote = processor.upload(profile)
+        # Send the same file again
+        processor.manifest.forget(remote)
+
+        # Drop the connection out from under the pool
+        with processor.pool.session() as s:
+            s.ftp.sock.shutdown(socket.SHUT_RDWR)
+
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+        assert len(LoginCountingHandler.logins) == 2
+
+    def test_keepalive(self):
+        pool = FtpPool(self.ftp_url, 'gutils', 'gutils', size=2, keepalive=1)
+
+        def pwd(session):
+            return session.ftp.pwd()
+
+        assert pool.run(pwd) == '/'
+        with pool.session() as s:
+            before = s.last_used
+        time.sleep(2.5)
+        # The idle session was sent a NOOP by the keepalive thread
+        with pool.session() as s:
+            assert s.last_used > before
+        pool.close()
+        assert len(LoginCountingHandler.logins) == 1
+
+    def test_drain(self):
+        queue_path = output('state', 'ftp_queue.sqlite')
+        processor = self.processor(queue=UploadQueue(queue_path))
+
+        # A file that can't be uploaded, and one that was removed before it was
+        no_id = output('no_id', 'bass_0000000000_20160909T173300Z_rt.nc')
+        safe_makedirs(os.path.dirname(no_id))
+        with nc4.Dataset(no_id, 'w') as ncd:
+            ncd.title = 'No id'
+        missing = output('missing', 'bass_0000000001_20160909T180000Z_rt.nc')
+        processor.scheduler.queue.add(resource('profile.nc'))
+        processor.scheduler.queue.add(no_id)
+        processor.scheduler.queue.add(missing)
+
+        assert processor.scheduler.drain() == 1
+        processor.pool.close()
+        assert os.listdir(ftp_path)
+
+        # The failed upload is still queued after a restart, the removed file is not
+        queue = UploadQueue(queue_path)
+        assert len(queue) == 1
+        assert queue.claim() is None
+        queue.retry_now()
+        assert queue.claim() == no_id
+
+    def test_local_errors_keep_the_connection(self):
+        pool = FtpPool(self.ftp_url, 'gutils', 'gutils')
+
+        def upload(session):
+            with open(output('missing', 'profile.nc'), 'rb') as fp:
+                session.upload('missing', 'profile.nc', fp)
+
+        # A local file error is raised without reconnecting and retrying
+        with self.assertRaises(IOError):
+            pool.run(upload)
+        with pool.session() as s:
+            assert s.connected
+        pool.close()
+        assert len(LoginCountingHandler.logins) == 1
+
+    def test_skip_unchanged(self):
+        manifest = UploadManifest(output('state', 'ftp_manifest.sqlite'))
+        processor = self.processor(manifest=manifest)
+        profile = resource('profile.nc')
+
+        remote = processor.upload(profile)
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+        assert len(LoginCountingHandler.received) == 1
+
+        # Someone removed the file from the server
+        os.remove(os.path.join(ftp_path, remote))
+
+        # Trusting the manifest skips it
+        processor = self.processor(manifest=manifest)
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+        assert len(LoginCountingHandler.received) == 1
+
+        # Verifying against the server sends it again, listing the directory once
+        processor = self.processor(manifest=manifest, verify=True)
+        assert processor.upload(profile) == remote
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+        assert len(LoginCountingHandler.received) == 2
+        assert os.path.isfile(os.path.join(ftp_path, remote))
+
+    def test_skip_regenerated(self):
+        def create():
+            create_dataset(
+                file=resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat'),
+                reader_class=SlocumReader,
+                config_path=config_path,
+                output_path=netcdf_path,
+                subset=False,
+                template='trajectory',
+                profile_id_type=1,
+                tsint=10,
+                filter_distance=1,
+                filter_points=5,
+                filter_time=10,
+                filter_z=1
+            )
+            return sorted(glob(os.path.join(netcdf_path, '*.nc')))[0]
+
+        def date_created(profile):
+            with nc4.Dataset(profile) as ncd:
+                return ncd.date_created
+
+        processor = self.processor(manifest=UploadManifest(output('state', 'ftp_manifest.sqlite')))
+        profile = create()
+        created = date_created(profile)
+        remote = processor.upload(profile)
+
+        # Reprocessing writes the same profile again with new creation attributes
+        time.sleep(1)
+        assert create() == profile
+        assert date_created(profile) != created
+        assert processor.upload(profile) == remote
+        processor.pool.close()
+        assert len(LoginCountingHandler.received) == 1
+
+    def test_unreadable_files_fail(self):
+        ledger = Ledger(output('state', 'ftp.sqlite'))
+        processor = self.processor(ledger=ledger)
+
+        no_id = output('no_id', 'bass_0000000000_20160909T173300Z_rt.nc')
+        safe_makedirs(os.path.dirname(no_id))
+        with nc4.Dataset(no_id, 'w') as ncd:
+            ncd.title = 'No id'
+        not_netcdf = output('not_netcdf', 'bass_0000000001_20160909T180000Z_rt.nc')
+        safe_makedirs(os.path.dirname(not_netcdf))
+        with open(not_netcdf, 'w') as f:
+            f.write('not a netCDF file')
+
+        # Recorded as failed instead of raising out of the notifier
+        for p in [no_id, not_netcdf]:
+            assert processor.handle(PathEvent.from_path(p)) == []
+            assert ledger.get(p)['result'] == 'failed'
+        assert len(processor.scheduler.queue) == 0
+        processor.pool.close()
+
+
+class TestUploadQueue(GutilsTestClass):
+
+    def test_order_and_backoff(self):
+        queue = UploadQueue(backoff=10, max_backoff=25)
+        later = '/data/bass_0000000002_20160909T180000Z_rt.nc'
+        earlier = '/data/bass_0000000001_20160909T170000Z_rt.nc'
+        queue.add(later)
+        queue.add(earlier)
+
+        # Oldest profile first, and never the same file twice
+        assert queue.claim() == earlier
+        assert queue.claim() == later
+        assert queue.claim() is None
+
+        assert queue.failed(earlier) == 10
+        queue.done(later)
+        assert queue.claim() is None
+        assert queue.claim(now=time.time() + 11) == earlier
+
+        assert queue.failed(earlier) == 20
+        claimed = queue.claim(now=time.time() + 21)
+        assert claimed == earlier
+        assert queue.failed(earlier) == 25
+        assert len(queue) == 1
@@ -0,0 +1,79 @@
+#!python
+# coding=utf-8
+import numpy as np
+import pandas as pd
+
+from gutils.filters import process_dataset
+from gutils.profile_adjust import reassign_profile_id
+from gutils.slocum import SlocumReader
+from gutils.tests import GutilsTestClass, resource
+from gutils.yo import (
+    assign_profiles,
+    assign_profiles_native,
+    compare_profile_boundaries,
+    get_detector
+)
+
+import logging
+L = logging.getLogger(__name__)  # noqa
+
+FILTERS = dict(filter_z=1, filter_points=5, filter_time=10, filter_distance=1)
+
+
+class TestNativeDetector(GutilsTestClass):
+
+    def setUp(self):
+        super(TestNativeDetector, self).setUp()
+        self.file = resource('slocum', 'usf_bass_2016_253_0_6_sbd.dat')
+
+    def test_matches_interpolated(self):
+        data = SlocumReader(self.file).standardize()
+        interpolated = reassign_profile_id(assign_profiles(data, tsint=2))
+        native = reassign_profile_id(assign_profiles_native(data, tsint=2))
+
+        comparison = compare_profile_boundaries(interpolated, native, tolerance=10)
+        assert comparison['profiles_a'] == comparison['profiles_b']
+        assert comparison['matched'] == comparison['profiles_a']
+        assert comparison['max_offset'] <= 10
+
+        processed, _ = process_dataset(self.file, SlocumReader, detector='native', **FILTERS)
+        expected, _ = process_dataset(self.file, SlocumReader, **FILTERS)
+        assert processed.profile.nunique() == expected.profile.nunique() == 32
+
+    def test_sparse_and_untimed_rows(self):
+        # Depths every 10 seconds over two yos, with rows in between without depths
+        t = np.arange(0, 1200, 5.)
+        z = 1 + 49 * (1 - np.abs((t / 300.) % 2 - 1))
+        z[1::2] = np.nan
+        df = pd.DataFrame({'t': pd.to_datetime(t, unit='s'), 'z': z})
+        df.loc[100, 't'] = pd.NaT
+
+        profiles = assign_profiles_native(df, tsint=2)
+        starts = profiles.groupby('profile').t.min()
+        assert len(starts) == 4
+        seconds = starts.iloc[1:].values.astype('int64') // 10 ** 9
+        assert (np.abs(seconds - [300, 600, 900]) <= 10).all()
+        # Rows without a time join the profile of the row before
+        assert profiles.profile[100] == profiles.profile[99]
+
+        assert assign_profiles_native(df.iloc[:1], tsint=2) is None
+
+    def test_single_dive(self):
+        t = np.arange(0, 600, 5.)
+        for z in [1 + t / 10., np.full(t.size, 10.)]:
+            df = pd.DataFrame({'t': pd.to_datetime(t, unit='s'), 'z': z})
+            interpolated = assign_profiles(df, tsint=2)
+            native = assign_profiles_native(df, tsint=2)
+
+            # Every row is in a single profile
+            for profiles in [interpolated, native]:
+                assert profiles.profile.notnull().all()
+                assert profiles.profile.nunique() == 1
+
+            comparison = compare_profile_boundaries(interpolated, native, tolerance=10)
+            assert comparison['profiles_a'] == comparison['profiles_b'] == comparison['matched'] == 1
+
+    def test_unknown_detector(self):
+        assert get_detector(None) is assign_profiles
+        with self.assertRaises(ValueError):
+            get_detector('grid')
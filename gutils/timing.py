@@ -0,0 +1,281 @@
+#!python
+# coding=utf-8
+""" Wall time, CPU time and memory of each processing stage of a file.
+
+`file_timings(name)` collects the stages run for one file and reports them when the file
+is done, as a single INFO log record with the summary as JSON (also attached to the
+record as `record.timings`) and, when GUTILS_TIMINGS_FILE is set, as a line appended to
+that file. Code further down only has to wrap its work in `stage(name)`, which does
+nothing when no file is being timed.
+
+Environment variables:
+
+* GUTILS_TIMINGS - set to 0 to turn the timings off
+* GUTILS_TIMINGS_FILE - JSON lines file to append the summary of every file to
+* GUTILS_TRACEMALLOC - set to 1 to also record the peak memory allocated by Python in
+  each stage. This slows processing down, peak RSS is always recorded.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+try:
+    process_time = time.process_time
+except AttributeError:  # Python 2
+    process_time = time.clock
+
+import logging
+L = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Called with the summary of every reported file, ie. to export the stages as metrics
+listeners = []
+
+
+def env_flag(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+def rss_peak():
+    """ Peak resident set size of this process in MB """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak / 1024. / 1024.
+    return peak / 1024.
+
+
+def tracing():
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def traced_peak():
+    return tracemalloc.get_traced_memory()[1] / 1024. / 1024.
+
+
+def reset_traced_peak():
+    # Python < 3.9 can't reset the peak so stages report the peak of the file so far
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+
+class Stage(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.
+        self.cpu = 0.
+        self.rss_peak = None
+        self.rss_growth = None
+        self.traced_peak = None
+
+    def as_dict(self):
+        d = OrderedDict([
+            ('calls', self.calls),
+            ('wall', round(self.wall, 6)),
+            ('cpu', round(self.cpu, 6)),
+        ])
+        if self.rss_peak is not None:
+            d['rss_peak_mb'] = round(self.rss_peak, 3)
+            d['rss_growth_mb'] = round(self.rss_growth, 3)
+        if self.traced_peak is not None:
+            d['traced_peak_mb'] = round(self.traced_peak, 3)
+        return d
+
+
+class Timings(object):
+    """ The stages run for one file. Stages run inside other stages are named
+    `outer.inner` and stages run more than once are added up.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.info = OrderedDict()
+        self.stages = OrderedDict()
+        self.failed = False
+        self.deferred = False
+        self._stack = []
+        self._started = datetime.utcnow()
+        self._wall = time.time()
+
+    @contextmanager
+    def activate(self):
+        """ Makes this the Timings that `stage` and `annotate` record into on this thread """
+        previous = getattr(_local, 'timings', None)
+        _local.timings = self
+        try:
+            yield self
+        finally:
+            _local.timings = previous
+
+    @contextmanager
+    def stage(self, name):
+        name = '.'.join([ s for s, _ in self._stack ] + [name])
+        frame = dict(traced_peak=0.)
+        traced = tracing()
+        if traced:
+            if self._stack:
+                parent = self._stack[-1][1]
+                parent['traced_peak'] = max(parent['traced_peak'], traced_peak())
+            reset_traced_peak()
+
+        rss_before = rss_peak()
+        wall = time.time()
+        cpu = process_time()
+        self._stack.append((name.split('.')[-1], frame))
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            s = self.stages.setdefault(name, Stage())
+            s.calls += 1
+            s.wall += time.time() - wall
+            s.cpu += process_time() - cpu
+
+            rss_after = rss_peak()
+            if rss_after is not None:
+                s.rss_peak = rss_after
+                s.rss_growth = (s.rss_growth or 0.) + rss_after - rss_before
+
+            if traced:
+                frame['traced_peak'] = max(frame['traced_peak'], traced_peak())
+                s.traced_peak = max(s.traced_peak or 0., frame['traced_peak'])
+                if self._stack:
+                    parent = self._stack[-1][1]
+                    parent['traced_peak'] = max(parent['traced_peak'], frame['traced_peak'])
+
+    def summary(self):
+        d = OrderedDict([
+            ('file', self.name),
+            ('started', self._started.isoformat()),
+            ('pid', os.getpid()),
+            ('failed', self.failed),
+            ('wall', round(time.time() - self._wall, 6)),
+            # Added up from the stages because a file can be finished in another process
+            ('cpu', round(sum(v.cpu for k, v in self.stages.items() if '.' not in k), 6)),
+        ])
+        peak = rss_peak()
+        if peak is not None:
+            d['rss_peak_mb'] = round(peak, 3)
+        d.update(self.info)
+        d['stages'] = OrderedDict([ (k, v.as_dict()) for k, v in self.stages.items() ])
+        return d
+
+    def report(self):
+        summary = self.summary()
+        serialized = json.dumps(summary, default=str)
+
+        L.info(
+            "Timings for {}: {}".format(self.name, serialized),
+            extra={'timings': summary}
+        )
+
+        path = os.environ.get('GUTILS_TIMINGS_FILE')
+        if path:
+            try:
+                # One write per line so processes appending to the same file don't interleave
+                with open(path, 'a') as f:
+                    f.write(serialized + '\n')
+            except (IOError, OSError) as e:
+                L.warning("Could not write timings to {}: {}".format(path, e))
+
+        for listener in listeners:
+            try:
+                listener(summary)
+            except Exception:
+                L.exception("Could not pass the timings of {} to {}".format(self.name, listener))
+
+        return summary
+
+
+def current():
+    """ The Timings being recorded on this thread, or None """
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def stage(name):
+    """ Records the time spent in the block as stage `name` of the current file """
+    timings = current()
+    if timings is None:
+        yield
+    else:
+        with timings.stage(name):
+            yield
+
+
+def annotate(**kwargs):
+    """ Adds values like the number of rows to the summary of the current file """
+    timings = current()
+    if timings is not None:
+        timings.info.update(kwargs)
+
+
+def defer():
+    """ Hands the current Timings over to be finished and reported somewhere else, ie. in
+    the parent of a worker process. Returns it so it can be passed on to `file_timings`.
+    """
+    timings = current()
+    if timings is not None:
+        timings.deferred = True
+    return timings
+
+
+def start_timings(name):
+    """ A new Timings for the file `name`, or None when the timings are turned off """
+    if not env_flag('GUTILS_TIMINGS', True):
+        return None
+    if env_flag('GUTILS_TRACEMALLOC', False) and tracemalloc is not None \
+            and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    return Timings(name)
+
+
+@contextmanager
+def file_timings(name, timings=None):
+    """ Times the stages run for the file `name` and reports them at the end of the block.
+    Inside the block of another file the stages are added to that file instead. Pass the
+    Timings of a file started elsewhere (ie. in a worker process) as `timings` to finish
+    and report it here.
+    """
+    if timings is None:
+        if current() is not None:
+            yield current()
+            return
+        timings = start_timings(name)
+        if timings is None:
+            yield None
+            return
+    else:
+        timings.deferred = False
+
+    with timings.activate():
+        try:
+            yield timings
+        except BaseException:
+            timings.failed = True
+            raise
+        finally:
+            if not timings.deferred:
+                timings.report()
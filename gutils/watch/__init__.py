@@ -0,0 +1,122 @@
+#!python
+# coding=utf-8
+import os
+import time
+from collections import namedtuple
+
+from pyinotify import ProcessEvent
+
+from gutils.profiling import profiled
+from gutils.watch.metrics import EVENTS, FILES, PROCESSING, observe_output
+from gutils.watch.trace import traced
+
+import logging
+L = logging.getLogger(__name__)
+
+
+class PathEvent(namedtuple('PathEvent', ['path', 'name', 'pathname'])):
+    """ Stand-in for a pyinotify Event when a file is processed outside of the notifier """
+
+    @classmethod
+    def from_path(cls, pathname):
+        return cls(
+            path=os.path.dirname(pathname),
+            name=os.path.basename(pathname),
+            pathname=pathname
+        )
+
+
+class ReaderEvent(namedtuple('ReaderEvent', ['path', 'name', 'pathname', 'reader'])):
+    """ A PathEvent for an ASCII file that was already read into `reader` """
+
+
+class GutilsProcessEvent(ProcessEvent):
+    """ Base class for the GUTILS watch processors.
+
+    Subclasses implement `valid_file(name)` and `process_file(event)`, which returns the
+    list of files that were produced. Any other return value (None, or the non-zero exit
+    code of a command) means the file could not be processed and it is recorded as failed
+    so it is retried by `catch_up`. When a `ledger` is set every handled file is
+    recorded in it so a restarted watch can catch up on the files it missed. `watch` names
+    the watch in its metrics.
+    """
+
+    ledger = None
+    watch = 'watch'
+
+    def process_IN_CLOSE(self, event):
+        EVENTS.inc(watch=self.watch)
+        self.handle(event)
+
+    def process_IN_MOVED_TO(self, event):
+        EVENTS.inc(watch=self.watch)
+        self.handle(event)
+
+    def handle(self, event):
+        if not self.valid_file(event.name):
+            return
+
+        start = time.time()
+        try:
+            with profiled(event.pathname), traced(self.watch, event.pathname) as span:
+                outputs = self.process_file(event)
+                if isinstance(outputs, (list, tuple)):
+                    span.outputs = outputs
+        except BaseException:
+            PROCESSING.observe(time.time() - start, watch=self.watch)
+            self.record(event, 'failed')
+            raise
+        PROCESSING.observe(time.time() - start, watch=self.watch)
+
+        if not isinstance(outputs, (list, tuple)):
+            self.record(event, 'failed')
+            return []
+        self.record(event, 'processed', outputs)
+        if outputs:
+            self.observe_outputs(event)
+        return outputs
+
+    def observe_outputs(self, event):
+        """ Called once the outputs of `event` were produced """
+        observe_output(self.watch, event.pathname)
+
+    def record(self, event, result, outputs=None):
+        FILES.inc(watch=self.watch, result=result)
+        if self.ledger is not None:
+            for p in self.ledger_paths(event):
+                self.ledger.record(p, result, outputs)
+
+    def ledger_paths(self, event):
+        """ The files recorded in the ledger when `event` is processed """
+        return [event.pathname]
+
+    def pending(self, root):
+        """ The files below `root` that were not processed successfully or have changed
+        since they were
+        """
+        return self.ledger.scan(root, valid=self.valid_file)
+
+    def sort_key(self, pathname):
+        return os.path.basename(pathname)
+
+    def catch_up(self, root):
+        """ Processes every valid file below `root` that is missing from the ledger, failed
+        or has changed since it was recorded. Called on startup before the notifier loop begins.
+        """
+        if self.ledger is None:
+            return []
+
+        pending = sorted(
+            self.pending(root),
+            key=lambda p: (os.path.dirname(p), self.sort_key(p))
+        )
+        if pending:
+            L.info("Catching up on {} files in {}".format(len(pending), root))
+
+        for p in pending:
+            try:
+                self.handle(PathEvent.from_path(p))
+            except Exception:
+                L.exception("Could not process {} while catching up".format(p))
+
+        return pending
@@ -9,21 +9,32 @@ from pyinotify import (
     IN_MOVED_TO,
     Notifier,
     NotifierError,
-    ProcessEvent,
     WatchManager
 )
 
-from gutils import setup_cli_logger
-from gutils.nc import create_dataset
-from gutils.slocum import SlocumReader
+from gutils import add_detector_argument, setup_cli_logger
+from gutils.ledger import stage_ledger
+from gutils.profiling import add_profile_arguments, configure_profiling
+from gutils.timing import env_flag
+from gutils.watch import GutilsProcessEvent
+from gutils.watch.metrics import add_metrics_arguments, report_queue_depth, serve_metrics
+from gutils.watch.trace import add_trace_arguments, configure_tracing
 
 import logging
 L = logging.getLogger(__name__)
 
 
-class Ascii2NetcdfProcessor(ProcessEvent):
+class Ascii2NetcdfProcessor(GutilsProcessEvent):
 
-    def my_init(self, outputs_path, configs_path, subset, template, profile_id_type, **filters):
+    watch = 'ascii_to_netcdf'
+
+    def my_init(self, outputs_path, configs_path, subset, template, profile_id_type, ledger=None,
+                profile_state_path=None, gps_index_path=None, **filters):
+        self.ledger = ledger
+        # Continue profiles across segments with the per-glider state kept in this folder
+        self.profile_state_path = profile_state_path
+        # Interpolate positions with the per-deployment GPS fixes kept in this folder
+        self.gps_index_path = gps_index_path
         self.outputs_path = outputs_path
         self.configs_path = configs_path
         self.subset = subset
@@ -37,13 +48,8 @@ class Ascii2NetcdfProcessor(ProcessEvent):
             return True
         return False
 
-    def process_IN_CLOSE(self, event):
-        if self.valid_file(event.name):
-            self.convert_to_netcdf(event)
-
-    def process_IN_MOVED_TO(self, event):
-        if self.valid_file(event.name):
-            self.convert_to_netcdf(event)
+    def process_file(self, event):
+        return self.convert_to_netcdf(event)
 
 
 class Slocum2NetcdfProcessor(Ascii2NetcdfProcessor):
@@ -54,7 +60,14 @@ class Slocum2NetcdfProcessor(Ascii2NetcdfProcessor):
         super(Slocum2NetcdfProcessor, self).my_init(*args, **kwargs)
 
     def convert_to_netcdf(self, event):
-        glider_folder_name = os.path.basename(event.path)
+        # A ReaderEvent carries the already read ASCII file
+        return self.create_netcdf(
+            os.path.basename(event.path),
+            getattr(event, 'reader', event.pathname)
+        )
+
+    def create_netcdf(self, glider_folder_name, file):
+        """ `file` is the path to an ASCII file or an already read SlocumReader """
         glider_config_folder = os.path.join(self.configs_path, glider_folder_name)
         if not os.path.isdir(glider_config_folder):
             L.error("Config folder {} not found!".format(glider_config_folder))
@@ -62,18 +75,46 @@ class Slocum2NetcdfProcessor(Ascii2NetcdfProcessor):
 
         glider_output_folder = os.path.join(self.outputs_path, glider_folder_name)
 
-        create_dataset(
-            file=event.pathname,
+        from gutils.nc import create_dataset
+        from gutils.slocum import SlocumReader
+        from gutils.gps import deployment_gps_index
+        from gutils.profile_state import glider_profile_state
+        return create_dataset(
+            file=file,
             reader_class=SlocumReader,
             config_path=glider_config_folder,
             output_path=glider_output_folder,
             subset=self.subset,
             template=self.template,
             profile_id_type=self.profile_id_type,
+            profile_state=glider_profile_state(self.profile_state_path, glider_folder_name),
+            gps_index=deployment_gps_index(self.gps_index_path, glider_folder_name),
             **self.filters
         )
 
 
+def add_incremental_profiles_argument(parser):
+    parser.add_argument(
+        "--incremental_profiles",
+        help="Continue the last profile of each segment into the next segment of the glider "
+             "instead of processing segments on their own. Needs --state_path.",
+        action='store_true',
+        default=env_flag('GUTILS_INCREMENTAL_PROFILES', False)
+    )
+    return parser
+
+
+def add_gps_index_argument(parser):
+    parser.add_argument(
+        "--gps_index",
+        help="Interpolate positions between the GPS fixes of the whole deployment, kept "
+             "in --state_path, instead of only the fixes in each file. Needs --state_path.",
+        action='store_true',
+        default=env_flag('GUTILS_GPS_INDEX', False)
+    )
+    return parser
+
+
 def create_netcdf_arg_parser():
 
     parser = argparse.ArgumentParser(
@@ -124,6 +165,7 @@ def create_netcdf_arg_parser():
         help="Filter out profiles that are not completely below this depth (meters)",
         default=1
     )
+    add_detector_argument(parser)
     parser.add_argument(
         '--no-subset',
         dest='subset',
@@ -143,6 +185,14 @@ def create_netcdf_arg_parser():
         default=os.environ.get('GUTILS_PROFILE_ID_TYPE', 1),
         type=int
     )
+    parser.add_argument(
+        "--state_path",
+        help="Folder to keep a ledger of processed files in. When set, files that arrived "
+             "while the watch was not running are processed on startup.",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
+    add_incremental_profiles_argument(parser)
+    add_gps_index_argument(parser)
     parser.add_argument(
         "--daemonize",
         help="To daemonize or not to daemonize",
@@ -150,6 +200,9 @@ def create_netcdf_arg_parser():
         default=False
     )
     parser.set_defaults(subset=True)
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     return parser
 
@@ -159,6 +212,9 @@ def main_to_netcdf():
 
     parser = create_netcdf_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
+
+    from gutils.slocum import SlocumReader
 
     filter_args = vars(args)
     # Remove non-filter args into positional arguments
@@ -167,8 +223,17 @@ def main_to_netcdf():
     outputs = filter_args.pop('outputs')
     subset = filter_args.pop('subset')
     daemonize = filter_args.pop('daemonize')
+    state_path = filter_args.pop('state_path')
+    incremental_profiles = filter_args.pop('incremental_profiles')
+    gps_index = filter_args.pop('gps_index')
     template = filter_args.pop('template')
     profile_id_type = int(filter_args.pop('profile_id_type'))
+    filter_args.pop('profile')
+    filter_args.pop('profile_keep')
+    filter_args.pop('profile_memory')
+    metrics_port = filter_args.pop('metrics_port')
+    metrics_host = filter_args.pop('metrics_host')
+    trace_path = filter_args.pop('trace_path')
 
     # Move reader_class to a class
     reader_class = filter_args.pop('reader_class')
@@ -180,6 +245,17 @@ def main_to_netcdf():
                 "GUTILS_ASCII_DIRECTORY environmental variable")
         sys.exit(parser.print_usage())
 
+    if incremental_profiles is True and not state_path:
+        L.error("--incremental_profiles needs a --state_path to keep the open profiles in")
+        sys.exit(parser.print_usage())
+
+    if gps_index is True and not state_path:
+        L.error("--gps_index needs a --state_path to keep the GPS fixes in")
+        sys.exit(parser.print_usage())
+
+    serve_metrics(metrics_port, metrics_host)
+    configure_tracing(trace_path)
+
     # Add inotify watch
     wm = WatchManager()
     mask = IN_MOVED_TO | IN_CLOSE_WRITE
@@ -198,12 +274,19 @@ def main_to_netcdf():
             subset=subset,
             template=template,
             profile_id_type=profile_id_type,
+            ledger=stage_ledger(state_path, 'ascii_to_netcdf'),
+            profile_state_path=state_path if incremental_profiles is True else None,
+            gps_index_path=state_path if gps_index is True else None,
             **filter_args
         )
+    # Process anything that arrived while we were not watching
+    processor.catch_up(data_path)
+
     notifier = Notifier(wm, processor, read_freq=10)
     # Enable coalescing of events. This merges event types of the same type on the same file
     # together over the `read_freq` specified in the Notifier.
     notifier.coalesce_events()
+    report_queue_depth(notifier, processor)
 
     try:
         L.info("Watching {} and Outputting NetCDF to {}".format(
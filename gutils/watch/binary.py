@@ -9,21 +9,27 @@ from pyinotify import (
     IN_MOVED_TO,
     Notifier,
     NotifierError,
-    ProcessEvent,
     WatchManager
 )
 
 from gutils import setup_cli_logger
-from gutils.slocum import SlocumMerger
+from gutils.ledger import stage_ledger
+from gutils.profiling import add_profile_arguments, configure_profiling
+from gutils.watch import GutilsProcessEvent
+from gutils.watch.metrics import add_metrics_arguments, report_queue_depth, serve_metrics
+from gutils.watch.trace import add_trace_arguments, configure_tracing
 
 import logging
 L = logging.getLogger(__name__)
 
 
-class Binary2AsciiProcessor(ProcessEvent):
+class Binary2AsciiProcessor(GutilsProcessEvent):
 
-    def my_init(self, outputs_path, **kwargs):
+    watch = 'binary_to_ascii'
+
+    def my_init(self, outputs_path, ledger=None, **kwargs):
         self.outputs_path = outputs_path
+        self.ledger = ledger
 
     def valid_file(self, name):
         _, extension = os.path.splitext(name)
@@ -31,13 +37,8 @@ class Binary2AsciiProcessor(ProcessEvent):
             return True
         return False
 
-    def process_IN_CLOSE(self, event):
-        if self.valid_file(event.name):
-            self.convert_to_ascii(event)
-
-    def process_IN_MOVED_TO(self, event):
-        if self.valid_file(event.name):
-            self.convert_to_ascii(event)
+    def process_file(self, event):
+        return self.convert_to_ascii(event)
 
 
 class Slocum2AsciiProcessor(Binary2AsciiProcessor):
@@ -59,6 +60,48 @@ class Slocum2AsciiProcessor(Binary2AsciiProcessor):
     def my_init(self, *args, **kwargs):
         super(Slocum2AsciiProcessor, self).my_init(*args, **kwargs)
 
+    def sort_key(self, pathname):
+        from gutils.slocum import slocum_binary_sorter
+        return slocum_binary_sorter(pathname)
+
+    def segment(self, pathname):
+        """ Names the segment of a binary file, shared by its flight and science files """
+        base_name, _ = os.path.splitext(os.path.basename(pathname))
+        return os.path.join(os.path.dirname(pathname), base_name.lower())
+
+    def flight_file(self, pathname):
+        """ The flight file of the segment of a flight or science file, None if there is
+        no flight file
+        """
+        base_name, extension = os.path.splitext(pathname)
+        if extension.lower() in self.PAIRS:
+            return pathname
+        for flight, science in self.PAIRS.items():
+            if science == extension.lower():
+                for p in [base_name + flight, base_name + flight.upper()]:
+                    if os.path.isfile(p):
+                        return p
+
+    def ledger_paths(self, event):
+        # The science file is converted with the flight file
+        pair = self.check_for_pair(event) or [event.name]
+        return [ os.path.join(event.path, f) for f in pair ]
+
+    def pending(self, root):
+        """ The flight file of each segment below `root` with a flight or science file
+        that was not converted successfully or has changed since it was
+        """
+        def binary_file(name):
+            extension = os.path.splitext(name)[1].lower()
+            return extension in self.PAIRS or extension in self.PAIRS.values()
+
+        segments = {}
+        for p in self.ledger.scan(root, valid=binary_file):
+            flight = self.flight_file(p)
+            if flight is not None:
+                segments.setdefault(self.segment(flight), flight)
+        return list(segments.values())
+
     def check_for_pair(self, event):
 
         base_name, extension = os.path.splitext(event.name)
@@ -75,20 +118,23 @@ class Slocum2AsciiProcessor(Binary2AsciiProcessor):
                 _, file_ext = os.path.splitext(p)
                 return [event.name, base_name + file_ext]
 
-    def convert_to_ascii(self, event):
+    def merger(self, event):
         file_pairs = self.check_for_pair(event)
 
         # Create a folder inside of the output directory for this glider folder name.
         glider_folder_name = os.path.basename(event.path)
         outputs_folder = os.path.join(self.outputs_path, glider_folder_name)
 
-        merger = SlocumMerger(
+        from gutils.slocum import SlocumMerger
+        return SlocumMerger(
             event.path,
             outputs_folder,
             cache_directory=event.path,  # Default the cache directory to the data folder
             globs=file_pairs
         )
-        merger.convert()
+
+    def convert_to_ascii(self, event):
+        return [ p['ascii'] for p in self.merger(event).convert() ]
 
 
 def create_ascii_arg_parser():
@@ -114,12 +160,21 @@ def create_ascii_arg_parser():
         help="Where to place the newly generated ASCII files.",
         default=os.environ.get('GUTILS_ASCII_DIRECTORY')
     )
+    parser.add_argument(
+        "--state_path",
+        help="Folder to keep a ledger of processed files in. When set, files that arrived "
+             "while the watch was not running are processed on startup.",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
     parser.add_argument(
         "--daemonize",
         help="To daemonize or not to daemonize",
         type=bool,
         default=False
     )
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     return parser
 
@@ -129,12 +184,16 @@ def main_to_ascii():
 
     parser = create_ascii_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
 
     if not args.data_path:
         L.error("Please provide a --data_path agrument or set the "
                 "GUTILS_DATA_DIRECTORY environmental variable")
         sys.exit(parser.print_usage())
 
+    serve_metrics(args.metrics_port, args.metrics_host)
+    configure_tracing(args.trace_path)
+
     wm = WatchManager()
     mask = IN_MOVED_TO | IN_CLOSE_WRITE
     wm.add_watch(
@@ -147,12 +206,17 @@ def main_to_ascii():
     # Convert binary data to ASCII
     if args.type == 'slocum':
         processor = Slocum2AsciiProcessor(
-            outputs_path=args.outputs
+            outputs_path=args.outputs,
+            ledger=stage_ledger(args.state_path, 'binary_to_ascii')
         )
+    # Process anything that arrived while we were not watching
+    processor.catch_up(args.data_path)
+
     notifier = Notifier(wm, processor, read_freq=10)  # Read every 10 seconds
     # Enable coalescing of events. This merges event types of the same type on the same file
     # together over the `read_freq` specified in the Notifier.
     notifier.coalesce_events()
+    report_queue_depth(notifier, processor)
 
     try:
         L.info("Watching {} and Outputting ASCII to {}".format(
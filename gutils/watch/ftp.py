@@ -0,0 +1,546 @@
+#!python
+# coding=utf-8
+import os
+import re
+import time
+import socket
+import ftplib
+import posixpath
+import sqlite3
+import calendar
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+from six.moves import queue
+from six.moves.urllib.parse import urlparse
+
+from gutils import safe_makedirs
+
+import logging
+L = logging.getLogger(__name__)
+
+
+try:
+    # socket.error is OSError on Python 3, which would include local file errors
+    SOCKET_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror, socket.herror)
+except NameError:
+    SOCKET_ERRORS = (socket.error,)
+
+# Errors that mean the connection is gone (or was never there) rather than the
+# server refusing a command. Local file errors are not, they don't need a new connection.
+CONNECTION_ERRORS = SOCKET_ERRORS + (EOFError, ftplib.error_temp, ftplib.error_reply, ftplib.error_proto)
+
+
+def parse_ftp_url(ftp_url):
+    """ Returns a (host, port) tuple from 'host', 'host:port' or 'ftp://host:port' """
+    if '://' not in ftp_url:
+        ftp_url = 'ftp://{}'.format(ftp_url)
+    parsed = urlparse(ftp_url)
+    return parsed.hostname, parsed.port or ftplib.FTP_PORT
+
+
+class FtpSession(object):
+    """ A logged in FTP connection that remembers its remote working directory
+    so repeated uploads into the same deployment directory skip the `cwd`.
+    """
+
+    def __init__(self, host, port, user, passwd, timeout=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.ftp = None
+        self.home = None
+        self.directory = None
+        self.last_used = 0
+
+    @property
+    def connected(self):
+        return self.ftp is not None
+
+    def connect(self):
+        self.close()
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        L.debug('Logged into {}:{} as {}'.format(self.host, self.port, self.user))
+        self.ftp = ftp
+        self.home = ftp.pwd()
+        self.directory = None
+        self.last_used = time.time()
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except BaseException:
+                self.ftp.close()
+        self.ftp = None
+        self.directory = None
+
+    def noop(self):
+        self.ftp.voidcmd('NOOP')
+        self.last_used = time.time()
+
+    def check(self, idle=None):
+        """ Makes sure the session is connected, sending a NOOP first if it has been
+        idle for more than `idle` seconds and reconnecting if that fails
+        """
+        if not self.connected:
+            self.connect()
+        elif idle is not None and time.time() - self.last_used > idle:
+            try:
+                self.noop()
+            except CONNECTION_ERRORS:
+                L.info('FTP connection to {} went away, reconnecting'.format(self.host))
+                self.connect()
+
+    def cwd(self, directory):
+        """ Changes into `directory` relative to the login directory, creating it if needed """
+        if directory == self.directory:
+            return
+
+        if self.directory is not None:
+            self.ftp.cwd(self.home)
+        try:
+            self.ftp.cwd(directory)
+        except ftplib.error_perm:
+            self.ftp.mkd(directory)
+            self.ftp.cwd(directory)
+        self.directory = directory
+
+    def upload(self, directory, name, fp):
+        self.cwd(directory)
+        self.ftp.storbinary('STOR {}'.format(name), fp)
+        self.last_used = time.time()
+
+    def sizes(self, directory):
+        """ Returns {name: size} of the files in `directory` from one MLSD listing,
+        or None if the server does not support MLSD
+        """
+        path = posixpath.join(self.home, directory)
+        try:
+            listing = self.ftp.mlsd(path, facts=['type', 'size'])
+            sizes = {
+                name: int(facts['size']) for name, facts in listing
+                if facts.get('type') == 'file' and 'size' in facts
+            }
+        except AttributeError:
+            # No MLSD support in this ftplib
+            return None
+        except ftplib.error_perm as e:
+            if str(e).startswith('550'):
+                # The directory doesn't exist yet
+                return {}
+            return None
+        self.last_used = time.time()
+        return sizes
+
+    def size(self, directory, name):
+        """ Returns the size of a remote file using SIZE, or None if it doesn't exist """
+        try:
+            self.ftp.voidcmd('TYPE I')
+            return self.ftp.size(posixpath.join(self.home, directory, name))
+        except ftplib.error_perm:
+            return None
+        finally:
+            self.last_used = time.time()
+
+
+class FtpPool(object):
+    """ A pool of up to `size` logged in FTP sessions to the same server.
+
+    Idle sessions are kept alive by sending a NOOP every `keepalive` seconds and any
+    session that has gone away is transparently reconnected when it is next used.
+    """
+
+    def __init__(self, ftp_url, user, passwd, size=1, keepalive=60, timeout=60):
+        self.host, self.port = parse_ftp_url(ftp_url)
+        self.user = user
+        self.passwd = passwd
+        self.size = max(int(size or 1), 1)
+        self.keepalive = keepalive
+        self.timeout = timeout
+
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.keepalive_thread = None
+
+    def new_session(self):
+        return FtpSession(self.host, self.port, self.user, self.passwd, timeout=self.timeout)
+
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and self.created < self.size:
+                self.created += 1
+                return self.new_session()
+        return self.idle.get()
+
+    def release(self, session):
+        self.idle.put(session)
+
+    @contextmanager
+    def session(self):
+        """ Yields a connected FtpSession from the pool """
+        s = self.acquire()
+        try:
+            s.check(idle=self.keepalive)
+            yield s
+        except CONNECTION_ERRORS:
+            # Don't hand a broken connection to the next caller
+            s.close()
+            raise
+        finally:
+            self.release(s)
+            self.start_keepalive()
+
+    def run(self, func):
+        """ Calls `func(session)`, retrying once on a fresh connection if the
+        connection drops while it is running
+        """
+        try:
+            with self.session() as s:
+                return func(s)
+        except CONNECTION_ERRORS as e:
+            L.info('FTP connection to {} failed ({}), retrying'.format(self.host, e))
+            with self.session() as s:
+                return func(s)
+
+    def ping(self):
+        """ Sends a NOOP on each idle session that is due one """
+        sessions = []
+        while True:
+            try:
+                sessions.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+        for s in sessions:
+            if s.connected and time.time() - s.last_used >= self.keepalive:
+                try:
+                    s.noop()
+                except CONNECTION_ERRORS:
+                    s.close()
+            self.idle.put(s)
+
+    def start_keepalive(self):
+        if not self.keepalive or self.stopped.is_set():
+            return
+
+        def loop():
+            while not self.stopped.wait(self.keepalive):
+                self.ping()
+
+        with self.lock:
+            if self.keepalive_thread is None:
+                self.keepalive_thread = threading.Thread(target=loop, name='ftp-keepalive')
+                self.keepalive_thread.daemon = True
+                self.keepalive_thread.start()
+
+    def close(self):
+        self.stopped.set()
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.created = 0
+
+
+# Profile netCDF files are named {glider}_{profile_id}_{%Y%m%dT%H%M%S}Z_{mode}.nc
+PROFILE_TIME_REGEX = re.compile(r'_(\d{8}T\d{6})Z_')
+
+
+def profile_time(path):
+    """ Returns the profile time of a profile netCDF file as an epoch, falling back
+    to the modification time of the file
+    """
+    m = PROFILE_TIME_REGEX.search(os.path.basename(path))
+    if m is not None:
+        return calendar.timegm(datetime.strptime(m.group(1), '%Y%m%dT%H%M%S').utctimetuple())
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return time.time()
+
+
+class UploadQueue(object):
+    """ Durable queue of files waiting to be uploaded, stored in a SQLite database.
+
+    Files are handed out oldest profile first. A failed upload is put back with an
+    exponential backoff before it is tried again.
+    """
+
+    def __init__(self, path=':memory:', backoff=30, max_backoff=3600):
+        self.path = path
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        if os.path.dirname(path):
+            safe_makedirs(os.path.dirname(path))
+
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        # Upload threads use the connection too
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                '  path TEXT PRIMARY KEY,'
+                '  profile_time REAL,'
+                '  attempts INTEGER,'
+                '  next_attempt REAL,'
+                '  error TEXT,'
+                '  added REAL'
+                ')'
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add(self, path):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO uploads VALUES (?, ?, 0, ?, NULL, ?)',
+                (path, profile_time(path), now, now)
+            )
+
+    def claim(self, now=None):
+        """ Returns the due file with the oldest profile time that is not already
+        being uploaded, or None
+        """
+        now = now or time.time()
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT path FROM uploads WHERE next_attempt <= ? ORDER BY profile_time, path',
+                (now,)
+            )
+            for (path,) in rows:
+                if path not in self.in_flight:
+                    self.in_flight.add(path)
+                    return path
+        return None
+
+    def done(self, path):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM uploads WHERE path = ?', (path,))
+            self.in_flight.discard(path)
+
+    def failed(self, path, error=None):
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                'SELECT attempts FROM uploads WHERE path = ?', (path,)
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            self.conn.execute(
+                'UPDATE uploads SET attempts = ?, next_attempt = ?, error = ? WHERE path = ?',
+                (attempts, time.time() + delay, str(error), path)
+            )
+            self.in_flight.discard(path)
+        return delay
+
+    def retry_now(self):
+        """ Makes every queued file due immediately """
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE uploads SET next_attempt = 0')
+
+    def next_attempt(self):
+        """ Returns the time the next queued file is due, or None if the queue is empty """
+        with self.lock:
+            row = self.conn.execute('SELECT MIN(next_attempt) FROM uploads').fetchone()
+        return row[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+
+
+def upload_queue(state_path, backoff=30, max_backoff=3600):
+    """ Returns the UploadQueue kept inside of `state_path`, or an in-memory one if
+    no state path was configured.
+    """
+    path = ':memory:'
+    if state_path:
+        path = os.path.join(state_path, 'ftp_queue.sqlite')
+    return UploadQueue(path, backoff=backoff, max_backoff=max_backoff)
+
+
+class UploadScheduler(object):
+    """ Uploads the files in an UploadQueue with `workers` threads, each calling
+    `upload(path)` which raises if the upload failed.
+    """
+
+    def __init__(self, upload, queue, workers=1):
+        self.upload = upload
+        self.queue = queue
+        self.workers = max(int(workers or 1), 1)
+        self.threads = []
+        self.wakeup = threading.Condition()
+        self.stopped = threading.Event()
+
+    def submit(self, path):
+        self.queue.add(path)
+        self.start()
+        with self.wakeup:
+            self.wakeup.notify()
+
+    def start(self):
+        if self.threads:
+            return
+        self.stopped.clear()
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run, name='ftp-upload-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        self.stopped.set()
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def process(self, path):
+        try:
+            self.upload(path)
+        except BaseException as e:
+            if not os.path.exists(path):
+                # Nothing left to upload, the watch queues the file again if it is rewritten
+                L.error('Could not upload: {}. {}. The file is gone, not retrying.'.format(path, e))
+                self.queue.done(path)
+                return
+            delay = self.queue.failed(path, e)
+            L.error('Could not upload: {}. {}. Retrying in {} seconds.'.format(path, e, delay))
+        else:
+            self.queue.done(path)
+
+    def run(self):
+        while not self.stopped.is_set():
+            path = self.queue.claim()
+            if path is not None:
+                self.process(path)
+                continue
+
+            # Sleep until the next file is due or a new one is submitted
+            due = self.queue.next_attempt()
+            timeout = 60 if due is None else min(max(due - time.time(), 0.1), 60)
+            with self.wakeup:
+                self.wakeup.wait(timeout)
+
+    def drain(self):
+        """ Tries every queued file once right now, ignoring any backoff, and returns the
+        number of files still queued
+        """
+        self.queue.retry_now()
+        start = time.time()
+
+        def run():
+            while True:
+                path = self.queue.claim(now=start)
+                if path is None:
+                    return
+                self.process(path)
+
+        threads = [ threading.Thread(target=run) for _ in range(self.workers) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return len(self.queue)
+
+
+class UploadManifest(object):
+    """ Record of the (size, digest) of each file pushed to an FTP server, by remote
+    path, stored in a SQLite database. Used to skip uploading files that did not change.
+    """
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        if os.path.dirname(path):
+            safe_makedirs(os.path.dirname(path))
+
+        self.lock = threading.Lock()
+        # Upload threads use the connection too
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploaded ('
+                '  remote_path TEXT PRIMARY KEY,'
+                '  size INTEGER,'
+                '  digest TEXT,'
+                '  uploaded REAL'
+                ')'
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, remote_path):
+        """ Returns the (size, digest) last uploaded to `remote_path`, or None """
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT size, digest FROM uploaded WHERE remote_path = ?',
+                (remote_path,)
+            ).fetchone()
+        return tuple(row) if row is not None else None
+
+    def record(self, remote_path, size, digest):
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO uploaded VALUES (?, ?, ?, ?)',
+                (remote_path, size, digest, time.time())
+            )
+
+    def forget(self, remote_path):
+        with self.lock, self.conn:
+            self.conn.execute('DELETE FROM uploaded WHERE remote_path = ?', (remote_path,))
+
+
+def upload_manifest(state_path):
+    """ Returns the UploadManifest kept inside of `state_path`, or an in-memory one if
+    no state path was configured.
+    """
+    path = ':memory:'
+    if state_path:
+        path = os.path.join(state_path, 'ftp_manifest.sqlite')
+    return UploadManifest(path)
+
+
+class RemoteListing(object):
+    """ Sizes of the files on the FTP server, listed once per directory and kept up
+    to date with the uploads made since.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.directories = {}
+
+    def size(self, directory, name):
+        with self.lock:
+            sizes = self.directories.get(directory)
+
+        if sizes is None:
+            sizes = self.pool.run(lambda s: s.sizes(directory))
+            if sizes is None:
+                # No MLSD, ask for the one file
+                return self.pool.run(lambda s: s.size(directory, name))
+            with self.lock:
+                sizes = self.directories.setdefault(directory, sizes)
+
+        return sizes.get(name)
+
+    def uploaded(self, directory, name, size):
+        with self.lock:
+            if directory in self.directories:
+                self.directories[directory][name] = size
@@ -0,0 +1,285 @@
+#!python
+# coding=utf-8
+""" Metrics of the watches, served over HTTP in the Prometheus text format.
+
+The watches always count what they do. With `--metrics_port` (GUTILS_METRICS_PORT) a
+watch also serves the metrics at http://<metrics_host>:<metrics_port>/metrics.
+"""
+import os
+import time
+import threading
+from bisect import bisect_left
+
+from six.moves import BaseHTTPServer, socketserver
+
+from gutils import timing
+
+import logging
+L = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, 3 * 3600)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    escaped = [
+        str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        for v in values
+    ]
+    return '{' + ','.join('{}="{}"'.format(n, v) for n, v in zip(names, escaped)) + '}'
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes the labels {}'.format(self.name, self.labelnames))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self):
+        """ (suffix, label names, label values, value) of each sample """
+        with self.lock:
+            return [ ('', self.labelnames, k, v) for k, v in sorted(self.values.items()) ]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix, format_labels(names, values), format_value(value)
+            ))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + amount
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """ A value that is set, or read from a function every time the metrics are served """
+
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.functions = {}
+
+    def set(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = value
+
+    def set_function(self, func, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.functions[k] = func
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+
+        for k, func in functions.items():
+            try:
+                values[k] = func()
+            except Exception as e:
+                L.debug("Could not read {}{}: {}".format(self.name, k, e))
+        return [ ('', self.labelnames, k, v) for k, v in sorted(values.items()) ]
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(k, ([0] * len(self.buckets), 0.))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[k] = (counts, total + value)
+
+    def count(self, **labels):
+        with self.lock:
+            counts, _ = self.values.get(self.key(labels), ([0], 0.))
+            return sum(counts)
+
+    def samples(self):
+        samples = []
+        names = self.labelnames + ('le',)
+        with self.lock:
+            for k, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bucket, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', names, k + (format_value(bucket),), cumulative))
+                samples.append(('_sum', self.labelnames, k, total))
+                samples.append(('_count', self.labelnames, k, cumulative))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+EVENTS = REGISTRY.register(Counter(
+    'gutils_events_received_total',
+    'Filesystem events received by the watch',
+    ['watch']
+))
+FILES = REGISTRY.register(Counter(
+    'gutils_files_total',
+    'Files handled by the watch, by result (processed or failed)',
+    ['watch', 'result']
+))
+PROCESSING = REGISTRY.register(Histogram(
+    'gutils_processing_seconds',
+    'Time the watch spent processing a file',
+    ['watch']
+))
+STAGES = REGISTRY.register(Histogram(
+    'gutils_stage_seconds',
+    'Time spent in each stage of turning an ASCII file into netCDF files',
+    ['stage']
+))
+OUTPUT_LATENCY = REGISTRY.register(Histogram(
+    'gutils_event_to_output_seconds',
+    'Time from a file being written to the outputs of the watch being produced',
+    ['watch']
+))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'gutils_queue_depth',
+    'Items waiting in a queue of the watch (filesystem events or FTP uploads)',
+    ['watch', 'queue']
+))
+UPLOADED_BYTES = REGISTRY.register(Counter(
+    'gutils_uploaded_bytes_total',
+    'Bytes uploaded to the FTP server'
+))
+UPLOADS = REGISTRY.register(Counter(
+    'gutils_uploads_total',
+    'FTP uploads, by result (uploaded, unchanged or failed)',
+    ['result']
+))
+
+
+def observe_timings(summary):
+    for name, s in summary['stages'].items():
+        STAGES.observe(s['wall'], stage=name)
+
+
+timing.listeners.append(observe_timings)
+
+
+def observe_output(watch, pathname):
+    """ Records the time since `pathname` was last written as the latency of `watch` """
+    try:
+        OUTPUT_LATENCY.observe(max(time.time() - os.path.getmtime(pathname), 0), watch=watch)
+    except OSError:
+        pass
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        L.debug(format % args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """ Serves the metrics from a background thread and returns the server """
+    server = MetricsServer((host, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever, name='metrics')
+    t.daemon = True
+    t.start()
+    L.info("Serving metrics on http://{}:{}/metrics".format(host, server.server_address[1]))
+    return server
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics_port",
+        help="Port to serve Prometheus metrics on, metrics are not served when not set",
+        default=os.environ.get('GUTILS_METRICS_PORT'),
+        type=int
+    )
+    parser.add_argument(
+        "--metrics_host",
+        help="Address to serve the metrics on, defaults to 127.0.0.1",
+        default=os.environ.get('GUTILS_METRICS_HOST', '127.0.0.1')
+    )
+    return parser
+
+
+def serve_metrics(port=None, host='127.0.0.1'):
+    """ Starts the metrics server if a `--metrics_port` was given """
+    if port is None:
+        return None
+    return start_metrics_server(port, host)
+
+
+def report_queue_depth(notifier, processor):
+    """ Reports the events queued in the pyinotify `notifier` of `processor` """
+    QUEUE_DEPTH.set_function(
+        # pyinotify keeps the events it is coalescing over `read_freq` in _eventq
+        lambda: len(getattr(notifier, '_eventq', ())),
+        watch=processor.watch,
+        queue='events'
+    )
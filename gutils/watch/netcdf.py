@@ -2,52 +2,100 @@
 # coding=utf-8
 import os
 import sys
-import shutil
 import argparse
-import tempfile
-from ftplib import FTP
-from copy import deepcopy
-from datetime import datetime
+import posixpath
 from collections import namedtuple
 
-import numpy as np
-import netCDF4 as nc4
-from lxml import etree
-from jinja2 import Environment, PackageLoader, select_autoescape
 from pyinotify import (
     IN_CLOSE_WRITE,
     IN_MOVED_TO,
     Notifier,
     NotifierError,
-    ProcessEvent,
     WatchManager
 )
 
 from gutils import setup_cli_logger
-from gutils.nc import check_dataset
+from gutils.ledger import iter_files, stage_ledger
+from gutils.nc import check_dataset, content_digest
+from gutils.profiling import add_profile_arguments, configure_profiling
+from gutils.watch import GutilsProcessEvent
+from gutils.watch.ftp import (
+    FtpPool,
+    RemoteListing,
+    UploadManifest,
+    UploadQueue,
+    UploadScheduler,
+    upload_manifest,
+    upload_queue
+)
+from gutils.watch.metrics import (
+    QUEUE_DEPTH,
+    UPLOADED_BYTES,
+    UPLOADS,
+    add_metrics_arguments,
+    observe_output,
+    report_queue_depth,
+    serve_metrics
+)
+from gutils.watch.trace import add_trace_arguments, configure_tracing, traced
 
 import logging
 L = logging.getLogger(__name__)
 
 
-class Netcdf2FtpProcessor(ProcessEvent):
+class Netcdf2FtpProcessor(GutilsProcessEvent):
+
+    watch = 'netcdf_to_ftp'
 
-    def my_init(self, ftp_url, ftp_user, ftp_pass):
+    def my_init(self, ftp_url, ftp_user, ftp_pass, ledger=None, connections=1, keepalive=60, queue=None,
+                manifest=None, verify=False):
         self.ftp_url = ftp_url
         self.ftp_user = ftp_user
         self.ftp_pass = ftp_pass
+        self.ledger = ledger
+        # Logged in sessions are reused across uploads
+        self.pool = FtpPool(
+            ftp_url,
+            ftp_user,
+            ftp_pass,
+            size=connections,
+            keepalive=keepalive
+        )
+        # One upload thread per session. Failed uploads stay queued and are retried.
+        self.scheduler = UploadScheduler(
+            self.upload,
+            queue if queue is not None else UploadQueue(),
+            workers=connections
+        )
+        # What has already been uploaded, so unchanged files are not sent again
+        self.manifest = manifest if manifest is not None else UploadManifest()
+        self.listing = RemoteListing(self.pool) if verify else None
+        QUEUE_DEPTH.set_function(
+            lambda: len(self.scheduler.queue),
+            watch=self.watch,
+            queue='uploads'
+        )
 
-    def process_IN_CLOSE(self, event):
-        f = namedtuple('Check_Arguments', ['file'])
-        args = f(file=event.pathname)
-        if self.valid_extension(event.name) and check_dataset(args) == 0:
-            self.upload_file(event)
+    def valid_file(self, name):
+        return self.valid_extension(name)
+
+    def observe_outputs(self, event):
+        # Files are only queued by `process_file`, the latency is recorded once uploaded
+        pass
+
+    def process_file(self, event):
+        # A file that can't be read is recorded as failed, raising would stop the notifier
+        try:
+            remote_path = self.remote_path(event.pathname)
+        except Exception as e:
+            L.error('Could not read {}: {}'.format(event.pathname, e))
+            return
 
-    def process_IN_MOVED_TO(self, event):
         f = namedtuple('Check_Arguments', ['file'])
         args = f(file=event.pathname)
-        if self.valid_extension(event.name) and check_dataset(args) == 0:
-            self.upload_file(event)
+        if check_dataset(args) == 0:
+            self.scheduler.submit(event.pathname)
+            return [remote_path]
 
     def valid_extension(self, name):
         _, ext = os.path.splitext(name)
@@ -57,36 +105,133 @@ class Netcdf2FtpProcessor(ProcessEvent):
         L.error('Unrecognized file extension: {}'.format(ext))
         return False
 
-    def upload_file(self, event):
-        ftp = None
-        try:
-            ftp = FTP(self.ftp_url)
-            ftp.login(self.ftp_user, self.ftp_pass)
-
-            with nc4.Dataset(event.pathname) as ncd:
-                if not hasattr(ncd, 'id'):
-                    raise ValueError("No 'id' global attribute")
-                # Change into the correct deployment directory
-                try:
-                    ftp.cwd(ncd.id)
-                except BaseException:
-                    ftp.mkd(ncd.id)
-                    ftp.cwd(ncd.id)
-
-            with open(event.pathname, 'rb') as fp:
-                # Upload NetCDF file
-                ftp.storbinary(
-                    'STOR {}'.format(event.name),
-                    fp
-                )
-                L.info("Uploaded file: {}".format(event.name))
+    def remote_path(self, pathname):
+        """ Files are uploaded into a directory named after the deployment """
+        import netCDF4 as nc4
+        with nc4.Dataset(pathname) as ncd:
+            if not hasattr(ncd, 'id'):
+                raise ValueError("No 'id' global attribute")
+            return posixpath.join(ncd.id, os.path.basename(pathname))
+
+    def unchanged(self, remote_path, digest):
+        """ True if a file with the same content was already uploaded to `remote_path`
+        (and, when verifying, the uploaded file is still there with the same size)
+        """
+        uploaded = self.manifest.get(remote_path)
+        if uploaded is None or uploaded[1] != digest:
+            return False
+        if self.listing is None:
+            return True
+        directory, name = posixpath.split(remote_path)
+        return self.listing.size(directory, name) == uploaded[0]
+
+    def upload(self, pathname):
+        """ Uploads a file and returns its remote path, raising if the upload failed """
+        with traced('ftp_upload', pathname) as span:
+            remote_path = self.remote_path(pathname)
+            directory, name = posixpath.split(remote_path)
+
+            size = os.path.getsize(pathname)
+            # Regenerated profiles only differ in their creation attributes
+            digest = content_digest(pathname)
+            if self.unchanged(remote_path, digest):
+                UPLOADS.inc(result='unchanged')
+                span.result = 'unchanged'
+                L.info("Skipping unchanged file: {}".format(name))
+                return remote_path
+
+            try:
+                # Opened before connecting so local file errors never look like a dropped
+                # connection to the pool
+                with open(pathname, 'rb') as fp:
+                    def upload(session):
+                        # Upload NetCDF file into the deployment directory
+                        fp.seek(0)
+                        session.upload(directory, name, fp)
+
+                    self.pool.run(upload)
+            except BaseException:
+                UPLOADS.inc(result='failed')
+                raise
+            UPLOADS.inc(result='uploaded')
+            UPLOADED_BYTES.inc(size)
+            observe_output(self.watch, pathname)
+
+            self.manifest.record(remote_path, size, digest)
+            if self.listing is not None:
+                self.listing.uploaded(directory, name, size)
+            L.info("Uploaded file: {}".format(name))
+            return remote_path
+
+
+def add_ftp_arguments(parser):
+    parser.add_argument(
+        "--ftp_url",
+        help="FTP server to upload to, as host or host:port",
+        default=os.environ.get('GUTILS_FTP_URL')
+    )
+    parser.add_argument(
+        "--ftp_user",
+        help="FTP username, defaults to 'anonymous'",
+        default=os.environ.get('GUTILS_FTP_USER', 'anonymous')
+    )
+    parser.add_argument(
+        "--ftp_pass",
+        help="FTP password, defaults to an empty string",
+        default=os.environ.get('GUTILS_FTP_PASS', '')
+    )
+    parser.add_argument(
+        "--ftp_connections",
+        help="Number of logged in FTP sessions to keep open and files to upload at the same time",
+        default=os.environ.get('GUTILS_FTP_CONNECTIONS', 1),
+        type=int
+    )
+    parser.add_argument(
+        "--ftp_keepalive",
+        help="Seconds between NOOP commands sent to keep idle FTP sessions open",
+        default=os.environ.get('GUTILS_FTP_KEEPALIVE', 60),
+        type=int
+    )
+    parser.add_argument(
+        "--ftp_retry_backoff",
+        help="Seconds to wait before retrying a failed upload. Doubles with each failure.",
+        default=os.environ.get('GUTILS_FTP_RETRY_BACKOFF', 30),
+        type=int
+    )
+    parser.add_argument(
+        "--ftp_max_backoff",
+        help="Longest number of seconds to wait between retries of a failed upload",
+        default=os.environ.get('GUTILS_FTP_MAX_BACKOFF', 3600),
+        type=int
+    )
+    parser.add_argument(
+        "--ftp_verify",
+        help="Before skipping a file that was already uploaded, check it is still on the "
+             "FTP server with the same size. Each directory is listed once.",
+        action='store_true'
+    )
+    return parser
 
-        except BaseException as e:
-            L.error('Could not upload: {} to {}. {}.'.format(event.pathname, self.ftp_url, e))
 
-        finally:
-            if ftp is not None:
-                ftp.quit()
+def ftp_processor(args, ledger=None):
+    """ Netcdf2FtpProcessor from the arguments added by `add_ftp_arguments`. Failed
+    uploads and the manifest of uploaded files are kept in `args.state_path` when it is set.
+    """
+    return Netcdf2FtpProcessor(
+        ftp_url=args.ftp_url,
+        ftp_user=args.ftp_user,
+        ftp_pass=args.ftp_pass,
+        ledger=ledger,
+        connections=args.ftp_connections,
+        keepalive=args.ftp_keepalive,
+        queue=upload_queue(
+            args.state_path,
+            backoff=args.ftp_retry_backoff,
+            max_backoff=args.ftp_max_backoff
+        ),
+        manifest=upload_manifest(args.state_path),
+        verify=args.ftp_verify
+    )
 
 
 def create_ftp_arg_parser():
@@ -101,20 +246,12 @@ def create_ftp_arg_parser():
         help="Path to the glider data netCDF output directory",
         default=os.environ.get('GUTILS_NETCDF_DIRECTORY')
     )
+    add_ftp_arguments(parser)
     parser.add_argument(
-        "--ftp_url",
-        help="Path to the glider data netCDF output directory",
-        default=os.environ.get('GUTILS_FTP_URL')
-    )
-    parser.add_argument(
-        "--ftp_user",
-        help="FTP username, defaults to 'anonymous'",
-        default=os.environ.get('GUTILS_FTP_USER', 'anonymous')
-    )
-    parser.add_argument(
-        "--ftp_pass",
-        help="FTP password, defaults to an empty string",
-        default=os.environ.get('GUTILS_FTP_PASS', '')
+        "--state_path",
+        help="Folder to keep a ledger of processed files in. When set, files that arrived "
+             "while the watch was not running are processed on startup.",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
     )
     parser.add_argument(
         "--daemonize",
@@ -122,6 +259,9 @@ def create_ftp_arg_parser():
         type=bool,
         default=False
     )
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     return parser
 
@@ -131,6 +271,7 @@ def main_to_ftp():
 
     parser = create_ftp_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
 
     if not args.data_path:
         L.error("Please provide an --data_path agrument or set the "
@@ -142,6 +283,9 @@ def main_to_ftp():
                 "GUTILS_FTP_URL environmental variable")
         sys.exit(parser.print_usage())
 
+    serve_metrics(args.metrics_port, args.metrics_host)
+    configure_tracing(args.trace_path)
+
     wm = WatchManager()
     mask = IN_MOVED_TO | IN_CLOSE_WRITE
     wm.add_watch(
@@ -151,15 +295,17 @@ def main_to_ftp():
         auto_add=True
     )
 
-    processor = Netcdf2FtpProcessor(
-        ftp_url=args.ftp_url,
-        ftp_user=args.ftp_user,
-        ftp_pass=args.ftp_pass,
-    )
+    processor = ftp_processor(args, ledger=stage_ledger(args.state_path, 'netcdf_to_ftp'))
+    # Resume uploading anything left in the queue
+    processor.scheduler.start()
+    # Process anything that arrived while we were not watching
+    processor.catch_up(args.data_path)
+
     notifier = Notifier(wm, processor, read_freq=10)  # Read every 10 seconds
     # Enable coalescing of events. This merges event types of the same type on the same file
     # together over the `read_freq` specified in the Notifier.
     notifier.coalesce_events()
+    report_queue_depth(notifier, processor)
 
     try:
         L.info("Watching {} and Uploading to {}".format(
@@ -173,166 +319,102 @@ def main_to_ftp():
     except BaseException as e:
         L.exception(e)
         return 1
+    finally:
+        processor.scheduler.stop()
+        processor.pool.close()
 
     L.info("GUTILS netcdf_to_ftp Exited Successfully")
     return 0
 
 
-def lxml_elements_equal(e1, e2):
-    if e1.tag != e2.tag:
-        return False
-    if e1.text != e2.text:
-        return False
-    if e1.tail != e2.tail:
-        return False
-    if e1.attrib != e2.attrib:
-        return False
-    if len(e1) != len(e2):
-        return False
+def create_ftp_drain_arg_parser():
 
-    return all(lxml_elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+    parser = argparse.ArgumentParser(
+        description="Upload every file waiting in the FTP retry queue right now, "
+                    "ignoring any retry backoff. Use after an FTP outage."
+    )
+    add_ftp_arguments(parser)
+    parser.add_argument(
+        "--state_path",
+        help="Folder the FTP watch keeps its retry queue in",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        help="Also queue every netCDF file below this directory before draining",
+        default=None
+    )
+    return parser
 
 
-datatype_mapping = {
-    str: 'String',
-    np.dtype('U'): 'String',
-    np.dtype('int8'): 'byte',
-    np.dtype('int32'): 'int',
-    np.dtype('float32'): 'float',
-    np.dtype('float64'): 'double',
-}
+def main_ftp_drain():
+    setup_cli_logger(logging.INFO)
 
+    parser = create_ftp_drain_arg_parser()
+    args = parser.parse_args()
+
+    if not args.ftp_url:
+        L.error("Please provide an --ftp_url agrument or set the "
+                "GUTILS_FTP_URL environmental variable")
+        sys.exit(parser.print_usage())
 
-destination_mapping = {
-    'profile_lat': 'latitude',
-    'profile_lon': 'longitude',
-    'profile_time': 'time',
-    'time': 'precise_time',
-    'lat': 'precise_lat',
-    'lon': 'precise_lon',
-    'platform': 'meta_platform',
-    'crs': 'meta_crs',
-}
+    if not args.state_path and not args.data_path:
+        L.error("Please provide a --state_path or --data_path agrument or set the "
+                "GUTILS_STATE_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
 
+    processor = ftp_processor(args)
+    queue = processor.scheduler.queue
 
-def netcdf_to_erddap_dataset(datasets_path, netcdf_path, flag_path):
-    tmp_handle, tmp_path = tempfile.mkstemp(prefix='gutils_errdap_', suffix='.xml')
+    if args.data_path:
+        for path, name, _ in iter_files(args.data_path):
+            if processor.valid_extension(name):
+                queue.add(path)
 
+    L.info("Uploading {} queued files to {}".format(len(queue), args.ftp_url))
     try:
-        loader = PackageLoader('gutils', 'templates')
-        jenv = Environment(loader=loader, autoescape=select_autoescape(['html', 'xml']))
-
-        # Copy datasets.xml to a tmpfile if it exists
-        if os.path.isfile(datasets_path):
-            shutil.copy(datasets_path, tmp_path)
-        else:
-            # Render the base template to the tmpfile
-            datasets_template_string = jenv.get_template('erddap_datasets.xml').render()
-            with open(tmp_path, 'wt') as f:
-                f.write(
-                    etree.tostring(
-                        etree.fromstring(datasets_template_string),
-                        encoding='ISO-8859-1',
-                        pretty_print=True,
-                        xml_declaration=True
-                    ).decode('iso-8859-1')
-                )
-                f.write('\n')
+        remaining = processor.scheduler.drain()
+    finally:
+        processor.pool.close()
 
-        deployment_directory = os.path.dirname(netcdf_path)
-        deployment_name = os.path.basename(deployment_directory)
-        with nc4.Dataset(netcdf_path) as ncd:
-            xmlstring = jenv.get_template('erddap_deployment.xml').render(
-                deployment_name=deployment_name,
-                deployment_directory=deployment_directory,
-                deployment_variables=ncd.variables,
-                datatype_mapping=datatype_mapping,
-                destination_mapping=destination_mapping
-            )
-        deployment_xml_node = etree.fromstring(xmlstring)
-
-        # Create
-        xmltree = etree.parse(tmp_path).getroot()
-        find_dataset = etree.XPath("//erddapDatasets/dataset[@datasetID=$name]")
-
-        # Find an existing datasetID within the datasets.xml file
-        dnode = find_dataset(xmltree, name=deployment_name)
-        if not dnode:
-            # No datasetID found, create a new one
-            xmltree.append(deployment_xml_node)
-            L.debug("Added Deployment: {}".format(deployment_name))
-        else:
-            if lxml_elements_equal(dnode[0], deployment_xml_node):
-                L.debug("Not replacing identical deployment XML node")
-                return
-            else:
-                # Now make sure we don't remove any variables since some could be
-                # missing from this file but present in others
-                new_vars = [ d.findtext('sourceName') for d in deployment_xml_node.iter('dataVariable') ]
-                # iterate over the old_vars and figure out which ones
-                # are not in the new_vars
-                for dv in dnode[0].iter('dataVariable'):
-                    vname = dv.findtext('sourceName')
-                    if vname not in new_vars:
-                        # Append the old variable block into the new one
-                        L.debug('Carried over variable {}'.format(vname))
-                        deployment_xml_node.append(deepcopy(dv))
-
-                # Update the existing datasetID with a new XML block
-                xmltree.replace(dnode[0], deployment_xml_node)
-                L.debug("Replaced Deployment: {}".format(deployment_name))
-
-        # Create tempfile for the new modified file
-        new_datasets_handle, new_datasets_path = tempfile.mkstemp(prefix='gutils_erddap_', suffix='.xml')
-        with open(new_datasets_path, 'wt') as f:
-            f.write(etree.tostring(
-                xmltree,
-                encoding='ISO-8859-1',
-                pretty_print=True,
-                xml_declaration=True
-            ).decode('iso-8859-1'))
-            f.write('\n')
-
-        # Replace old datasets.xml
-        os.close(new_datasets_handle)
-        os.chmod(new_datasets_path, 0o664)
-        shutil.move(new_datasets_path, datasets_path)
+    if remaining:
+        L.error("{} files could not be uploaded and are still queued".format(remaining))
+        return 1
 
-    finally:
-        # Write dataset update flag if it doesn't exist
-        if flag_path is not None:
-            flag_tmp_handle, flag_tmp_path = tempfile.mkstemp(prefix='gutils_errdap_', suffix='.flag')
-            final_flagfile = os.path.join(flag_path, deployment_name)
+    L.info("GUTILS ftp_drain Exited Successfully")
+    return 0
 
-            if not os.path.isfile(final_flagfile):
-                with open(flag_tmp_path, 'w') as ff:
-                    ff.write(datetime.utcnow().isoformat())
-                os.chmod(flag_tmp_path, 0o666)
-                shutil.move(flag_tmp_path, final_flagfile)
 
-            os.close(flag_tmp_handle)
-            if os.path.exists(flag_tmp_path):
-                os.remove(flag_tmp_path)
+def netcdf_to_erddap_dataset(datasets_path, netcdf_path, flag_path):
+    from gutils.erddap import netcdf_to_erddap_dataset as to_dataset
+    return to_dataset(datasets_path, netcdf_path, flag_path)
 
-        os.close(tmp_handle)
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
 
+class Netcdf2ErddapProcessor(GutilsProcessEvent):
 
-class Netcdf2ErddapProcessor(ProcessEvent):
+    watch = 'netcdf_to_erddap'
 
-    def my_init(self, outputs_path, erddap_content_path, erddap_flag_path):
+    def my_init(self, outputs_path, erddap_content_path, erddap_flag_path, ledger=None, debounce=0):
         self.outputs_path = os.path.realpath(outputs_path)
         self.erddap_content_path = os.path.realpath(erddap_content_path)
-        self.erddap_flag_path = os.path.realpath(erddap_flag_path)
+        self.erddap_flag_path = os.path.realpath(erddap_flag_path) if erddap_flag_path else None
+        self.ledger = ledger
+        from gutils.erddap import DatasetsXml, erddap_jinja_environment
+        self.jenv = erddap_jinja_environment()
+        self.template = None
+        # Parsed once and written at most every `debounce` seconds
+        self.datasets = DatasetsXml(
+            os.path.join(self.erddap_content_path, 'datasets.xml'),
+            flag_path=self.erddap_flag_path,
+            debounce=debounce
+        )
 
-    def process_IN_CLOSE(self, event):
-        if self.valid_extension(event.name):
-            self.create_and_update_content(event)
+    def valid_file(self, name):
+        return self.valid_extension(name)
 
-    def process_IN_MOVED_TO(self, event):
-        if self.valid_extension(event.name):
-            self.create_and_update_content(event)
+    def process_file(self, event):
+        return self.create_and_update_content(event)
 
     def valid_extension(self, name):
         _, ext = os.path.splitext(name)
@@ -341,12 +423,103 @@ class Netcdf2ErddapProcessor(ProcessEvent):
         return False
 
     def create_and_update_content(self, event):
-        datasets_path = os.path.join(self.erddap_content_path, 'datasets.xml')
-        netcdf_to_erddap_dataset(
-            datasets_path=datasets_path,
-            netcdf_path=event.pathname,
-            flag_path=self.erddap_flag_path
-        )
+        import netCDF4 as nc4
+        from gutils.erddap import deployment_signature, render_deployment_template
+
+        template = self.jenv.get_template('erddap_deployment.xml')
+        if template is not self.template:
+            # The template was (re)loaded, every deployment needs to be rendered again
+            self.datasets.forget_signatures()
+            self.template = template
+
+        deployment_directory = os.path.dirname(event.pathname)
+        deployment_name = os.path.basename(deployment_directory)
+        with nc4.Dataset(event.pathname) as ncd:
+            signature = deployment_signature(deployment_directory, ncd.variables)
+            # Most new profiles have the same variables as the last one
+            if not self.datasets.unchanged(deployment_name, signature):
+                deployment_xml_node = render_deployment_template(
+                    deployment_directory,
+                    ncd.variables,
+                    self.jenv
+                )
+                self.datasets.update(deployment_name, deployment_xml_node, signature=signature)
+        return [self.datasets.datasets_path]
+
+
+def create_erddap_rebuild_arg_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Regenerate the ERDDAP datasets.xml entries of every glider deployment "
+                    "in a netCDF directory at once."
+    )
+    parser.add_argument(
+        "-d",
+        "--data_path",
+        help="Path to the glider data netCDF output directory",
+        default=os.environ.get('GUTILS_NETCDF_DIRECTORY')
+    )
+    parser.add_argument(
+        "--erddap_content_path",
+        help="Path to the ERDDAP content directory",
+        default=os.environ.get('GUTILS_ERDDAP_CONTENT_PATH')
+    )
+    parser.add_argument(
+        "--erddap_flag_path",
+        help="Path to the ERDDAP flag directory",
+        default=os.environ.get('GUTILS_ERDDAP_FLAG_PATH')
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of deployments to render at the same time. Defaults to the number of CPUs.",
+        default=None,
+        type=int
+    )
+    parser.add_argument(
+        "--union",
+        help="Read every file of each deployment for the union of their variables instead "
+             "of only the last file, and replace the existing entries instead of adding to them",
+        action='store_true'
+    )
+    parser.add_argument(
+        "--prune",
+        help="Remove deployments GUTILS wrote to datasets.xml that are no longer in --data_path",
+        action='store_true'
+    )
+
+    return parser
+
+
+def main_erddap_rebuild():
+    setup_cli_logger(logging.INFO)
+
+    parser = create_erddap_rebuild_arg_parser()
+    args = parser.parse_args()
+
+    if not args.data_path:
+        L.error("Please provide an --data_path agrument or set the "
+                "GUTILS_NETCDF_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    if not args.erddap_content_path:
+        L.error("Please provide an --erddap_content_path agrument or set the "
+                "GUTILS_ERDDAP_CONTENT_PATH environmental variable")
+        sys.exit(parser.print_usage())
+
+    from gutils.erddap import rebuild_datasets_xml
+
+    deployments = rebuild_datasets_xml(
+        data_path=os.path.abspath(args.data_path),
+        datasets_path=os.path.join(os.path.realpath(args.erddap_content_path), 'datasets.xml'),
+        flag_path=os.path.realpath(args.erddap_flag_path) if args.erddap_flag_path else None,
+        workers=args.workers,
+        union=args.union,
+        prune=args.prune
+    )
+
+    L.info("Rebuilt {} deployments".format(len(deployments)))
+    return 0
 
 
 def create_erddap_arg_parser():
@@ -371,12 +544,27 @@ def create_erddap_arg_parser():
         help="Path to the ERDDAP flag directory",
         default=os.environ.get('GUTILS_ERDDAP_FLAG_PATH')
     )
+    parser.add_argument(
+        "--erddap_debounce",
+        help="Write datasets.xml at most once every this many seconds",
+        default=os.environ.get('GUTILS_ERDDAP_DEBOUNCE', 5),
+        type=float
+    )
+    parser.add_argument(
+        "--state_path",
+        help="Folder to keep a ledger of processed files in. When set, files that arrived "
+             "while the watch was not running are processed on startup.",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
     parser.add_argument(
         "--daemonize",
         help="To daemonize or not to daemonize",
         type=bool,
         default=False
     )
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
 
     return parser
 
@@ -386,6 +574,7 @@ def main_to_erddap():
 
     parser = create_erddap_arg_parser()
     args = parser.parse_args()
+    configure_profiling(args)
 
     if not args.data_path:
         L.error("Please provide an --data_path agrument or set the "
@@ -397,6 +586,9 @@ def main_to_erddap():
                 "GUTILS_ERDDAP_CONTENT_PATH environmental variable")
         sys.exit(parser.print_usage())
 
+    serve_metrics(args.metrics_port, args.metrics_host)
+    configure_tracing(args.trace_path)
+
     wm = WatchManager()
     mask = IN_MOVED_TO | IN_CLOSE_WRITE
     wm.add_watch(
@@ -409,12 +601,18 @@ def main_to_erddap():
     processor = Netcdf2ErddapProcessor(
         outputs_path=args.data_path,
         erddap_content_path=args.erddap_content_path,
-        erddap_flag_path=args.erddap_flag_path
+        erddap_flag_path=args.erddap_flag_path,
+        ledger=stage_ledger(args.state_path, 'netcdf_to_erddap'),
+        debounce=args.erddap_debounce
     )
+    # Process anything that arrived while we were not watching
+    processor.catch_up(args.data_path)
+
     notifier = Notifier(wm, processor, read_freq=30)  # Read every 30 seconds
     # Enable coalescing of events. This merges event types of the same type on the same file
     # together over the `read_freq` specified in the Notifier.
     notifier.coalesce_events()
+    report_queue_depth(notifier, processor)
 
     try:
         L.info("Watching {}, updating content at {} and flags at {}".format(
@@ -429,6 +627,9 @@ def main_to_erddap():
     except BaseException as e:
         L.exception(e)
         return 1
+    finally:
+        # Write out anything waiting on the debounce
+        processor.datasets.flush()
 
     L.info("GUTILS netcdf_to_erddap Exited Successfully")
     return 0
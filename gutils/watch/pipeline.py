@@ -0,0 +1,497 @@
+#!python
+# coding=utf-8
+import os
+import sys
+import argparse
+import threading
+
+from six.moves import queue
+from pyinotify import (
+    IN_CLOSE_WRITE,
+    IN_MOVED_TO,
+    Notifier,
+    NotifierError,
+    WatchManager
+)
+
+from gutils import add_detector_argument, setup_cli_logger
+from gutils.ledger import stage_ledger
+from gutils.nc import ProfileIdTypes
+from gutils.profiling import add_profile_arguments, configure_profiling
+from gutils.watch import GutilsProcessEvent, PathEvent, ReaderEvent
+from gutils.watch.ascii import (
+    Slocum2NetcdfProcessor,
+    add_gps_index_argument,
+    add_incremental_profiles_argument
+)
+from gutils.watch.binary import Slocum2AsciiProcessor
+from gutils.watch.metrics import add_metrics_arguments, report_queue_depth, serve_metrics
+from gutils.watch.netcdf import Netcdf2ErddapProcessor, add_ftp_arguments, ftp_processor
+from gutils.watch.trace import add_trace_arguments, configure_tracing
+
+import logging
+L = logging.getLogger(__name__)
+
+
+# Tells a Stage worker to exit
+STOP = object()
+
+
+class Stage(object):
+    """ A pool of worker threads that run `func` on each item put on the stage's queue
+    and put every item `func` returns onto the queues of the downstream stages.
+    """
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers or 1), 1)
+        self.queue = queue.Queue()
+        self.downstream = []
+        self.threads = []
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def emit(self, result):
+        for d in self.downstream:
+            d.put(result)
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.run, name='{}-{}'.format(self.name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(STOP)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is STOP:
+                    return
+
+                for result in self.func(item) or []:
+                    self.emit(result)
+            except BaseException:
+                L.exception('Error in the {} stage processing {}'.format(self.name, item))
+            finally:
+                self.queue.task_done()
+
+
+class PipelineBinaryProcessor(Slocum2AsciiProcessor):
+    """ Converts binary files for the pipeline. Each merged segment is piped straight into
+    a SlocumReader and passed to `emit` as a ReaderEvent for its archived ASCII file.
+    """
+
+    emit = None
+
+    def convert_to_ascii(self, event):
+        outputs = []
+        # Binary workers run at the same time, so each one converts with its own cache
+        for p in self.merger(event).iter_read(archive=True, isolate_cache=True):
+            outputs.append(p['ascii'])
+            if self.emit is not None:
+                self.emit(ReaderEvent(
+                    path=os.path.dirname(p['ascii']),
+                    name=os.path.basename(p['ascii']),
+                    pathname=p['ascii'],
+                    reader=p['reader']
+                ))
+        return outputs
+
+
+class Pipeline(object):
+    """ Runs the binary -> ASCII -> netCDF -> ERDDAP/FTP chain as an in-process pipeline.
+
+    Merged ASCII data is piped straight from the binary converter into a SlocumReader
+    and handed to the netCDF stage, and the list of written netCDF files is handed to the
+    ERDDAP and FTP stages, so no stage waits on the filesystem or an inotify read
+    interval. The ASCII and netCDF files are still written for archival.
+
+    Every stage runs its files through the `handle` method of its processor, so files
+    are recorded in the processor's ledger, metrics, traces and profiles like they are
+    by the separate watches. `binary` must be a PipelineBinaryProcessor.
+    """
+
+    def __init__(self, binary, netcdf, erddap=None, ftp=None, ledger=None, workers=None):
+        workers = workers or {}
+
+        self.binary = binary
+        self.netcdf = netcdf
+        self.erddap = erddap
+        self.ftp = ftp
+        self.ledger = ledger
+        if ledger is not None:
+            self.binary.ledger = ledger
+
+        # Segments waiting in the binary stage, events for them are dropped
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+
+        self.stages = []
+        binary_stage = self.add_stage('binary', self.convert, workers.get('binary'))
+        self.binary.emit = binary_stage.emit
+        netcdf_stage = self.add_stage('netcdf', self.create_netcdf, workers.get('netcdf'))
+        binary_stage.downstream.append(netcdf_stage)
+
+        if erddap is not None:
+            # Each deployment has its own datasets.xml fragment, so different
+            # deployments are updated in parallel
+            netcdf_stage.downstream.append(self.add_stage('erddap', self.update_erddap, workers.get('erddap')))
+
+        if ftp is not None:
+            # Uploads run on the FTP processor's own upload threads
+            netcdf_stage.downstream.append(self.add_stage('ftp', self.upload, 1))
+
+    def add_stage(self, name, func, workers=None):
+        s = Stage(name, func, workers)
+        self.stages.append(s)
+        return s
+
+    def put(self, event):
+        segment = self.binary.segment(event.pathname)
+        with self.pending_lock:
+            if segment in self.pending:
+                L.debug("{} is already waiting to be converted".format(event.pathname))
+                return
+            self.pending.add(segment)
+        self.stages[0].put(event)
+
+    def start(self):
+        for s in self.stages:
+            s.start()
+
+    def join(self):
+        """ Blocks until every queued item has made its way through the pipeline """
+        for s in self.stages:
+            s.queue.join()
+
+    def stop(self):
+        # Upstream stages first so everything in flight is drained
+        for s in self.stages:
+            s.stop()
+
+    def convert(self, event):
+        with self.pending_lock:
+            self.pending.discard(self.binary.segment(event.pathname))
+        # Merged segments are emitted to the netCDF stage as they are read
+        self.binary.handle(event)
+
+    def create_netcdf(self, event):
+        written = self.netcdf.handle(event)
+        if not isinstance(written, (list, tuple)):
+            return []
+        return written
+
+    def update_erddap(self, netcdf_file):
+        self.erddap.handle(PathEvent.from_path(netcdf_file))
+
+    def upload(self, netcdf_file):
+        self.ftp.handle(PathEvent.from_path(netcdf_file))
+
+
+class PipelineProcessor(GutilsProcessEvent):
+
+    watch = 'pipeline'
+
+    def my_init(self, pipeline, binary, ledger=None):
+        self.pipeline = pipeline
+        self.binary = binary
+        self.ledger = ledger
+
+    def valid_file(self, name):
+        return self.binary.valid_file(name)
+
+    def sort_key(self, pathname):
+        return self.binary.sort_key(pathname)
+
+    def pending(self, root):
+        return self.binary.pending(root)
+
+    def handle(self, event):
+        # The pipeline records the file in the ledger once it has been converted
+        if self.valid_file(event.name):
+            self.pipeline.put(PathEvent(event.path, event.name, event.pathname))
+
+
+def create_pipeline_arg_parser():
+
+    parser = argparse.ArgumentParser(
+        description="Monitor a directory for new binary glider data and run every GUTILS "
+                    "stage, from binary to ERDDAP and FTP, in a single process."
+    )
+    parser.add_argument(
+        '-d',
+        '--data_path',
+        help='Path to binary glider data directory',
+        default=os.environ.get('GUTILS_BINARY_DIRECTORY')
+    )
+    parser.add_argument(
+        '--ascii_outputs',
+        help='Where to archive the merged ASCII files.',
+        default=os.environ.get('GUTILS_ASCII_DIRECTORY')
+    )
+    parser.add_argument(
+        '-o',
+        '--outputs',
+        help='Where to place the newly generated NetCDF files.',
+        default=os.environ.get('GUTILS_NETCDF_DIRECTORY')
+    )
+    parser.add_argument(
+        '-c',
+        '--configs',
+        help="Folder to look for NetCDF global and glider "
+             "JSON configuration files.  Default is './config'.",
+        default=os.environ.get('GUTILS_CONFIG_DIRECTORY', './config')
+    )
+    parser.add_argument(
+        '-fp', '--filter_points',
+        help="Filter out profiles that do not have at least this number of points",
+        default=5
+    )
+    parser.add_argument(
+        '-fd', '--filter_distance',
+        help="Filter out profiles that do not span at least this vertical distance (meters)",
+        default=1
+    )
+    parser.add_argument(
+        '-ft', '--filter_time',
+        help="Filter out profiles that last less than this numer of seconds",
+        default=10
+    )
+    parser.add_argument(
+        '-fz', '--filter_z',
+        help="Filter out profiles that are not completely below this depth (meters)",
+        default=1
+    )
+    add_detector_argument(parser)
+    parser.add_argument(
+        '--no-subset',
+        dest='subset',
+        action='store_false',
+        help='Process all variables - not just those available in a datatype mapping JSON file'
+    )
+    parser.add_argument(
+        "-t",
+        "--template",
+        help="The template to use when writing netCDF files. Options: [filepath], trajectory, ioos_ngdac",
+        default=os.environ.get('GUTILS_NETCDF_TEMPLATE', 'trajectory')
+    )
+    parser.add_argument(
+        "-p",
+        "--profile_id_type",
+        help="The profile type to use when writing netCDF files. 1 == EPOCH, 2 == COUNT, 3 == FRAME",
+        default=os.environ.get('GUTILS_PROFILE_ID_TYPE', 1),
+        type=int
+    )
+    parser.add_argument(
+        "--erddap_content_path",
+        help="Path to the ERDDAP content directory. The ERDDAP stage is skipped if not set.",
+        default=os.environ.get('GUTILS_ERDDAP_CONTENT_PATH')
+    )
+    parser.add_argument(
+        "--erddap_flag_path",
+        help="Path to the ERDDAP flag directory",
+        default=os.environ.get('GUTILS_ERDDAP_FLAG_PATH')
+    )
+    parser.add_argument(
+        "--erddap_debounce",
+        help="Write datasets.xml at most once every this many seconds",
+        default=os.environ.get('GUTILS_ERDDAP_DEBOUNCE', 5),
+        type=float
+    )
+    add_ftp_arguments(parser)
+    parser.add_argument(
+        "--binary_workers",
+        help="Number of binary files to convert at the same time. "
+             "Always 1 when using the COUNT profile id type or --incremental_profiles.",
+        default=os.environ.get('GUTILS_PIPELINE_BINARY_WORKERS', 1),
+        type=int
+    )
+    parser.add_argument(
+        "--netcdf_workers",
+        help="Number of merged segments to create netCDF files from at the same time. "
+             "Always 1 when using the COUNT profile id type or --incremental_profiles, "
+             "the binary files are then converted one at a time too so segments arrive "
+             "in order.",
+        default=os.environ.get('GUTILS_PIPELINE_NETCDF_WORKERS', 1),
+        type=int
+    )
+    parser.add_argument(
+        "--erddap_workers",
+        help="Number of ERDDAP deployment updates to run at the same time",
+        default=os.environ.get('GUTILS_PIPELINE_ERDDAP_WORKERS', 1),
+        type=int
+    )
+    parser.add_argument(
+        "--read_freq",
+        help="Seconds to wait between reading inotify events. Events for the same file "
+             "within this window are coalesced.",
+        default=os.environ.get('GUTILS_PIPELINE_READ_FREQ', 10),
+        type=int
+    )
+    parser.add_argument(
+        "--state_path",
+        help="Folder to keep a ledger of processed files in. When set, files that arrived "
+             "while the watch was not running are processed on startup.",
+        default=os.environ.get('GUTILS_STATE_DIRECTORY')
+    )
+    add_incremental_profiles_argument(parser)
+    add_gps_index_argument(parser)
+    parser.add_argument(
+        "--daemonize",
+        help="To daemonize or not to daemonize",
+        type=bool,
+        default=False
+    )
+    parser.set_defaults(subset=True)
+    add_profile_arguments(parser)
+    add_metrics_arguments(parser)
+    add_trace_arguments(parser)
+
+    return parser
+
+
+def main_pipeline():
+    setup_cli_logger(logging.INFO)
+
+    parser = create_pipeline_arg_parser()
+    args = parser.parse_args()
+    configure_profiling(args)
+
+    if not args.data_path:
+        L.error("Please provide a --data_path agrument or set the "
+                "GUTILS_BINARY_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    if not args.ascii_outputs or not args.outputs:
+        L.error("Please provide --ascii_outputs and --outputs agruments or set the "
+                "GUTILS_ASCII_DIRECTORY and GUTILS_NETCDF_DIRECTORY environmental variables")
+        sys.exit(parser.print_usage())
+
+    if args.incremental_profiles is True and not args.state_path:
+        L.error("--incremental_profiles needs a --state_path to keep the open profiles in")
+        sys.exit(parser.print_usage())
+
+    # Segments have to reach the netCDF stage in the order of their names, so both the
+    # converting and the netCDF stages run with a single worker
+    binary_workers = args.binary_workers
+    netcdf_workers = args.netcdf_workers
+    ordered = None
+    if args.profile_id_type == ProfileIdTypes.COUNT:
+        ordered = "COUNT profile ids require netCDF files to be written in order"
+    elif args.incremental_profiles is True:
+        ordered = "Incremental profiles require segments to be processed in order"
+    if ordered and (binary_workers > 1 or netcdf_workers > 1):
+        L.warning("{}, using 1 binary and 1 netCDF worker".format(ordered))
+        binary_workers = 1
+        netcdf_workers = 1
+
+    if args.gps_index is True and not args.state_path:
+        L.error("--gps_index needs a --state_path to keep the GPS fixes in")
+        sys.exit(parser.print_usage())
+
+    serve_metrics(args.metrics_port, args.metrics_host)
+    configure_tracing(args.trace_path)
+
+    binary = PipelineBinaryProcessor(
+        outputs_path=args.ascii_outputs
+    )
+    netcdf = Slocum2NetcdfProcessor(
+        outputs_path=args.outputs,
+        configs_path=args.configs,
+        subset=args.subset,
+        template=args.template,
+        profile_id_type=args.profile_id_type,
+        filter_points=args.filter_points,
+        filter_distance=args.filter_distance,
+        filter_time=args.filter_time,
+        filter_z=args.filter_z,
+        detector=args.detector,
+        profile_state_path=args.state_path if args.incremental_profiles is True else None,
+        gps_index_path=args.state_path if args.gps_index is True else None
+    )
+
+    erddap = None
+    if args.erddap_content_path:
+        erddap = Netcdf2ErddapProcessor(
+            outputs_path=args.outputs,
+            erddap_content_path=args.erddap_content_path,
+            erddap_flag_path=args.erddap_flag_path,
+            debounce=args.erddap_debounce
+        )
+
+    ftp = None
+    if args.ftp_url:
+        ftp = ftp_processor(args)
+        # Resume uploading anything left in the queue
+        ftp.scheduler.start()
+
+    ledger = stage_ledger(args.state_path, 'pipeline')
+    pipeline = Pipeline(
+        binary=binary,
+        netcdf=netcdf,
+        erddap=erddap,
+        ftp=ftp,
+        ledger=ledger,
+        workers=dict(
+            binary=binary_workers,
+            netcdf=netcdf_workers,
+            erddap=args.erddap_workers
+        )
+    )
+
+    wm = WatchManager()
+    mask = IN_MOVED_TO | IN_CLOSE_WRITE
+    wm.add_watch(
+        args.data_path,
+        mask,
+        rec=True,
+        auto_add=True
+    )
+
+    processor = PipelineProcessor(
+        pipeline=pipeline,
+        binary=binary,
+        ledger=ledger
+    )
+    pipeline.start()
+    # Queue anything that arrived while we were not watching
+    processor.catch_up(args.data_path)
+
+    notifier = Notifier(wm, processor, read_freq=args.read_freq)
+    # Enable coalescing of events. This merges event types of the same type on the same file
+    # together over the `read_freq` specified in the Notifier.
+    notifier.coalesce_events()
+    report_queue_depth(notifier, processor)
+
+    try:
+        L.info("Watching {} and running the pipeline to {}".format(
+            args.data_path,
+            ', '.join([ s.name for s in pipeline.stages ]))
+        )
+        notifier.loop(daemonize=args.daemonize)
+    except NotifierError:
+        L.exception('Unable to start notifier loop')
+        return 1
+    except BaseException as e:
+        L.exception(e)
+        return 1
+    finally:
+        pipeline.stop()
+        if erddap is not None:
+            erddap.datasets.flush()
+        if ftp is not None:
+            ftp.scheduler.stop()
+            ftp.pool.close()
+
+    L.info("GUTILS pipeline Exited Successfully")
+    return 0
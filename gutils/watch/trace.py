@@ -0,0 +1,354 @@
+#!python
+# coding=utf-8
+""" End-to-end latency tracing across the watches.
+
+When a watch is run with `--trace_path` (GUTILS_TRACE_DIRECTORY) each file it handles is
+recorded as a span in `spans.jsonl` inside of that folder. A file that is not the output
+of a traced file starts a new trace, with its modification time as the arrival of the
+data. The files a watch produces are linked to the trace of their input in
+`links.sqlite`, so the watches further down, in the same or other processes, add their
+spans to the same trace. Files are linked by their deployment folder and name, so the
+watches may see the data folders mounted at different paths.
+
+`gutils_trace_report` breaks the time from arrival to each stage finishing down by stage.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from six import string_types
+
+from gutils import safe_makedirs, setup_cli_logger
+
+import logging
+L = logging.getLogger(__name__)
+
+# Order of the stages a trace goes through, stages not listed here are reported last
+STAGES = [
+    'binary_to_ascii',
+    'ascii_to_netcdf',
+    'netcdf_to_erddap',
+    'netcdf_to_ftp',
+    'ftp_upload',
+]
+
+_tracer = None
+
+
+def trace_key(path):
+    """ 'deployment/file name', which is the same however the data folder is mounted """
+    path = os.path.normpath(path)
+    return '/'.join([os.path.basename(os.path.dirname(path)), os.path.basename(path)])
+
+
+class Span(object):
+
+    def __init__(self, stage, path):
+        self.stage = stage
+        self.path = path
+        self.trace = None
+        self.start = time.time()
+        self.end = None
+        self.result = 'processed'
+        self.outputs = []
+
+    def as_dict(self):
+        return OrderedDict([
+            ('trace', self.trace),
+            ('stage', self.stage),
+            ('file', trace_key(self.path)),
+            ('start', self.start),
+            ('end', self.end),
+            ('duration', self.end - self.start),
+            ('result', self.result),
+            ('outputs', len(self.outputs)),
+            ('pid', os.getpid()),
+        ])
+
+
+class Tracer(object):
+
+    def __init__(self, path):
+        self.path = path
+        safe_makedirs(path)
+        self.spans_path = os.path.join(path, 'spans.jsonl')
+
+        self.lock = threading.Lock()
+        # Shared by the watches, which may be in other processes
+        self.conn = sqlite3.connect(
+            os.path.join(path, 'links.sqlite'),
+            timeout=30,
+            check_same_thread=False
+        )
+        with self.lock, self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS links ('
+                '  file TEXT PRIMARY KEY,'
+                '  trace TEXT,'
+                '  linked REAL'
+                ')'
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def lookup(self, path):
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT trace FROM links WHERE file = ?', (trace_key(path),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def link(self, paths, trace):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO links VALUES (?, ?, ?)',
+                [ (trace_key(p), trace, now) for p in paths ]
+            )
+
+    def write(self, record):
+        # One write per line so processes appending to the same file don't interleave
+        with open(self.spans_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def trace(self, path):
+        """ The trace `path` belongs to, starting a new one if it is not linked to any """
+        trace = self.lookup(path)
+        if trace is not None:
+            return trace
+
+        trace = uuid.uuid4().hex
+        try:
+            arrived = os.path.getmtime(path)
+        except OSError:
+            arrived = time.time()
+        self.write(OrderedDict([
+            ('trace', trace),
+            ('stage', 'arrival'),
+            ('file', trace_key(path)),
+            ('start', arrived),
+            ('end', arrived),
+            ('duration', 0.),
+        ]))
+        return trace
+
+    def record(self, span):
+        span.end = time.time()
+        try:
+            if span.trace is None:
+                span.trace = self.trace(span.path)
+            outputs = [ o for o in span.outputs if isinstance(o, string_types) ]
+            if outputs:
+                self.link(outputs, span.trace)
+            self.write(span.as_dict())
+        except (IOError, OSError, sqlite3.Error) as e:
+            L.warning("Could not trace {} in {}: {}".format(span.path, span.stage, e))
+
+
+@contextmanager
+def traced(stage, path):
+    """ Records the block as the `stage` span of `path`. Set `outputs` on the yielded Span
+    to the files that were produced so they join the trace.
+    """
+    span = Span(stage, path)
+    tracer = _tracer
+    if tracer is not None:
+        try:
+            # Looked up before processing so an output overwriting its input keeps the trace
+            span.trace = tracer.trace(path)
+        except (IOError, OSError, sqlite3.Error) as e:
+            L.warning("Could not trace {} in {}: {}".format(path, stage, e))
+
+    try:
+        yield span
+    except BaseException:
+        span.result = 'failed'
+        raise
+    finally:
+        if tracer is not None:
+            tracer.record(span)
+
+
+def add_trace_arguments(parser):
+    parser.add_argument(
+        "--trace_path",
+        help="Folder to record the latency of each file in, shared by all of the watches",
+        default=os.environ.get('GUTILS_TRACE_DIRECTORY')
+    )
+    return parser
+
+
+def configure_tracing(trace_path):
+    global _tracer
+
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = Tracer(trace_path) if trace_path else None
+    return _tracer
+
+
+def read_spans(path, since=None):
+    spans = []
+    with open(path, 'rt') as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                # A line still being written
+                continue
+            if since is None or span['end'] >= since:
+                spans.append(span)
+    return spans
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+
+def summarize(values):
+    return OrderedDict([
+        ('median', percentile(values, 0.5)),
+        ('p95', percentile(values, 0.95)),
+        ('max', max(values) if values else None),
+    ])
+
+
+def trace_report(spans):
+    """ For each stage, over all traces: the time it spent processing the files of a
+    trace, the time from the previous stage finishing to this stage finishing, and the
+    time from the data arriving to this stage finishing.
+    """
+    traces = {}
+    for s in spans:
+        traces.setdefault(s['trace'], []).append(s)
+
+    stages = OrderedDict((s, dict(processing=[], stage=[], since_arrival=[])) for s in STAGES)
+    end_to_end = []
+    for trace_spans in traces.values():
+        arrivals = [ s['end'] for s in trace_spans if s['stage'] == 'arrival' ]
+        work = [ s for s in trace_spans if s['stage'] != 'arrival' ]
+        if not work:
+            continue
+        arrived = min(arrivals) if arrivals else min(s['start'] for s in work)
+
+        finished = {}
+        processing = {}
+        for s in work:
+            finished[s['stage']] = max(finished.get(s['stage'], 0), s['end'])
+            processing[s['stage']] = processing.get(s['stage'], 0) + s['duration']
+
+        previous = arrived
+        for stage in STAGES + sorted(set(finished) - set(STAGES)):
+            if stage not in finished:
+                continue
+            d = stages.setdefault(stage, dict(processing=[], stage=[], since_arrival=[]))
+            d['processing'].append(processing[stage])
+            d['stage'].append(max(finished[stage] - previous, 0))
+            d['since_arrival'].append(finished[stage] - arrived)
+            previous = max(previous, finished[stage])
+        end_to_end.append(max(finished.values()) - arrived)
+
+    report = OrderedDict([
+        ('traces', len(end_to_end)),
+        ('stages', OrderedDict()),
+        ('end_to_end', summarize(end_to_end)),
+    ])
+    for stage, d in stages.items():
+        if not d['since_arrival']:
+            continue
+        report['stages'][stage] = OrderedDict([
+            ('traces', len(d['since_arrival'])),
+            ('processing', summarize(d['processing'])),
+            ('stage', summarize(d['stage'])),
+            ('since_arrival', summarize(d['since_arrival'])),
+        ])
+    return report
+
+
+def format_report(report):
+
+    def seconds(v):
+        return '-' if v is None else '{:.1f}'.format(v)
+
+    header = '{:<18} {:>7}  {:>22}  {:>22}  {:>22}'.format(
+        'stage', 'traces', 'processing (s)', 'stage latency (s)', 'since arrival (s)'
+    )
+    sub = '{:<18} {:>7}  {:>22}  {:>22}  {:>22}'.format(
+        '', '', 'median / p95 / max', 'median / p95 / max', 'median / p95 / max'
+    )
+    lines = [header, sub]
+
+    def row(name, traces, *summaries):
+        cells = [
+            ' / '.join(seconds(s[k]) for k in ('median', 'p95', 'max')) if s else ''
+            for s in summaries
+        ]
+        return '{:<18} {:>7}  {:>22}  {:>22}  {:>22}'.format(name, traces, *cells)
+
+    for stage, s in report['stages'].items():
+        lines.append(row(stage, s['traces'], s['processing'], s['stage'], s['since_arrival']))
+    lines.append(row('end to end', report['traces'], None, None, report['end_to_end']))
+    return '\n'.join(lines)
+
+
+def create_trace_report_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Breaks the latency from glider data arriving to it being available "
+                    "down by stage, from the traces recorded by the watches."
+    )
+    parser.add_argument(
+        "trace_path",
+        nargs='?',
+        help="Folder the watches recorded traces in",
+        default=os.environ.get('GUTILS_TRACE_DIRECTORY')
+    )
+    parser.add_argument(
+        "--since",
+        help="Only include spans that finished in the last this many hours",
+        type=float,
+        default=None
+    )
+    parser.add_argument(
+        "--json",
+        help="Print the report as JSON",
+        action='store_true'
+    )
+    return parser
+
+
+def main_trace_report():
+    setup_cli_logger(logging.INFO)
+
+    parser = create_trace_report_arg_parser()
+    args = parser.parse_args()
+
+    if not args.trace_path:
+        L.error("Please provide a trace_path or set the "
+                "GUTILS_TRACE_DIRECTORY environmental variable")
+        sys.exit(parser.print_usage())
+
+    spans_path = os.path.join(args.trace_path, 'spans.jsonl')
+    if not os.path.isfile(spans_path):
+        L.error("No traces found in {}".format(args.trace_path))
+        return 1
+
+    since = time.time() - args.since * 3600 if args.since is not None else None
+    report = trace_report(read_spans(spans_path, since=since))
+
+    if args.json is True:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return 0
@@ -1,5 +1,7 @@
 #!python
 # coding=utf-8
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 
@@ -121,3 +123,121 @@ def assign_profiles(df, tsint=None):
     #     ))[0:20]
     # )
     return profile_df
+
+
+def assign_profiles_native(df, tsint=None, window=None):
+    """Assigns profiles like `assign_profiles` without interpolating the depths onto a
+    fixed time grid. The inflections are found in the valid depth samples themselves,
+    smoothed with a moving mean over `window` seconds (default: `tsint`), so the work
+    follows the number of depth samples and not the time the data spans.
+
+    Both detectors assign the same rows to each profile, including a single profile for
+    data without a turning point, but the profile ids may differ. Use `reassign_profile_id`
+    before comparing them.
+    """
+
+    profile_df = df.copy()
+    profile_df['profile'] = np.nan  # Fill profile with nans
+
+    if tsint is None:
+        tsint = 2
+    tsint = float(tsint)
+    if window is None:
+        window = tsint
+
+    t = np.asarray(masked_epoch(df.t), dtype='float64')
+    z = np.asarray(df.z, dtype='float64')
+
+    # Only the valid, positive depths
+    valid = np.isfinite(t) & np.isfinite(z) & (z > 0)
+    if valid.sum() < 2:
+        return None
+    order = np.argsort(t[valid], kind='mergesort')
+    vt = t[valid][order]
+    vz = z[valid][order]
+
+    # Moving mean of the depths within half a window of each sample
+    sums = np.concatenate([[0.], np.cumsum(vz)])
+    lo = np.searchsorted(vt, vt - window / 2., side='left')
+    hi = np.searchsorted(vt, vt + window / 2., side='right')
+    smoothed = (sums[hi] - sums[lo]) / (hi - lo)
+
+    direction = np.sign(np.diff(smoothed))
+    moving = np.flatnonzero(direction)
+    if moving.size < 1:
+        # Flat depths are a single profile, like they are for `assign_profiles`
+        starts = np.array([])
+    else:
+        # Keep the previous direction over flat stretches
+        last_moving = np.where(direction != 0, np.arange(direction.size), 0)
+        last_moving = np.maximum.accumulate(last_moving)
+        last_moving[:moving[0]] = moving[0]
+        direction = direction[last_moving]
+
+        # Each profile starts at a turning point
+        starts = vt[np.flatnonzero(np.diff(direction) != 0) + 1]
+
+    # Rows within the same window around the depths as `assign_profiles`
+    ts_window = tsint * 2
+    profile = np.full(len(df), np.nan)
+    between = np.isfinite(t) & (t >= vt[0] - ts_window) & (t <= vt[-1] + ts_window)
+    profile[between] = np.searchsorted(starts, t[between], side='right')
+
+    # Rows without a time are part of the profile of the row before them
+    profile = pd.Series(profile, index=df.index)
+    no_time = ~np.isfinite(t)
+    profile[no_time] = profile.ffill()[no_time]
+
+    profile_df['profile'] = profile
+    return profile_df
+
+
+# Profile detection algorithms, by the name used on the command line
+DETECTORS = OrderedDict([
+    ('interpolated', assign_profiles),
+    ('native', assign_profiles_native),
+])
+
+
+def get_detector(name):
+    try:
+        return DETECTORS[name or 'interpolated']
+    except KeyError:
+        raise ValueError('Unknown profile detector {}, use one of {}'.format(
+            name, ', '.join(DETECTORS)
+        ))
+
+
+def profile_boundaries(profiles):
+    """ The first and last time of each profile in an assigned DataFrame """
+    if profiles is None:
+        return pd.DataFrame(columns=['start', 'end'])
+    grouped = profiles.dropna(subset=['profile', 't']).groupby('profile').t
+    return pd.DataFrame({'start': grouped.min(), 'end': grouped.max()}).sort_values('start')
+
+
+def compare_profile_boundaries(a, b, tolerance=60):
+    """ Compares the profile starts of the assigned DataFrames `a` and `b`. A profile of `a`
+    matches the profile of `b` starting closest to it if they start within `tolerance`
+    seconds of each other.
+    """
+    starts_a = masked_epoch(profile_boundaries(a).start).values.astype('float64')
+    starts_b = masked_epoch(profile_boundaries(b).start).values.astype('float64')
+
+    offsets = np.array([])
+    if starts_a.size and starts_b.size:
+        nearest = np.searchsorted(starts_b, starts_a).clip(1, starts_b.size) - 1
+        after = (nearest + 1).clip(0, starts_b.size - 1)
+        offsets = np.minimum(
+            np.abs(starts_a - starts_b[nearest]),
+            np.abs(starts_a - starts_b[after])
+        )
+    matched = offsets[offsets <= tolerance]
+
+    return OrderedDict([
+        ('profiles_a', int(starts_a.size)),
+        ('profiles_b', int(starts_b.size)),
+        ('matched', int(matched.size)),
+        ('median_offset', float(np.median(matched)) if matched.size else None),
+        ('max_offset', float(matched.max()) if matched.size else None),
+    ])
@@ -26,7 +26,7 @@ setup(
     author_email='kyle@axiomdatascience.com',
     install_requires=reqs,
     url='https://github.com/SECOORA/GUTILS',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     entry_points={
         'console_scripts': [
             'gutils_create_nc = gutils.nc:main_create',
@@ -35,6 +35,11 @@ setup(
             'gutils_ascii_to_netcdf_watch = gutils.watch.ascii:main_to_netcdf',
             'gutils_netcdf_to_ftp_watch = gutils.watch.netcdf:main_to_ftp',
             'gutils_netcdf_to_erddap_watch = gutils.watch.netcdf:main_to_erddap',
+            'gutils_pipeline_watch = gutils.watch.pipeline:main_pipeline',
+            'gutils_ftp_drain = gutils.watch.netcdf:main_ftp_drain',
+            'gutils_erddap_rebuild = gutils.watch.netcdf:main_erddap_rebuild',
+            'gutils_reprocess = gutils.reprocess:main_reprocess',
+            'gutils_trace_report = gutils.watch.trace:main_trace_report',
         ]
     },
     include_package_data=True,